@@ -3,17 +3,34 @@
 """
 
 from flask import Flask, render_template, request, jsonify, session
+from flask.json.provider import DefaultJSONProvider
+from collections.abc import Mapping
 from classifier import TicketClassifier
 from response_generator import ResponseGenerator
 from knowledge_search import KnowledgeBase
 from anglicism_normalizer import get_normalizer
 from feedback_system import get_feedback_system
 from text_extractor import get_text_extractor
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from config import PIPELINE_SEARCH_WORKERS
 import json
 import os
 
+class ArticleJSONProvider(DefaultJSONProvider):
+    """JSON провайдер, сериализующий статьи БЗ (read-only Mapping) как обычные объекты"""
+    
+    ensure_ascii = False
+    
+    @staticmethod
+    def default(o):
+        if isinstance(o, Mapping):
+            return dict(o)
+        return DefaultJSONProvider.default(o)
+
+
 app = Flask(__name__)
+app.json = ArticleJSONProvider(app)
 app.config['JSON_AS_ASCII'] = False
 app.config['SECRET_KEY'] = os.urandom(24)  # Для сессий
 
@@ -25,6 +42,32 @@ knowledge_base = None
 # История обработанных обращений
 tickets_history = []
 
+# Поиск в БЗ выполняется в этих потоках параллельно с классификацией обращения
+search_executor = ThreadPoolExecutor(max_workers=PIPELINE_SEARCH_WORKERS, thread_name_prefix='kb-search')
+
+
+def frequent_search_texts(limit=None):
+    """
+    Частые обращения из истории и отзывов (feedback) в том виде,
+    в каком process_ticket передаёт их в поиск
+    """
+    from collections import Counter
+    from config import QUERY_CACHE_WARMUP_SIZE
+    
+    limit = limit or QUERY_CACHE_WARMUP_SIZE
+    counts = Counter(' '.join(ticket['ticket_text'].split()) for ticket in tickets_history)
+    for query, count in get_feedback_system().frequent_queries(limit):
+        counts[query] += count
+    
+    normalizer = get_normalizer()
+    text_extractor = get_text_extractor()
+    texts = []
+    for query, _ in counts.most_common(limit):
+        normalized_text, _ = normalizer.normalize_with_log(query)
+        optimized_text, _ = text_extractor.optimize_for_embedding(normalized_text)
+        texts.append(optimized_text)
+    return texts
+
 
 @app.route('/')
 def index():
@@ -44,11 +87,10 @@ def initialize_system():
         if not api_key:
             return jsonify({'error': 'API ключ не может быть пустым'}), 400
         
-        # Сначала проверяем валидность ключа
+        # Сначала проверяем валидность ключа (временным клиентом: общий создаётся только для рабочего ключа)
         try:
-            from llm_client import LLMClient
-            test_client = LLMClient(api_key=api_key)
-            is_valid, error_message = test_client.validate_key()
+            from llm_client import validate_api_key
+            is_valid, error_message = validate_api_key(api_key)
             
             if not is_valid:
                 return jsonify({
@@ -65,6 +107,12 @@ def initialize_system():
             classifier = TicketClassifier(api_key=api_key, knowledge_base=knowledge_base)
             response_gen = ResponseGenerator(api_key=api_key, knowledge_base=knowledge_base)
             
+            # Частые запросы не должны стоить вызова API после перезапуска
+            try:
+                knowledge_base.warm_up_query_cache(frequent_search_texts())
+            except Exception as e:
+                print(f"[WARNING] Прогрев кэша embeddings запросов не выполнен: {e}")
+            
             # Сохраняем в сессию
             session['initialized'] = True
             session['api_key'] = api_key
@@ -123,6 +171,14 @@ def process_ticket():
         if not ticket_text:
             return jsonify({'error': 'Текст обращения не может быть пустым'}), 400
         
+        import time
+        total_start = time.time()
+        
+        # Обращение дословно повторяет вопрос из БЗ - отвечаем статьёй без embedding и LLM
+        exact_article = knowledge_base.find_exact(ticket_text)
+        if exact_article is not None:
+            return jsonify(exact_match_result(ticket_text, exact_article, total_start))
+        
         # Нормализация англицизмов
         normalizer = get_normalizer()
         normalized_text, changes = normalizer.normalize_with_log(ticket_text)
@@ -131,6 +187,13 @@ def process_ticket():
         if changes:
             print(f"[ANGLICISM] Нормализация: {', '.join(changes)}")
         
+        # То же после нормализации англицизмов. Текст после TextExtractor не сравниваем:
+        # он отбрасывает предложения длинного обращения, и совпадение было бы неполным
+        if changes:
+            exact_article = knowledge_base.find_exact(normalized_text)
+            if exact_article is not None:
+                return jsonify(exact_match_result(ticket_text, exact_article, total_start, normalized_text, changes))
+        
         # Оптимизация текста для embedding
         text_extractor = get_text_extractor()
         optimized_text, optimization_stats = text_extractor.optimize_for_embedding(normalized_text)
@@ -140,16 +203,43 @@ def process_ticket():
             print(f"[OPTIMIZATION] Текст оптимизирован: {optimization_stats['original_tokens']} → {optimization_stats['optimized_tokens']} токенов "
                   f"(сжатие: {optimization_stats['compression_ratio']:.2%})")
         
-        # Начало замера общего времени
-        import time
-        total_start = time.time()
+        from config import PIPELINE_MODE, CLASSIFICATION_PROMPT_TOP_N, CLASSIFICATION_PROMPT_WAIT
+        
+        # Embedding запроса и сходство со статьями считаются параллельно с классификацией:
+        # категория нужна только для фильтра, а он применяется к уже посчитанному сходству
+        start_search = time.time()
+        scores_future = search_executor.submit(knowledge_base.score_query, optimized_text)
+        if classifier.mode != 'llm':
+            # Локальному классификатору нужен тот же embedding: ждём его, чтобы не запрашивать дважды
+            scores_future.result()
+        
+        # Режим search_first: сначала поиск без фильтра. Если лучшая статья совпадает
+        # уверенно, классификация берётся из неё и LLM не вызывается
+        result = None
+        if PIPELINE_MODE == 'search_first':
+            _, search_results_all = knowledge_base.results_from_scores(scores_future.result())
+            result = classifier.classify_from_search(optimized_text, search_results_all)
+            print(f"[TIMING] Поиск в БЗ (до классификации): {time.time() - start_search:.2f}s")
+        early_exit = result is not None
         
         # ОПТИМИЗАЦИЯ: Классификация + извлечение за ОДИН вызов
         start_classify = time.time()
         
         try:
-            # Используем оптимизированный текст для классификации
-            result = classifier.classify_and_extract(optimized_text)
+            if early_exit:
+                print(f"[EARLY EXIT] {result['reasoning']}: категория '{result['category']}', без вызова LLM")
+            else:
+                # Категории в промпте - только из лучших статей поиска. Классификатор ждёт поиск
+                # (не дольше CLASSIFICATION_PROMPT_WAIT) только если классификации нет в кэше;
+                # не дождался - полный список, поиск продолжается параллельно
+                def prompt_candidates():
+                    query_scores = scores_future.result(timeout=CLASSIFICATION_PROMPT_WAIT)
+                    return knowledge_base.results_from_scores(query_scores, top_k=CLASSIFICATION_PROMPT_TOP_N)[1]
+                
+                # Используем оптимизированный текст для классификации
+                result = classifier.classify_and_extract(
+                    optimized_text, candidates=prompt_candidates if CLASSIFICATION_PROMPT_TOP_N else None
+                )
             
             # Проверяем, не вернулась ли ошибка перегрузки
             if isinstance(result, dict) and 'error' in result:
@@ -183,73 +273,65 @@ def process_ticket():
                 }), 500
         
         # Шаг 2: Поиск релевантных решений (используем нормализованный текст)
-        start_search = time.time()
+        start_wait = time.time()
+        query_scores = scores_future.result()
         
-        # Сначала пробуем с фильтром по категории
-        search_results_filtered = knowledge_base.search(
-            optimized_text, 
-            category_filter=classification.get('category')
-        )
-        
-        # Если результаты с фильтром плохие (низкое совпадение или мало результатов), 
-        # ищем без фильтра и используем лучший результат
-        best_similarity_filtered = search_results_filtered[0]['similarity'] if search_results_filtered else 0
-        
-        if not search_results_filtered or best_similarity_filtered < 0.6:
-            if search_results_filtered:
-                print(f"[SEARCH] Низкое совпадение с фильтром ({best_similarity_filtered*100:.0f}%), пробуем без фильтра...")
-            else:
-                print(f"[SEARCH] Нет результатов с фильтром, пробуем без фильтра...")
-            
-            search_results_all = knowledge_base.search(optimized_text, category_filter=None)
-            
-            # Если без фильтра результаты лучше - используем их
-            if search_results_all:
-                best_similarity_all = search_results_all[0]['similarity']
-                if not search_results_filtered or best_similarity_all > best_similarity_filtered:
-                    print(f"[SEARCH] Используем результаты БЕЗ фильтра (лучшее совпадение: {best_similarity_all*100:.0f}%)")
-                    search_results = search_results_all
-                else:
-                    search_results = search_results_filtered
-            else:
-                search_results = search_results_filtered
+        if early_exit:
+            # Результаты поиска без фильтра уже есть, категория взята из лучшей статьи
+            search_results = search_results_all
         else:
-            search_results = search_results_filtered
+            # Результаты с фильтром по категории и без него из одного вычисления сходства
+            search_results_filtered, search_results_all = knowledge_base.results_from_scores(
+                query_scores,
+                category_filter=classification.get('category')
+            )
+            
+            # Если результаты с фильтром плохие (низкое совпадение или мало результатов),
+            # используем лучший результат без фильтра
+            search_results, _ = knowledge_base.select_results(search_results_filtered, search_results_all)
         
         # Переранжирование результатов с учетом feedback
         feedback_system = get_feedback_system()
         search_results = feedback_system.rerank_results(search_results)
         
-        print(f"[TIMING] Поиск в БЗ: {time.time() - start_search:.2f}s")
+        print(f"[TIMING] Поиск в БЗ: {time.time() - start_search:.2f}s "
+              f"(параллельно с классификацией, ожидание после неё: {time.time() - start_wait:.2f}s)")
         
-        # Определяем срочность/приоритет из найденного шаблона (лучшее совпадение)
-        priority_from_kb = 'Средний'  # По умолчанию
-        subcategories_from_kb = []  # Собираем подкатегории из найденных статей
-        
-        if search_results and len(search_results) > 0:
-            best_match = search_results[0]['article']
-            priority_from_kb = best_match.get('priority', 'Средний')
+        if early_exit:
+            # Подкатегория и приоритет - из статьи, по которой определена категория
+            subcategory = result.get('subcategory', '').strip()
+            if subcategory and subcategory != 'nan':
+                classification['subcategories'] = [subcategory]
+                classification['subcategory'] = subcategory
+        else:
+            # Определяем срочность/приоритет из найденного шаблона (лучшее совпадение)
+            priority_from_kb = 'Средний'  # По умолчанию
+            subcategories_from_kb = []  # Собираем подкатегории из найденных статей
             
-            # Собираем уникальные подкатегории из всех найденных статей
-            unique_subcats = set()
-            for result in search_results:
-                article = result['article']
-                subcat = article.get('subcategory', '')
-                if subcat and subcat != 'nan' and subcat.strip():
-                    unique_subcats.add(subcat.strip())
+            if search_results and len(search_results) > 0:
+                best_match = search_results[0]['article']
+                priority_from_kb = best_match.get('priority', 'Средний')
+                
+                # Собираем уникальные подкатегории из всех найденных статей
+                unique_subcats = set()
+                for result in search_results:
+                    article = result['article']
+                    subcat = article.get('subcategory', '')
+                    if subcat and subcat != 'nan' and subcat.strip():
+                        unique_subcats.add(subcat.strip())
+                
+                subcategories_from_kb = sorted(list(unique_subcats))
             
-            subcategories_from_kb = sorted(list(unique_subcats))
-        
-        # Заменяем срочность из LLM на приоритет из БЗ
-        key_info['urgency'] = priority_from_kb
-        
-        # Добавляем подкатегории в классификацию
-        if subcategories_from_kb:
-            classification['subcategories'] = subcategories_from_kb
-            classification['subcategory'] = ', '.join(subcategories_from_kb)  # Для совместимости
-            print(f"[SUBCATEGORIES] Найдены подкатегории: {subcategories_from_kb}")
-        else:
-            print(f"[SUBCATEGORIES] Подкатегории не найдены в результатах поиска")
+            # Заменяем срочность из LLM на приоритет из БЗ
+            key_info['urgency'] = priority_from_kb
+            
+            # Добавляем подкатегории в классификацию
+            if subcategories_from_kb:
+                classification['subcategories'] = subcategories_from_kb
+                classification['subcategory'] = ', '.join(subcategories_from_kb)  # Для совместимости
+                print(f"[SUBCATEGORIES] Найдены подкатегории: {subcategories_from_kb}")
+            else:
+                print(f"[SUBCATEGORIES] Подкатегории не найдены в результатах поиска")
         
         # Шаг 3: Генерация ответа (используем уже найденные результаты)
         start_gen = time.time()
@@ -305,6 +387,8 @@ def process_ticket():
                 }
                 for r in response_data.get('search_results', [])
             ],
+            'exact_match': False,
+            'early_exit': early_exit,
             'timestamp': datetime.now().isoformat()
         }
         
@@ -326,22 +410,92 @@ def process_ticket():
         return jsonify({'error': str(e)}), 500
 
 
+def exact_match_result(ticket_text, article, start_time, normalized_text=None, changes=None):
+    """Результат process_ticket для обращения, совпавшего с вопросом статьи БЗ"""
+    import time
+    
+    source = {
+        'id': article.get('id'),
+        'main_category': article.get('main_category', article.get('category', '')),
+        'subcategory': article.get('subcategory', ''),
+        'example_question': article.get('example_question', article.get('problem', '')),
+        'template_answer': article.get('template_answer', article.get('solution', '')),
+        'priority': article.get('priority', 'Средний'),
+        'target_audience': article.get('target_audience', 'Все')
+    }
+    
+    classification = {
+        'category': source['main_category'],
+        'confidence': 'высокая',
+        'reasoning': 'Обращение совпадает с вопросом из базы знаний'
+    }
+    if source['subcategory']:
+        classification['subcategories'] = [source['subcategory']]
+        classification['subcategory'] = source['subcategory']
+    
+    result = {
+        'ticket_text': ticket_text,
+        'normalized_text': normalized_text,
+        'optimized_text': None,
+        'anglicism_changes': changes or None,
+        'optimization_stats': None,
+        'classification': classification,
+        'key_info': {
+            'main_issue': source['example_question'],
+            'urgency': source['priority'],
+            'sentiment': 'нейтральное',
+            'key_details': []
+        },
+        'suggested_response': source['template_answer'],
+        'confidence': 'высокая',
+        'sources': [source],
+        'search_results': [
+            {
+                'similarity': r['similarity'],
+                'article': r['article'],
+                'article_id': r['article_id'],
+                'feedback_bonus': r['feedback_bonus'],
+                'feedback_stats': r['feedback_stats']
+            }
+            # article_id и статистика отзывов - как у обычных результатов поиска
+            for r in get_feedback_system().rerank_results([{'article': article, 'similarity': 1.0}])
+        ],
+        'exact_match': True,
+        'timestamp': datetime.now().isoformat()
+    }
+    tickets_history.append(result)
+    
+    print(f"[EXACT MATCH] Статья {source['id']}: {(time.time() - start_time) * 1000:.2f}ms")
+    return result
+
+
 @app.route('/api/search', methods=['POST'])
 def search_knowledge():
     """
     API endpoint для поиска по базе знаний
     
-    Принимает JSON: {"query": "поисковый запрос", "category": "категория (опционально)"}
+    Принимает JSON: {
+        "query": "поисковый запрос",
+        "category": "категория (опционально)",
+        "subcategory": "подкатегория (опционально)",
+        "target_audience": "целевая аудитория (опционально)",
+        "priority": "приоритет (опционально)"
+    }
     """
     try:
         data = request.get_json()
         query = data.get('query', '').strip()
-        category = data.get('category')
         
         if not query:
             return jsonify({'error': 'Поисковый запрос не может быть пустым'}), 400
         
-        results = knowledge_base.search(query, category_filter=category)
+        results = knowledge_base.search(
+            query,
+            category_filter=data.get('category'),
+            subcategory_filter=data.get('subcategory'),
+            audience_filter=data.get('target_audience'),
+            priority_filter=data.get('priority')
+        )
         
         formatted_results = [
             {
@@ -358,6 +512,132 @@ def search_knowledge():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/search_batch', methods=['POST'])
+def search_knowledge_batch():
+    """
+    API endpoint для пакетного поиска по базе знаний
+    
+    Принимает JSON: {
+        "queries": ["запрос 1", "запрос 2", ...],
+        "top_k": 3 (опционально),
+        "category", "subcategory", "target_audience", "priority": фильтры (опционально, общие для всех запросов)
+    }
+    Возвращает результаты в том же порядке, что и запросы
+    """
+    from config import SEARCH_BATCH_MAX_QUERIES, SEARCH_TOP_K
+    
+    if not knowledge_base:
+        return jsonify({'error': 'Система не инициализирована. Введите API ключ.'}), 400
+    
+    try:
+        data = request.get_json()
+        queries = data.get('queries')
+        
+        if not isinstance(queries, list) or not queries:
+            return jsonify({'error': 'queries должен быть непустым списком'}), 400
+        
+        if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+            return jsonify({'error': f'Слишком много запросов (максимум {SEARCH_BATCH_MAX_QUERIES})'}), 400
+        
+        queries = [str(q).strip() for q in queries]
+        if not all(queries):
+            return jsonify({'error': 'Поисковый запрос не может быть пустым'}), 400
+        
+        # Через str: 3.5 и true не превращаются молча в 3 и 1
+        try:
+            top_k = int(str(data.get('top_k', SEARCH_TOP_K)))
+        except ValueError:
+            top_k = 0
+        if top_k <= 0:
+            return jsonify({'error': 'top_k должен быть положительным целым числом'}), 400
+        
+        results = knowledge_base.search_batch(
+            queries,
+            top_k=top_k,
+            category_filter=data.get('category'),
+            subcategory_filter=data.get('subcategory'),
+            audience_filter=data.get('target_audience'),
+            priority_filter=data.get('priority')
+        )
+        
+        return jsonify({
+            'results': [
+                {
+                    'query': query,
+                    'results': [
+                        {
+                            'similarity': r['similarity'],
+                            'article': r['article']
+                        }
+                        for r in query_results
+                    ]
+                }
+                for query, query_results in zip(queries, results)
+            ]
+        })
+    
+    except Exception as e:
+        print(f"[ERROR] Ошибка при пакетном поиске: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/articles', methods=['POST'])
+def add_article():
+    """
+    API endpoint для добавления статьи в базу знаний без перезапуска
+    
+    Принимает JSON с полями статьи: {
+        "main_category", "subcategory", "example_question", "template_answer",
+        "priority", "target_audience" (как в файле БЗ), "id" (опционально)
+    }
+    """
+    if not knowledge_base:
+        return jsonify({'error': 'Система не инициализирована. Введите API ключ.'}), 400
+    
+    try:
+        data = request.get_json()
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Ожидается объект статьи'}), 400
+        
+        article = knowledge_base.add_article(data)
+        return jsonify({'success': True, 'article': article, 'version': knowledge_base.version.number}), 201
+    
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"[ERROR] Ошибка при добавлении статьи: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/articles/<int:article_id>', methods=['PUT', 'DELETE'])
+def change_article(article_id):
+    """
+    API endpoint для изменения (PUT, JSON с изменяемыми полями) или удаления (DELETE) статьи
+    """
+    if not knowledge_base:
+        return jsonify({'error': 'Система не инициализирована. Введите API ключ.'}), 400
+    
+    try:
+        if request.method == 'DELETE':
+            knowledge_base.delete_article(article_id)
+            return jsonify({'success': True, 'version': knowledge_base.version.number})
+        
+        data = request.get_json()
+        if not isinstance(data, dict) or not data:
+            return jsonify({'error': 'Ожидается объект с изменяемыми полями статьи'}), 400
+        
+        article = knowledge_base.update_article(article_id, data)
+        return jsonify({'success': True, 'article': article, 'version': knowledge_base.version.number})
+    
+    except KeyError:
+        return jsonify({'error': f'Статья с id {article_id} не найдена'}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"[ERROR] Ошибка при изменении статьи: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/api/history')
 def get_history():
     """Получить историю обработанных обращений"""
@@ -374,11 +654,20 @@ def get_categories():
 @app.route('/api/stats')
 def get_stats():
     """Получить статистику"""
+    from cache import cache_stats
+    from rate_limiter import rate_limit_stats
+    from llm_client import single_flight_stats, batcher_stats
+    
     if not tickets_history:
         return jsonify({
             'total_tickets': 0,
             'categories_distribution': {},
-            'avg_confidence': 0
+            'avg_confidence': 0,
+            'caches': cache_stats(),
+            'rate_limits': rate_limit_stats(),
+            'single_flight': single_flight_stats(),
+            'embedding_batches': batcher_stats(),
+            'prompt_pruning': classifier.prompt_stats() if classifier else {}
         })
     
     # Подсчет статистики
@@ -399,7 +688,12 @@ def get_stats():
             'высокая': confidences.count('высокая'),
             'средняя': confidences.count('средняя'),
             'низкая': confidences.count('низкая')
-        }
+        },
+        'caches': cache_stats(),
+        'rate_limits': rate_limit_stats(),
+        'single_flight': single_flight_stats(),
+        'embedding_batches': batcher_stats(),
+        'prompt_pruning': classifier.prompt_stats() if classifier else {}
     })
 
 
@@ -0,0 +1,209 @@
+"""
+Компактное хранилище статей базы знаний
+
+Статьи хранятся по колонкам: тексты - в списках строк, повторяющиеся
+значения (категории, приоритеты, аудитории) - интернированными номерами.
+Для обратной совместимости каждая статья доступна как read-only
+отображение Article с прежними ключами, включая старые синонимы
+category / problem / solution.
+"""
+
+import sys
+from array import array
+from collections.abc import Mapping, Sequence
+
+
+class ArticleStore(Sequence):
+    """Колоночное хранилище статей (только добавление)"""
+
+    FIELDS = ('id', 'main_category', 'subcategory', 'example_question', 'priority', 'target_audience', 'template_answer')
+    # Старые ключи -> основное поле (отдельных копий значений не храним)
+    ALIASES = {'category': 'main_category', 'problem': 'example_question', 'solution': 'template_answer'}
+    # Поля с небольшим числом различных значений храним номерами
+    INTERNED = ('main_category', 'subcategory', 'priority', 'target_audience')
+    DEFAULTS = {'main_category': 'Другое', 'priority': 'Средний', 'target_audience': 'Все'}
+
+    def __init__(self):
+        self._columns = {field: [] for field in self.FIELDS if field not in self.INTERNED}
+        self._codes = {field: array('i') for field in self.INTERNED}
+        self._values = {field: [] for field in self.INTERNED}
+        self._value_ids = {field: {} for field in self.INTERNED}
+        self._extra = {}  # номер строки -> dict нестандартных полей (из JSON)
+        self._size = 0
+
+    @classmethod
+    def from_dicts(cls, articles):
+        store = cls()
+        for article in articles:
+            store.append(article)
+        return store
+
+    @classmethod
+    def from_rows(cls, fields, rows):
+        store = cls()
+        for row in rows:
+            store.append(dict(zip(fields, row)))
+        return store
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Article(self, i) for i in range(*index.indices(self._size))]
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError('article index out of range')
+        return Article(self, index)
+
+    def __iter__(self):
+        return (Article(self, i) for i in range(self._size))
+
+    def _intern(self, field, value):
+        value_ids = self._value_ids[field]
+        value_id = value_ids.get(value)
+        if value_id is None:
+            value_id = value_ids[value] = len(value_ids)
+            self._values[field].append(sys.intern(value) if isinstance(value, str) else value)
+        return value_id
+
+    def append(self, article):
+        """
+        Добавляет статью из dict/Mapping
+
+        Старые ключи (category, problem, solution) используются, если нет основных.
+
+        Returns:
+            int: Номер строки новой статьи
+        """
+        row = self._size
+        for field in self.FIELDS:
+            value = article.get(field)
+            if value is None:
+                for alias, target in self.ALIASES.items():
+                    if target == field and article.get(alias) is not None:
+                        value = article.get(alias)
+                        break
+            if value is None and field != 'id':
+                value = self.DEFAULTS.get(field, '')
+
+            if field in self._codes:
+                self._codes[field].append(self._intern(field, value))
+            else:
+                self._columns[field].append(value)
+
+        extra = {key: value for key, value in article.items() if key not in self.FIELDS and key not in self.ALIASES}
+        if extra:
+            self._extra[row] = extra
+
+        self._size += 1
+        return row
+
+    def value(self, row, field):
+        """Значение поля статьи (KeyError, если поля нет)"""
+        field = self.ALIASES.get(field, field)
+        codes = self._codes.get(field)
+        if codes is not None:
+            return self._values[field][codes[row]]
+        column = self._columns.get(field)
+        if column is not None:
+            return column[row]
+        return self._extra[row][field]
+
+    def keys(self, row):
+        keys = self.FIELDS + tuple(self.ALIASES)
+        extra = self._extra.get(row)
+        return keys + tuple(extra) if extra else keys
+
+    def has_key(self, row, key):
+        if key in self.ALIASES or key in self._codes or key in self._columns:
+            return True
+        extra = self._extra.get(row)
+        return bool(extra) and key in extra
+
+    def field_codes(self, field):
+        """Номера значений интернированного поля по статьям и список самих значений"""
+        return self._codes[field], self._values[field]
+
+    @property
+    def fields(self):
+        """Поля для сохранения (без синонимов)"""
+        extra = []
+        for row_extra in self._extra.values():
+            for key in row_extra:
+                if key not in extra:
+                    extra.append(key)
+        return list(self.FIELDS) + extra
+
+    def iter_rows(self, fields=None):
+        """Статьи как списки значений в порядке fields"""
+        fields = fields or self.fields
+        for row in range(self._size):
+            extra = self._extra.get(row, {})
+            yield [
+                extra.get(field) if field not in self.FIELDS else self.value(row, field)
+                for field in fields
+            ]
+
+
+class ArticleView(Sequence):
+    """Статьи хранилища по списку строк (например, только актуальные статьи версии БЗ)"""
+
+    __slots__ = ('_store', '_rows')
+
+    def __init__(self, store, rows):
+        self._store = store
+        self._rows = rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Article(self._store, int(row)) for row in self._rows[index]]
+        return Article(self._store, int(self._rows[index]))
+
+    def __iter__(self):
+        return (Article(self._store, int(row)) for row in self._rows)
+
+
+class Article(Mapping):
+    """Read-only представление статьи из ArticleStore с интерфейсом dict"""
+
+    __slots__ = ('_store', '_row')
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    @property
+    def row(self):
+        """Номер строки статьи в хранилище"""
+        return self._row
+
+    def __getitem__(self, key):
+        try:
+            return self._store.value(self._row, key)
+        except (KeyError, TypeError):
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        if not self._store.has_key(self._row, key):
+            return default
+        return self._store.value(self._row, key)
+
+    def __contains__(self, key):
+        return self._store.has_key(self._row, key)
+
+    def __iter__(self):
+        return iter(self._store.keys(self._row))
+
+    def __len__(self):
+        return len(self._store.keys(self._row))
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return f"Article({self.to_dict()!r})"
@@ -0,0 +1,502 @@
+"""
+Общий кэш с вытеснением LRU и сроком жизни записей (TTL)
+
+Бэкенды:
+- memory - словарь в памяти процесса (по умолчанию);
+- sqlite - локальный файл SQLite, общий для всех воркеров на машине;
+- redis  - Redis-совместимый сервер (нужен пакет redis).
+
+Кэш ограничивается числом записей и суммарным размером значений в байтах
+и считает попадания, промахи и вытеснения. Значения сериализуются pickle,
+поэтому бэкенды sqlite и redis рассчитаны только на локальное использование.
+"""
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from config import CACHE_BACKEND, CACHE_SQLITE_PATH, CACHE_REDIS_URL
+
+
+class BaseCache:
+    """
+    Интерфейс кэша
+
+    Args:
+        name: Имя кэша (пространство ключей в общих бэкендах)
+        max_entries: Максимум записей (None - без ограничения)
+        max_bytes: Максимум суммарного размера значений (None - без ограничения)
+        ttl: Время жизни записи в секундах (None - бессрочно)
+    """
+
+    backend = None
+
+    def __init__(self, name, max_entries=None, max_bytes=None, ttl=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _count(self, hits=0, misses=0, evictions=0):
+        with self._stats_lock:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
+
+    def _expires_at(self):
+        return time.time() + self.ttl if self.ttl else None
+
+    @staticmethod
+    def _dumps(value):
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def get(self, key, default=None):
+        """Значение по ключу (default, если записи нет или срок её жизни истёк)"""
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def size_bytes(self):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """Значения для списка ключей (None для отсутствующих)"""
+        return [self.get(key) for key in keys]
+
+    def set_many(self, items):
+        for key, value in items:
+            self.set(key, value)
+
+    def stats(self):
+        """Счётчики и заполненность кэша"""
+        with self._stats_lock:
+            hits, misses, evictions = self.hits, self.misses, self.evictions
+        total = hits + misses
+        return {
+            'backend': self.backend,
+            'entries': len(self),
+            'bytes': self.size_bytes(),
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'hits': hits,
+            'misses': misses,
+            'evictions': evictions,
+            'hit_rate': hits / total if total else 0,
+        }
+
+
+_MISSING = object()
+
+
+class MemoryCache(BaseCache):
+    """LRU+TTL кэш в памяти процесса (потокобезопасный)"""
+
+    backend = 'memory'
+
+    def __init__(self, name, max_entries=None, max_bytes=None, ttl=None):
+        super().__init__(name, max_entries, max_bytes, ttl)
+        self._lock = threading.RLock()
+        self._data = OrderedDict()  # ключ -> (значение, срок жизни, размер); порядок - от давних к свежим
+        self._bytes = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._count(misses=1)
+                return default
+            self._data.move_to_end(key)
+        self._count(hits=1)
+        return entry[0]
+
+    def set(self, key, value):
+        size = len(self._dumps(value)) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return  # Значение больше всего кэша
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, self._expires_at(), size)
+            self._bytes += size
+            self._evict()
+
+    def _remove(self, key):
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def _evict(self):
+        evicted = 0
+        while self._data and (
+            (self.max_entries and len(self._data) > self.max_entries)
+            or (self.max_bytes and self._bytes > self.max_bytes)
+        ):
+            _, (_, _, size) = self._data.popitem(last=False)
+            self._bytes -= size
+            evicted += 1
+        if evicted:
+            self._count(evictions=evicted)
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def size_bytes(self):
+        return self._bytes
+
+
+class SQLiteCache(BaseCache):
+    """
+    LRU+TTL кэш в локальном файле SQLite, общий для процессов
+
+    Время последнего обращения хранится в строке, при превышении лимитов
+    удаляются самые давние записи. Каждый поток работает со своим соединением.
+    """
+
+    backend = 'sqlite'
+
+    def __init__(self, name, path, max_entries=None, max_bytes=None, ttl=None):
+        super().__init__(name, max_entries, max_bytes, ttl)
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " name TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL,"
+                " size INTEGER NOT NULL, expires_at REAL, accessed_at REAL NOT NULL,"
+                " PRIMARY KEY (name, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_lru ON cache (name, accessed_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn = self._local.conn = _Transaction(conn)
+        return conn
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM cache WHERE name = ? AND key = ?", (self.name, key)
+            ).fetchone()
+            if row is not None and row[1] is not None and row[1] < now:
+                conn.execute("DELETE FROM cache WHERE name = ? AND key = ?", (self.name, key))
+                row = None
+            if row is not None:
+                conn.execute(
+                    "UPDATE cache SET accessed_at = ? WHERE name = ? AND key = ?", (now, self.name, key)
+                )
+        if row is None:
+            self._count(misses=1)
+            return default
+        self._count(hits=1)
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        self.set_many([(key, value)])
+
+    def set_many(self, items):
+        now = time.time()
+        rows = []
+        for key, value in items:
+            blob = self._dumps(value)
+            if self.max_bytes and len(blob) > self.max_bytes:
+                continue
+            rows.append((self.name, key, blob, len(blob), self._expires_at(), now))
+        if not rows:
+            return
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        evicted = conn.execute(
+            "DELETE FROM cache WHERE name = ? AND expires_at < ?", (self.name, now)
+        ).rowcount
+        count, total = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache WHERE name = ?", (self.name,)
+        ).fetchone()
+
+        if self.max_entries and count > self.max_entries:
+            evicted += conn.execute(
+                "DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache WHERE name = ?"
+                " ORDER BY accessed_at LIMIT ?)", (self.name, count - self.max_entries)
+            ).rowcount
+            count, total = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache WHERE name = ?", (self.name,)
+            ).fetchone()
+
+        if self.max_bytes and total > self.max_bytes:
+            # Самые давние записи, после удаления которых размер укладывается в лимит
+            excess = total - self.max_bytes
+            freed = 0
+            rowids = []
+            for rowid, size in conn.execute(
+                "SELECT rowid, size FROM cache WHERE name = ? ORDER BY accessed_at", (self.name,)
+            ):
+                rowids.append(rowid)
+                freed += size
+                if freed >= excess:
+                    break
+            conn.executemany("DELETE FROM cache WHERE rowid = ?", [(rowid,) for rowid in rowids])
+            evicted += len(rowids)
+
+        if evicted:
+            self._count(evictions=evicted)
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache WHERE name = ? AND key = ?", (self.name, key))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache WHERE name = ?", (self.name,))
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM cache WHERE name = ?", (self.name,)).fetchone()[0]
+
+    def size_bytes(self):
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM cache WHERE name = ?", (self.name,)
+            ).fetchone()[0]
+
+
+class _Transaction:
+    """Соединение SQLite, где with открывает транзакцию BEGIN IMMEDIATE (блокировка между процессами)"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.depth = 0
+
+    def execute(self, *args):
+        return self.conn.execute(*args)
+
+    def executemany(self, *args):
+        return self.conn.executemany(*args)
+
+    def __enter__(self):
+        if self.depth == 0:
+            self.conn.execute("BEGIN IMMEDIATE")
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.depth -= 1
+        if self.depth == 0:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+class RedisCache(BaseCache):
+    """
+    LRU+TTL кэш в Redis-совместимом сервере
+
+    Значения хранятся в ключах "<name>:<key>" со сроком жизни, порядок
+    обращений - в отсортированном множестве "<name>:lru", размеры - в хэше
+    "<name>:sizes".
+    """
+
+    backend = 'redis'
+
+    def __init__(self, name, url, max_entries=None, max_bytes=None, ttl=None):
+        super().__init__(name, max_entries, max_bytes, ttl)
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.client.ping()
+        self._lru_key = f"{name}:lru"
+        self._sizes_key = f"{name}:sizes"
+        self._bytes_key = f"{name}:bytes"
+
+    def _value_key(self, key):
+        return f"{self.name}:v:{key}"
+
+    def get(self, key, default=None):
+        blob = self.client.get(self._value_key(key))
+        if blob is None:
+            self._forget_expired([key])
+            self._count(misses=1)
+            return default
+        self.client.zadd(self._lru_key, {key: time.time()})
+        self._count(hits=1)
+        return pickle.loads(blob)
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        blobs = self.client.mget([self._value_key(key) for key in keys])
+        found = {key: time.time() for key, blob in zip(keys, blobs) if blob is not None}
+        if found:
+            self.client.zadd(self._lru_key, found)
+        if len(found) < len(keys):
+            self._forget_expired([key for key, blob in zip(keys, blobs) if blob is None])
+        self._count(hits=len(found), misses=len(keys) - len(found))
+        return [pickle.loads(blob) if blob is not None else None for blob in blobs]
+
+    def set(self, key, value):
+        self.set_many([(key, value)])
+
+    def set_many(self, items):
+        now = time.time()
+        blobs = {}
+        for key, value in items:
+            blob = self._dumps(value)
+            if not self.max_bytes or len(blob) <= self.max_bytes:
+                blobs[key] = blob
+        if not blobs:
+            return
+
+        old_sizes = self.client.hmget(self._sizes_key, list(blobs))
+        pipe = self.client.pipeline()
+        for key, blob in blobs.items():
+            pipe.set(self._value_key(key), blob, ex=int(self.ttl) if self.ttl else None)
+            pipe.zadd(self._lru_key, {key: now})
+            pipe.hset(self._sizes_key, key, len(blob))
+        delta = sum(len(blob) for blob in blobs.values()) - sum(int(size or 0) for size in old_sizes)
+        pipe.incrby(self._bytes_key, delta)
+        pipe.execute()
+        self._evict()
+
+    def _forget_expired(self, keys):
+        """
+        Убирает промахнувшиеся ключи (могли истечь по TTL) из LRU и учёта размера
+
+        Размеры читаются и удаляются в одной транзакции, поэтому одновременные
+        промахи по одному ключу не вычтут его размер дважды.
+        """
+        pipe = self.client.pipeline()
+        for key in keys:
+            pipe.hget(self._sizes_key, key)
+            pipe.hdel(self._sizes_key, key)
+        pipe.zrem(self._lru_key, *keys)
+        replies = pipe.execute()
+        freed = sum(int(size) for size, removed in zip(replies[0:-1:2], replies[1:-1:2]) if removed and size)
+        if freed:
+            self.client.decrby(self._bytes_key, freed)
+
+    def _forget(self, keys):
+        pipe = self.client.pipeline()
+        pipe.zrem(self._lru_key, *keys)
+        pipe.hdel(self._sizes_key, *keys)
+        pipe.execute()
+
+    def _evict(self):
+        evicted = 0
+        while True:
+            count = self.client.zcard(self._lru_key)
+            total = int(self.client.get(self._bytes_key) or 0)
+            over_entries = self.max_entries and count > self.max_entries
+            over_bytes = self.max_bytes and total > self.max_bytes
+            if not count or not (over_entries or over_bytes):
+                break
+            oldest = [key.decode('utf-8') for key in self.client.zrange(self._lru_key, 0, 0)]
+            sizes = self.client.hmget(self._sizes_key, oldest)
+            self.client.delete(*[self._value_key(key) for key in oldest])
+            self._forget(oldest)
+            self.client.decrby(self._bytes_key, sum(int(size or 0) for size in sizes))
+            evicted += len(oldest)
+        if evicted:
+            self._count(evictions=evicted)
+
+    def delete(self, key):
+        size = self.client.hget(self._sizes_key, key)
+        self.client.delete(self._value_key(key))
+        self._forget([key])
+        if size:
+            self.client.decrby(self._bytes_key, int(size))
+
+    def clear(self):
+        keys = [key.decode('utf-8') for key in self.client.zrange(self._lru_key, 0, -1)]
+        if keys:
+            self.client.delete(*[self._value_key(key) for key in keys])
+        self.client.delete(self._lru_key, self._sizes_key, self._bytes_key)
+
+    def __len__(self):
+        return self.client.zcard(self._lru_key)
+
+    def size_bytes(self):
+        return int(self.client.get(self._bytes_key) or 0)
+
+
+# Кэши по имени: один экземпляр на процесс
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(name, max_entries=None, max_bytes=None, ttl=None, backend=None):
+    """
+    Получение общего экземпляра кэша по имени
+
+    Бэкенд задаётся CACHE_BACKEND. Если sqlite или redis недоступны,
+    используется кэш в памяти процесса.
+    """
+    with _caches_lock:
+        cache = _caches.get(name)
+        if cache is not None:
+            return cache
+
+        backend = backend or CACHE_BACKEND
+        try:
+            if backend == 'sqlite':
+                path = CACHE_SQLITE_PATH
+                if not os.path.isabs(path):
+                    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+                cache = SQLiteCache(name, path, max_entries, max_bytes, ttl)
+            elif backend == 'redis':
+                cache = RedisCache(name, CACHE_REDIS_URL, max_entries, max_bytes, ttl)
+            elif backend != 'memory':
+                print(f"[WARNING] Неизвестный бэкенд кэша: {backend}, используем memory")
+        except Exception as e:
+            print(f"[WARNING] Кэш {name}: бэкенд {backend} недоступен ({e}), используем memory")
+            cache = None
+
+        if cache is None:
+            cache = MemoryCache(name, max_entries, max_bytes, ttl)
+
+        _caches[name] = cache
+        return cache
+
+
+def cache_stats():
+    """Статистика всех созданных кэшей"""
+    with _caches_lock:
+        caches = dict(_caches)
+    return {name: cache.stats() for name, cache in caches.items()}
@@ -3,20 +3,38 @@
 """
 
 from llm_client import LLMClient
-from config import CATEGORIES
+from cache import get_cache
+from local_classifier import LocalClassifier
+from rate_limiter import estimate_tokens
+from config import (
+    CATEGORIES, CLASSIFICATION_CACHE, EARLY_EXIT_SIMILARITY,
+    CLASSIFIER_MODE, LOCAL_CLASSIFIER_MIN_CONFIDENCE, LOCAL_CLASSIFIER_FALLBACK, CLASSIFICATION_PROMPT_MIN_SIMILARITY
+)
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import hashlib
 import json
+import threading
 
+# Промпт classify_and_extract: на каждый запрос подставляются только категории и текст
+CLASSIFY_AND_EXTRACT_SYSTEM = "Классификация. JSON only. Всегда возвращай подкатегорию если она подходит."
+CLASSIFY_AND_EXTRACT_PROMPT = """Категории: {categories}
+Запрос: "{ticket_text}"
+JSON: {{"category": "...", "subcategory": "..." (если применимо), "confidence": "высокая/средняя/низкая", "reasoning": "...", "key_info": {{"main_issue": "...", "urgency": "обычно", "sentiment": "нейтральное", "key_details": []}}}}"""
 
 class TicketClassifier:
     """Классификатор обращений на основе LLM"""
     
-    def __init__(self, api_key=None, knowledge_base=None):
+    def __init__(self, api_key=None, knowledge_base=None, mode=CLASSIFIER_MODE):
         self.llm = LLMClient(api_key=api_key)
         self.knowledge_base = knowledge_base
+        self.mode = mode
         
-        # Кэш для классификации (хэш запроса -> результат)
-        self.classification_cache = {}
-        self.cache_max_size = 100  # Максимум 100 запросов в кэше
+        # Общий LRU+TTL кэш классификации (хэш набора категорий БЗ и запроса -> результат)
+        self.classification_cache = get_cache('classification', **CLASSIFICATION_CACHE)
+        
+        # Промпты чат-модели: сокращённые и с полным списком категорий (по причине)
+        self._prompt_stats = {'prompts': 0, 'pruned': 0, 'search_pending': 0, 'weak_match': 0, 'no_candidates': 0}
+        self._prompt_stats_lock = threading.Lock()
         
         # Загружаем категории и подкатегории из БЗ если доступна
         if knowledge_base and knowledge_base.articles:
@@ -42,6 +60,29 @@ class TicketClassifier:
         else:
             self.categories = CATEGORIES
             self.category_subcategories = {}
+        
+        # Строки "категория (подкатегории)" для промпта собираются один раз
+        self._category_lines = {}
+        for cat in self.categories:
+            if cat in self.category_subcategories and self.category_subcategories[cat]:
+                subcats = ", ".join(self.category_subcategories[cat])
+                self._category_lines[cat] = f"{cat} ({subcats})"
+            else:
+                self._category_lines[cat] = cat
+        self._all_categories = "; ".join(self._category_lines.values())
+        
+        # Результат классификации зависит от набора категорий: он входит в ключ кэша
+        self._cache_prefix = hashlib.md5(
+            json.dumps([self.categories, self.category_subcategories], ensure_ascii=False, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+        
+        # Локальный kNN-классификатор по embeddings статей БЗ. В режиме llm он нужен только
+        # при перегрузке API, поэтому калибруется при первом таком случае, а не при запуске
+        self.local_classifier = None
+        if knowledge_base and knowledge_base.version is not None and (mode != 'llm' or LOCAL_CLASSIFIER_FALLBACK):
+            self.local_classifier = LocalClassifier(knowledge_base)
+            if mode != 'llm':
+                self.local_classifier.calibrated()
     
     def classify(self, ticket_text):
         """
@@ -151,7 +192,129 @@ class TicketClassifier:
             "key_details": []
         }
     
-    def classify_and_extract(self, ticket_text):
+    @staticmethod
+    def classify_from_search(ticket_text, search_results, min_similarity=EARLY_EXIT_SIMILARITY):
+        """
+        Классификация по лучшей статье поиска без вызова LLM
+        
+        Args:
+            ticket_text: Текст обращения
+            search_results: Результаты поиска без фильтра по категории
+            min_similarity: Минимальное сходство лучшей статьи
+            
+        Returns:
+            dict в формате classify_and_extract (с category, subcategory и приоритетом
+            статьи) или None, если совпадение недостаточно уверенное
+        """
+        if not search_results or search_results[0]['similarity'] < min_similarity:
+            return None
+        
+        best = search_results[0]
+        article = best['article']
+        return {
+            "category": article.get('main_category', article.get('category', 'Другое')),
+            "subcategory": article.get('subcategory', ''),
+            "confidence": "высокая",
+            "reasoning": f"Совпадение со статьёй базы знаний ({best['similarity']*100:.0f}%)",
+            "key_info": {
+                "main_issue": ticket_text[:100],
+                "urgency": article.get('priority', 'Средний'),
+                "sentiment": "нейтральное",
+                "key_details": []
+            }
+        }
+    
+    def candidate_categories(self, candidates, min_similarity=CLASSIFICATION_PROMPT_MIN_SIMILARITY):
+        """
+        Категории лучших статей поиска в порядке сходства
+        
+        Returns:
+            list или None, если кандидатов нет или совпадение слабое (тогда нужен полный список)
+        """
+        if not candidates or candidates[0]['similarity'] < min_similarity:
+            return None
+        
+        categories = []
+        for result in candidates:
+            article = result['article']
+            cat = article.get('main_category', article.get('category', ''))
+            if cat and cat not in categories:
+                categories.append(cat)
+        return categories or None
+    
+    def _prompt_categories(self, candidates):
+        """
+        Категории для промпта чат-модели и учёт того, как часто промпт сокращается
+        
+        Args:
+            candidates: Результаты поиска или функция, которая их возвращает
+                (может ждать поиск и выбросить TimeoutError, если он не успел)
+        
+        Returns:
+            list или None (полный список категорий)
+        """
+        reason = 'pruned'
+        if callable(candidates):
+            try:
+                candidates = candidates()
+            except FutureTimeoutError:
+                print(f"[PROMPT] Поиск ещё идёт, в промпте полный список категорий")
+                candidates, reason = None, 'search_pending'
+        
+        categories = self.candidate_categories(candidates)
+        if categories is None and reason == 'pruned':
+            reason = 'weak_match' if candidates else 'no_candidates'
+        with self._prompt_stats_lock:
+            self._prompt_stats['prompts'] += 1
+            self._prompt_stats[reason] += 1
+        return categories
+    
+    def prompt_stats(self):
+        """Сколько промптов чат-модели получили сокращённый список категорий и почему остальные - полный"""
+        with self._prompt_stats_lock:
+            stats = dict(self._prompt_stats)
+        stats['pruned_share'] = round(stats['pruned'] / stats['prompts'], 3) if stats['prompts'] else 0
+        return stats
+    
+    def classify_and_extract(self, ticket_text, candidates=None):
+        """
+        Классификация + извлечение информации (по CLASSIFIER_MODE)
+        
+        В режиме local классифицирует локальный классификатор, в режиме hybrid -
+        он же, а чат-модель вызывается только при уверенности ниже
+        LOCAL_CLASSIFIER_MIN_CONFIDENCE. Если чат-модель перегружена, ответ
+        локального классификатора заменяет ошибку rate_limit.
+        
+        Args:
+            ticket_text: Текст обращения клиента
+            candidates: Результаты поиска без фильтра или функция, которая их
+                возвращает (вызывается, только если нужен запрос к чат-модели);
+                в промпт попадут только их категории (None - все категории)
+        
+        Returns:
+            dict: Как в _classify_and_extract_llm; у локального результата
+            дополнительно confidence_score и classifier='local'
+        """
+        local_result = None
+        if self.local_classifier and self.mode in ('local', 'hybrid'):
+            local_result = self.local_classifier.classify_and_extract(ticket_text)
+            if local_result and (self.mode == 'local' or local_result['confidence_score'] >= LOCAL_CLASSIFIER_MIN_CONFIDENCE):
+                print(f"[LOCAL] Классификация: '{local_result['category']}' (уверенность {local_result['confidence_score']:.2f})")
+                return local_result
+        
+        result = self._classify_and_extract_llm(ticket_text, candidates)
+        
+        if (isinstance(result, dict) and result.get('error') in ('rate_limit', 'max_retries_exceeded')
+                and self.local_classifier and LOCAL_CLASSIFIER_FALLBACK):
+            if local_result is None:
+                local_result = self.local_classifier.classify_and_extract(ticket_text)
+            if local_result:
+                print(f"[WARNING] Чат-модель перегружена, используется локальная классификация: '{local_result['category']}'")
+                return local_result
+        
+        return result
+    
+    def _classify_and_extract_llm(self, ticket_text, candidates=None):
         """
         ОПТИМИЗИРОВАННЫЙ МЕТОД: Классификация + извлечение информации за ОДИН вызов LLM
         С КЭШИРОВАНИЕМ для ускорения повторных запросов
@@ -161,6 +324,7 @@ class TicketClassifier:
         
         Args:
             ticket_text: Текст обращения клиента
+            candidates: Результаты поиска (или функция) для сокращения категорий в промпте
             
         Returns:
             dict: {
@@ -176,34 +340,35 @@ class TicketClassifier:
             }
         """
         import time
-        import hashlib
         
-        # Проверяем кэш
-        cache_key = hashlib.md5(ticket_text.lower().strip().encode('utf-8')).hexdigest()
+        # Проверяем кэш. Ключ - только текст обращения: будут ли категории в промпте
+        # сокращены, зависит от того, готов ли уже embedding, и повтор того же
+        # обращения должен попадать в кэш независимо от этого
+        cache_key = self._cache_prefix + hashlib.md5(ticket_text.lower().strip().encode('utf-8')).hexdigest()
         
-        if cache_key in self.classification_cache:
+        cached = self.classification_cache.get(cache_key)
+        if cached is not None:
             print(f"[CACHE HIT] Классификация взята из кэша (~0.00s)")
-            return self.classification_cache[cache_key].copy()
+            return cached.copy()
         
+        # Кандидатов поиска ждём только здесь: до вызова чат-модели дело дошло
+        categories = self._prompt_categories(candidates)
         start_time = time.time()
         
-        # Формируем строку категорий с подкатегориями
-        categories_info = []
-        for cat in self.categories:
-            if cat in self.category_subcategories and self.category_subcategories[cat]:
-                subcats = ", ".join(self.category_subcategories[cat])
-                categories_info.append(f"{cat} ({subcats})")
-            else:
-                categories_info.append(cat)
-        
-        categories_str = "; ".join(categories_info)
+        # Строка категорий с подкатегориями: только кандидаты поиска или полный список
+        if categories:
+            categories_str = "; ".join(self._category_lines.get(cat, cat) for cat in categories)
+        else:
+            categories_str = self._all_categories
         
-        prompt = f"""Категории: {categories_str}
-Запрос: "{ticket_text}"
-JSON: {{"category": "...", "subcategory": "..." (если применимо), "confidence": "высокая/средняя/низкая", "reasoning": "...", "key_info": {{"main_issue": "...", "urgency": "обычно", "sentiment": "нейтральное", "key_details": []}}}}"""
+        prompt = CLASSIFY_AND_EXTRACT_PROMPT.format(categories=categories_str, ticket_text=ticket_text)
+        prompt_tokens = estimate_tokens(CLASSIFY_AND_EXTRACT_SYSTEM) + estimate_tokens(prompt)
+        full_tokens = prompt_tokens + estimate_tokens(self._all_categories) - estimate_tokens(categories_str)
+        print(f"[PROMPT] Категорий в промпте: {len(categories) if categories else len(self._category_lines)}"
+              f"/{len(self._category_lines)}, ~{prompt_tokens} токенов (с полным списком ~{full_tokens})")
 
         messages = [
-            {"role": "system", "content": "Классификация. JSON only. Всегда возвращай подкатегорию если она подходит."},
+            {"role": "system", "content": CLASSIFY_AND_EXTRACT_SYSTEM},
             {"role": "user", "content": prompt}
         ]
         
@@ -222,16 +387,10 @@ JSON: {{"category": "...", "subcategory": "..." (если применимо), "
                     result = json.loads(json_str)
                     
                     elapsed = time.time() - start_time
-                    print(f"[FAST] classify_and_extract: {elapsed:.2f}s")
-                    
-                    # Сохраняем в кэш
-                    self.classification_cache[cache_key] = result.copy()
+                    print(f"[FAST] classify_and_extract: {elapsed:.2f}s (~{prompt_tokens} токенов промпта)")
                     
-                    # Ограничиваем размер кэша
-                    if len(self.classification_cache) > self.cache_max_size:
-                        # Удаляем самый старый элемент
-                        oldest_key = next(iter(self.classification_cache))
-                        del self.classification_cache[oldest_key]
+                    # Сохраняем в кэш (вытеснение - по LRU и TTL)
+                    self.classification_cache.set(cache_key, result.copy())
                     
                     return result
             except json.JSONDecodeError as e:
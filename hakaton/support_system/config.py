@@ -8,6 +8,35 @@ import os
 SCIBOX_API_KEY = None  # Вводится сотрудником через интерфейс
 SCIBOX_BASE_URL = "https://llm.t1v.scibox.tech/v1"
 
+# HTTP соединения с API: один пул keep-alive соединений на API ключ, общий для всех модулей
+LLM_POOL_MAX_CONNECTIONS = 32  # Максимум одновременных соединений
+LLM_POOL_MAX_KEEPALIVE = 16  # Сколько простаивающих соединений держать открытыми
+LLM_KEEPALIVE_EXPIRY = 60  # Через сколько секунд простоя закрывать соединение
+LLM_REQUEST_TIMEOUT = 60  # Таймаут запроса к API в секундах
+LLM_CONNECT_TIMEOUT = 10  # Таймаут установки соединения в секундах
+
+# Повторы запросов к API (retry_policy.py): экспоненциальная задержка со случайным разбросом (full jitter),
+# Retry-After сервера учитывается. Если повтор не помещается в дедлайн, ошибка возвращается сразу
+LLM_RETRY_MAX_ATTEMPTS = 3  # Всего попыток, включая первую
+LLM_RETRY_BASE_DELAY = 1.0  # Верхняя граница задержки перед первым повтором, секунды (дальше удваивается)
+LLM_RETRY_MAX_DELAY = 10.0  # Максимальная задержка между попытками, секунды
+LLM_RETRY_DEADLINE = 20.0  # Время на запрос к чат-модели вместе с повторами, секунды
+EMBEDDING_RETRY_DEADLINE = 10.0  # То же для embedding запроса пользователя
+EMBEDDING_BATCH_MAX_RETRY_DELAY = 30.0  # Максимальная задержка между попытками чанка в get_embeddings_batch
+
+# Ограничение частоты запросов к API на стороне клиента (rate_limiter.py)
+# Бюджеты в минуту: запросов и токенов (оценка по длине текста); None - без ограничения
+RATE_LIMITS = {
+    "chat": {"requests_per_minute": 120, "tokens_per_minute": 200000},
+    "embeddings": {"requests_per_minute": 600, "tokens_per_minute": 1000000},
+}
+RATE_LIMIT_BURST_SECONDS = 10  # Ёмкость корзин: бюджет за столько секунд
+RATE_LIMIT_MAX_QUEUE = 256  # Максимум запросов в очереди за бюджетом (остальным сразу rate_limit)
+RATE_LIMIT_BACKEND = "memory"  # "sqlite" - общий бюджет для всех воркеров (файл CACHE_SQLITE_PATH)
+
+# Одинаковые одновременные запросы к API (модель, параметры, текст) выполняются один раз (single_flight.py)
+LLM_SINGLE_FLIGHT = True
+
 # Модели
 CHAT_MODEL = "Qwen2.5-72B-Instruct-AWQ"
 EMBEDDING_MODEL = "bge-m3"
@@ -24,6 +53,32 @@ CATEGORIES = [
     "Другое"
 ]
 
+# Массовое создание embeddings (get_embeddings_batch)
+EMBEDDING_CHUNK_SIZE = 64  # Текстов в одном запросе к API
+EMBEDDING_MAX_CONCURRENCY = 4  # Максимум одновременных запросов
+EMBEDDING_CHUNK_RETRIES = 3  # Повторных попыток для каждого чанка
+EMBEDDING_STREAM_BATCH = 4096  # Сколько новых текстов БЗ накапливать перед отправкой в get_embeddings_batch
+# Микро-пакеты get_embedding (embedding_batcher.py): одновременные запросы отправляются одним вызовом API
+EMBEDDING_MICROBATCH_WAIT = 0.005  # Сколько секунд пакет ждёт новых текстов (0 - без пакетов)
+EMBEDDING_MICROBATCH_SIZE = 32  # Максимум текстов в пакете
+
+# Классификация обращений
+# "llm" - чат-модель; "local" - голосование ближайших статей БЗ по embeddings (local_classifier.py);
+# "hybrid" - локальный классификатор, а чат-модель - только при низкой уверенности
+CLASSIFIER_MODE = "llm"
+LOCAL_CLASSIFIER_K = 10  # Сколько ближайших статей голосуют за категорию
+LOCAL_CLASSIFIER_TEMPERATURE = 0.05  # Чем меньше, тем сильнее голос ближайших статей
+LOCAL_CLASSIFIER_MIN_CONFIDENCE = 0.8  # Калиброванная уверенность для ответа без чат-модели в режиме hybrid
+LOCAL_CLASSIFIER_CALIBRATION_SAMPLE = 500  # Статей БЗ для калибровки уверенности (leave-one-out)
+LOCAL_CLASSIFIER_FALLBACK = True  # Классифицировать локально, если чат-модель перегружена (429)
+# В промпт классификации попадают только категории CLASSIFICATION_PROMPT_TOP_N лучших статей поиска
+# (0 - всегда полный список). Если классификации нет в кэше и нужен вызов чат-модели, она ждёт результаты
+# поиска не дольше CLASSIFICATION_PROMPT_WAIT секунд (embedding из кэша готов сразу; запрос embedding к API
+# обычно укладывается в это время), иначе идёт с полным списком параллельно с поиском
+CLASSIFICATION_PROMPT_TOP_N = 10
+CLASSIFICATION_PROMPT_WAIT = 0.3
+CLASSIFICATION_PROMPT_MIN_SIMILARITY = 0.5  # Если лучшая статья похожа меньше - в промпте полный список категорий
+
 # Параметры генерации
 GENERATION_PARAMS = {
     "temperature": 0.3,
@@ -34,6 +89,43 @@ GENERATION_PARAMS = {
 # Параметры поиска
 SEARCH_TOP_K = 3  # Количество наиболее релевантных результатов (увеличено для лучшего охвата)
 SIMILARITY_THRESHOLD = 0.3  # Порог схожести для фильтрации (снижен для большего охвата)
+FILTERED_SEARCH_MIN_SIMILARITY = 0.6  # Ниже этого совпадения с фильтром по категории сравниваем с поиском без фильтра
+SEARCH_BATCH_MAX_QUERIES = 5000  # Максимум запросов в одном вызове /api/search_batch
+SEARCH_BATCH_CHUNK_SIZE = 256  # Запросов в одном матричном умножении при пакетном поиске
+
+# Порядок шагов обработки обращения (process_ticket)
+# "classify_first" - классификация LLM, затем поиск с фильтром по категории;
+# "search_first" - сначала поиск без фильтра: если лучшая статья совпадает не ниже
+# EARLY_EXIT_SIMILARITY, категория, подкатегория и приоритет берутся из неё без вызова LLM
+PIPELINE_MODE = "classify_first"
+EARLY_EXIT_SIMILARITY = 0.85  # Минимальное сходство лучшей статьи для ответа без классификации LLM
+PIPELINE_SEARCH_WORKERS = 8  # Потоков для поиска в БЗ параллельно с классификацией
+
+# Кэши запросов (cache.py): LRU с ограничением по числу записей и размеру в байтах, ttl в секундах
+# CACHE_BACKEND: "memory" - в памяти процесса; "sqlite" - общий файл для всех воркеров; "redis" - Redis-совместимый сервер
+CACHE_BACKEND = "memory"
+CACHE_SQLITE_PATH = "data/cache.sqlite3"
+CACHE_REDIS_URL = "redis://localhost:6379/0"  # Для "redis" нужен пакет redis
+QUERY_EMBEDDING_CACHE = {"max_entries": 10000, "max_bytes": 128 * 2**20, "ttl": 7 * 24 * 3600}
+CLASSIFICATION_CACHE = {"max_entries": 5000, "max_bytes": 16 * 2**20, "ttl": 24 * 3600}
+# Кэш embeddings запросов на диске (data/query_embeddings.*), переживает перезапуск
+QUERY_EMBEDDING_STORE_MAX_ROWS = 50000  # ~4 KB на запрос для bge-m3
+QUERY_EMBEDDING_STORE_COMPACT_KEEP = 0.75  # Доля записей, которая остаётся после сжатия заполненного кэша (самые частые)
+QUERY_CACHE_WARMUP_SIZE = 1000  # Сколько самых частых запросов загружать в кэш при старте
+
+# Приближённый поиск (ANN) для больших баз знаний
+ANN_INDEX = "auto"  # "exact" - точный перебор, "ivf" - IVF индекс, "auto" - IVF начиная с ANN_MIN_ARTICLES
+ANN_MIN_ARTICLES = 20000  # Размер БЗ, начиная с которого "auto" включает IVF
+IVF_NLIST = None  # Количество кластеров IVF (None - 4 * sqrt(число статей))
+IVF_NPROBE = 16  # Сколько ближайших кластеров просматривать: больше - выше полнота, но медленнее
+IVF_TRAIN_ITERATIONS = 10  # Итерации k-means при построении IVF
+IVF_TRAIN_SAMPLE = 65536  # Максимум статей в выборке для обучения k-means
+
+# Хранение матрицы embeddings
+# "memory" - float32 в памяти процесса; "mmap" - float32 файл через memory mapping (общий page cache воркеров);
+# "float16" / "int8" - квантованная матрица через mmap с точным пересчётом лучших кандидатов
+EMBEDDINGS_STORAGE = "memory"
+RESCORE_CANDIDATES = 100  # Сколько кандидатов пересчитывать точно для квантованных хранилищ
 
 # Параметры оптимизации текста
 MAX_QUERY_TOKENS = 512  # Максимальное количество токенов для запроса пользователя
@@ -0,0 +1,94 @@
+"""
+Микро-пакеты запросов embedding
+
+Одновременные get_embedding (например, из параллельных process_ticket)
+собираются в один запрос к API: первый вызов открывает пакет и ждёт
+несколько миллисекунд или пока в пакете не наберётся max_batch текстов,
+затем отправляет весь пакет, а каждый вызов получает свой вектор.
+Отдельного потока нет: запрос выполняет поток, открывший пакет.
+"""
+
+import threading
+import time
+
+from config import EMBEDDING_MICROBATCH_SIZE, EMBEDDING_MICROBATCH_WAIT
+
+
+class _Batch:
+    __slots__ = ('texts', 'vectors', 'error', 'done')
+
+    def __init__(self):
+        self.texts = []
+        self.vectors = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class EmbeddingBatcher:
+    """
+    Собирает одновременные запросы embedding в пакеты
+
+    Args:
+        embed_many: Функция texts -> список векторов (исключение - ошибка всего пакета)
+        max_batch: Максимум текстов в пакете
+        max_wait: Сколько секунд пакет ждёт новых текстов
+    """
+
+    def __init__(self, embed_many, max_batch=EMBEDDING_MICROBATCH_SIZE, max_wait=EMBEDDING_MICROBATCH_WAIT):
+        self.embed_many = embed_many
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._open = None  # Пакет, в который добавляются новые тексты
+        self._stats = {'texts': 0, 'batches': 0}
+
+    def embed(self, text):
+        """
+        Вектор текста, полученный в составе пакета
+
+        Raises:
+            Exception: Ошибка запроса пакета (одна для всех его текстов)
+        """
+        with self._cond:
+            batch = self._open
+            leader = batch is None
+            if leader:
+                batch = self._open = _Batch()
+            index = len(batch.texts)
+            batch.texts.append(text)
+
+            if len(batch.texts) >= self.max_batch:
+                # Пакет заполнен: следующий вызов откроет новый
+                self._open = None
+                self._cond.notify_all()
+
+            if leader:
+                deadline = time.monotonic() + self.max_wait
+                while self._open is batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._open = None
+                        break
+                    self._cond.wait(remaining)
+                self._stats['texts'] += len(batch.texts)
+                self._stats['batches'] += 1
+
+        if leader:
+            try:
+                batch.vectors = self.embed_many(batch.texts)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.vectors[index]
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+        stats['avg_batch'] = round(stats['texts'] / stats['batches'], 2) if stats['batches'] else 0
+        return stats
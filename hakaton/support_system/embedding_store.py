@@ -0,0 +1,581 @@
+"""
+Хранилища нормализованных embeddings для поиска по базе знаний
+
+Матрица может храниться в памяти процесса (float32) или на диске с
+memory mapping: тогда несколько воркеров разделяют один page cache.
+Квантованные варианты (float16, int8 со своим масштабом на каждое
+измерение) дают приближённое сходство, а лучшие кандидаты затем
+пересчитываются точно по float32 матрице на диске.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+
+def normalize_rows(vectors):
+    """L2-нормализация строк в float32 (нулевые строки остаются нулевыми)"""
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+
+class EmbeddingStore:
+    """
+    Нормализованная float32 матрица embeddings (в памяти или через mmap)
+
+    Атрибут matrix всегда даёт точные float32 векторы статей.
+    """
+
+    kind = 'memory'
+    approximate = False  # True - dot() возвращает приближённое сходство
+    block_size = 16384  # Строк в одном блоке при пересчёте квантованных значений
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def nbytes(self):
+        """Объём матрицы, по которой идёт перебор"""
+        return self.matrix.nbytes
+
+    def dot(self, query_vec, rows=None):
+        """Сходство запроса со всеми статьями или только со строками rows"""
+        if rows is None:
+            return self.matrix @ query_vec
+        return self.matrix[rows] @ query_vec
+
+    def dot_batch(self, query_vecs):
+        """Сходство нескольких запросов со всеми статьями (запросы x статьи)"""
+        return query_vecs @ self.matrix.T
+
+
+class MmapStore(EmbeddingStore):
+    """float32 матрица, открытая через memory mapping"""
+
+    kind = 'mmap'
+
+
+class QuantizedStore(EmbeddingStore):
+    """
+    Базовый класс квантованного хранилища
+
+    values - квантованная матрица для перебора, matrix - точная float32
+    матрица (mmap) для пересчёта кандидатов.
+    """
+
+    approximate = True
+
+    def __init__(self, matrix, values):
+        super().__init__(matrix)
+        self.values = values
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def _query_weights(self, query_vecs):
+        return query_vecs
+
+    def dot(self, query_vec, rows=None):
+        weights = self._query_weights(query_vec)
+        if rows is not None:
+            return self.values[rows].astype(np.float32) @ weights
+
+        # Приводим к float32 блоками, чтобы не создавать копию всей матрицы
+        scores = np.empty(len(self.values), dtype=np.float32)
+        for start in range(0, len(self.values), self.block_size):
+            block = self.values[start:start + self.block_size]
+            scores[start:start + len(block)] = block.astype(np.float32) @ weights
+        return scores
+
+    def dot_batch(self, query_vecs):
+        weights = self._query_weights(query_vecs)
+        scores = np.empty((len(query_vecs), len(self.values)), dtype=np.float32)
+        for start in range(0, len(self.values), self.block_size):
+            block = self.values[start:start + self.block_size]
+            scores[:, start:start + len(block)] = weights @ block.astype(np.float32).T
+        return scores
+
+
+class Float16Store(QuantizedStore):
+    """Матрица в float16: в 2 раза меньше float32"""
+
+    kind = 'float16'
+
+
+class Int8Store(QuantizedStore):
+    """
+    Скалярное квантование в int8 с масштабом на каждое измерение: в 4 раза меньше float32
+
+    x[i, d] ≈ values[i, d] * scale[d], поэтому сходство с запросом q -
+    это values @ (q * scale).
+    """
+
+    kind = 'int8'
+
+    def __init__(self, matrix, values, scale):
+        super().__init__(matrix, values)
+        self.scale = np.asarray(scale, dtype=np.float32)
+
+    def _query_weights(self, query_vecs):
+        return query_vecs * self.scale
+
+
+class DiskStoreFiles:
+    """
+    Файлы хранилища embeddings рядом с кэшем
+
+    Рядом с base_path хранятся .f32.npy, .f16.npy, .i8.npy, .i8_scale.npy
+    и .json с отпечатком исходных embeddings. Файлы пересоздаются, когда
+    отпечаток не совпадает.
+    """
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.meta_file = f"{base_path}.json"
+
+    def path(self, suffix):
+        return f"{self.base_path}.{suffix}.npy"
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def is_valid(self, fingerprint, kind):
+        meta = self._read_meta()
+        return meta.get('fingerprint') == fingerprint and kind in meta.get('kinds', [])
+
+    def write(self, embeddings, fingerprint, kind, block_size=EmbeddingStore.block_size):
+        """Нормализует embeddings блоками и записывает файлы для указанного вида хранилища"""
+        n_rows, dim = embeddings.shape
+
+        # Точная float32 матрица нужна всем видам (для пересчёта кандидатов)
+        f32_path = self.path('f32')
+        tmp_path = f"{f32_path}.{os.getpid()}.tmp.npy"
+        matrix = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(n_rows, dim))
+        for start in range(0, n_rows, block_size):
+            matrix[start:start + block_size] = normalize_rows(embeddings[start:start + block_size])
+        matrix.flush()
+        del matrix
+        os.replace(tmp_path, f32_path)
+
+        matrix = np.load(f32_path, mmap_mode='r')
+
+        if kind == 'float16':
+            self._save_array(self.path('f16'), matrix.astype(np.float16))
+        elif kind == 'int8':
+            scale = np.zeros(dim, dtype=np.float32)
+            for start in range(0, n_rows, block_size):
+                scale = np.maximum(scale, np.abs(matrix[start:start + block_size]).max(axis=0))
+            scale = scale / 127.0
+            scale[scale == 0] = 1.0
+
+            tmp_path = f"{self.path('i8')}.{os.getpid()}.tmp.npy"
+            values = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.int8, shape=(n_rows, dim))
+            for start in range(0, n_rows, block_size):
+                block = np.rint(matrix[start:start + block_size] / scale)
+                values[start:start + block_size] = np.clip(block, -127, 127)
+            values.flush()
+            del values
+            os.replace(tmp_path, self.path('i8'))
+            self._save_array(self.path('i8_scale'), scale)
+
+        kinds = {'mmap', kind}
+        meta = self._read_meta()
+        if meta.get('fingerprint') == fingerprint:
+            kinds.update(meta.get('kinds', []))
+
+        tmp_meta = f"{self.meta_file}.{os.getpid()}.tmp"
+        with open(tmp_meta, 'w', encoding='utf-8') as f:
+            json.dump({'fingerprint': fingerprint, 'shape': [n_rows, dim], 'kinds': sorted(kinds)}, f)
+        os.replace(tmp_meta, self.meta_file)
+
+    @staticmethod
+    def _save_array(path, array):
+        tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+
+    def open(self, kind):
+        """Открывает хранилище через memory mapping"""
+        matrix = np.load(self.path('f32'), mmap_mode='r')
+        if kind == 'float16':
+            return Float16Store(matrix, np.load(self.path('f16'), mmap_mode='r'))
+        if kind == 'int8':
+            return Int8Store(matrix, np.load(self.path('i8'), mmap_mode='r'), np.load(self.path('i8_scale')))
+        return MmapStore(matrix)
+
+
+def open_embedding_store(embeddings, kind='memory', base_path=None, fingerprint=None):
+    """
+    Создаёт хранилище embeddings нужного вида
+
+    Args:
+        embeddings: Исходные (ненормализованные) embeddings, можно через mmap
+        kind: 'memory', 'mmap', 'float16' или 'int8'
+        base_path: Путь без расширения для файлов на диске (для всех видов, кроме 'memory')
+        fingerprint: Отпечаток embeddings для проверки актуальности файлов
+
+    Returns:
+        EmbeddingStore
+    """
+    if kind == 'memory':
+        return EmbeddingStore(normalize_rows(embeddings))
+
+    if kind not in ('mmap', 'float16', 'int8'):
+        raise ValueError(f"Неизвестный вид хранилища embeddings: {kind}")
+
+    files = DiskStoreFiles(base_path)
+    if not files.is_valid(fingerprint, kind):
+        print(f"[INFO] Подготовка хранилища embeddings ({kind})...")
+        files.write(embeddings, fingerprint, kind)
+
+    return files.open(kind)
+
+
+class EmbeddingCache:
+    """
+    Кэш embeddings статей с манифестом хэшей содержимого
+
+    Строка i в cache_file - embedding текста с хэшем hashes[i] из манифеста.
+    Хэш учитывает модель embeddings, поэтому смена модели или текста статьи
+    делает соответствующую строку недействительной.
+    """
+
+    def __init__(self, cache_file, manifest_file, model):
+        self.cache_file = cache_file
+        self.manifest_file = manifest_file
+        self.model = model
+
+    def text_hash(self, text):
+        """Хэш текста статьи для указанной модели"""
+        return hashlib.sha1(f"{self.model}\0{text}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def fingerprint(hashes):
+        """Отпечаток всего набора embeddings (для проверки производных файлов индекса)"""
+        return hashlib.sha1("\n".join(hashes).encode('utf-8')).hexdigest()
+
+    def load(self, mmap_mode=None):
+        """
+        Загружает кэш и манифест
+
+        Returns:
+            tuple: (матрица или None, список хэшей строк или None, если манифеста нет)
+        """
+        if not os.path.exists(self.cache_file):
+            return None, None
+
+        matrix = np.load(self.cache_file, mmap_mode=mmap_mode)
+
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return matrix, None
+
+        hashes = manifest.get('hashes', [])
+        if manifest.get('model') != self.model or len(hashes) != len(matrix):
+            return matrix, []
+        return matrix, hashes
+
+    def save_manifest(self, hashes, dim):
+        tmp_path = f"{self.manifest_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'model': self.model, 'dim': dim, 'hashes': hashes}, f)
+        os.replace(tmp_path, self.manifest_file)
+
+    def create_matrix(self, n_rows, dim):
+        """Создаёт новый файл кэша через mmap; вызовите commit() после заполнения"""
+        tmp_path = f"{self.cache_file}.{os.getpid()}.tmp.npy"
+        return np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(n_rows, dim))
+
+    def commit(self, matrix, hashes):
+        """Атомарно заменяет кэш заполненной матрицей и записывает манифест"""
+        matrix.flush()
+        tmp_path = matrix.filename
+        dim = matrix.shape[1]
+        del matrix
+        os.replace(tmp_path, self.cache_file)
+        self.save_manifest(hashes, dim)
+
+
+class QueryEmbeddingStore:
+    """
+    Постоянный кэш embeddings запросов на диске, общий для воркеров
+    
+    Векторы дописываются в файл .bin записями фиксированной длины: ключ
+    (hex md5 модели и нормализованного текста запроса) и float32 вектор.
+    Индекс ключ -> запись строится при открытии по колонке ключей (через mmap)
+    и дочитывается, когда файл вырос из-за записей других воркеров. Число
+    обращений к записи хранится в файле .hits (uint32 на запись) и нужно для
+    прогрева кэша самыми частыми запросами.
+    
+    Когда записей становится max_rows, файлы переписываются: остаётся доля
+    compact_keep самых частых записей (при равенстве - более новые), а их
+    счётчики делятся пополам, чтобы давние популярные запросы постепенно
+    уступали новым. Воркеры замечают замену файла и перестраивают индекс;
+    запись другого воркера, попавшая в старый файл во время замены, теряется
+    (это кэш).
+    """
+    
+    KEY_SIZE = 32  # hex md5: без нулевых байт, которые numpy отбрасывает в конце bytes
+    HITS_FLUSH_EVERY = 64  # Сколько обращений накапливать перед записью счётчиков
+    
+    def __init__(self, base_path, model, max_rows=None, compact_keep=0.75):
+        self.base_path = base_path
+        self.model = model
+        self.max_rows = max_rows
+        self.compact_keep = compact_keep
+        self.data_file = f"{base_path}.bin"
+        self.hits_file = f"{base_path}.hits"
+        self.meta_file = f"{base_path}.json"
+        
+        self._lock = threading.RLock()
+        self._rows = {}  # ключ -> номер записи
+        self._hits = np.zeros(0, dtype=np.uint32)
+        self._pending_hits = {}  # номер записи -> обращения, ещё не записанные на диск
+        self._records = None  # mmap записей
+        self._indexed_bytes = 0
+        self._file_id = None  # (st_dev, st_ino) проиндексированного файла: меняется при сжатии
+        self._full_warned = False
+        
+        self.dim = self._read_meta()
+        if self.dim is not None:
+            self._refresh()
+    
+    @staticmethod
+    def normalize(text):
+        """Нормализация текста запроса для ключа: регистр и пробелы"""
+        return ' '.join(str(text).lower().split())
+    
+    def key(self, text):
+        """Ключ записи (bytes)"""
+        return hashlib.md5(f"{self.model}\0{self.normalize(text)}".encode('utf-8')).hexdigest().encode('ascii')
+    
+    def __len__(self):
+        return len(self._rows)
+    
+    def _read_meta(self):
+        try:
+            with open(self.meta_file, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('model') != self.model:
+            # Векторы другой модели не подходят: начинаем кэш заново
+            for path in (self.data_file, self.hits_file, self.meta_file):
+                if os.path.exists(path):
+                    os.remove(path)
+            return None
+        return int(meta['dim'])
+    
+    def _record_dtype(self):
+        return np.dtype([('key', f'S{self.KEY_SIZE}'), ('vector', '<f4', (self.dim,))])
+    
+    def _refresh(self):
+        """Дочитывает записи, добавленные после последнего обращения (в том числе другими воркерами)"""
+        if self.dim is None:
+            # Кэш мог создать другой воркер после открытия этого
+            self.dim = self._read_meta()
+        if self.dim is None or not os.path.exists(self.data_file):
+            return
+        stat = os.stat(self.data_file)
+        file_id = (stat.st_dev, stat.st_ino)
+        if file_id != self._file_id:
+            # Файл заменён при сжатии (этим или другим воркером): номера записей изменились
+            if self._file_id is not None:
+                self._reset_index()
+            self._file_id = file_id
+        record_size = self._record_dtype().itemsize
+        # Недописанную при сбое последнюю запись не читаем
+        size = os.path.getsize(self.data_file) // record_size * record_size
+        if size <= self._indexed_bytes:
+            return
+        
+        self._records = np.memmap(self.data_file, dtype=self._record_dtype(), mode='r', shape=(size // record_size,))
+        start = self._indexed_bytes // record_size
+        for row, key in enumerate(self._records['key'][start:].tolist(), start):
+            self._rows[key] = row
+        self._indexed_bytes = size
+        
+        hits = np.zeros(len(self._records), dtype=np.uint32)
+        if os.path.exists(self.hits_file):
+            saved = np.fromfile(self.hits_file, dtype=np.uint32)[:len(hits)]
+            hits[:len(saved)] = saved
+        self._hits = hits
+    
+    def get(self, text):
+        """Вектор запроса (float32) или None"""
+        return self.get_many([text])[0]
+    
+    def get_many(self, texts):
+        keys = [self.key(text) for text in texts]
+        with self._lock:
+            if any(key not in self._rows for key in keys):
+                self._refresh()
+            rows = [self._rows.get(key) for key in keys]
+            result = [np.array(self._records['vector'][row]) if row is not None else None for row in rows]
+            for row in rows:
+                if row is not None:
+                    self._touch(row)
+        return result
+    
+    def contains(self, text):
+        """Есть ли запрос в кэше (без учёта обращения)"""
+        key = self.key(text)
+        with self._lock:
+            if key not in self._rows:
+                self._refresh()
+            return key in self._rows
+    
+    def touch(self, key):
+        """Учитывает обращение к записи, найденной в кэше в памяти"""
+        with self._lock:
+            row = self._rows.get(key)
+            if row is not None:
+                self._touch(row)
+    
+    def put(self, text, vector):
+        self.put_many([(text, vector)])
+    
+    def put_many(self, items):
+        """Дописывает векторы запросов, которых ещё нет в кэше"""
+        with self._lock:
+            self._refresh()
+            if self.dim is None:
+                for _, vector in items:
+                    self._create(len(vector))
+                    break
+            
+            records = []
+            seen = set()
+            for text, vector in items:
+                key = self.key(text)
+                if key in self._rows or key in seen or len(vector) != self.dim:
+                    continue
+                seen.add(key)
+                records.append((key, np.asarray(vector, dtype=np.float32)))
+            
+            if self.max_rows is not None:
+                if len(self._rows) + len(records) > self.max_rows:
+                    self._compact()
+                free = max(self.max_rows - len(self._rows), 0)
+                records = records[:free]
+            if not records:
+                return
+            
+            data = np.array(records, dtype=self._record_dtype()).tobytes()
+            # O_APPEND: записи нескольких воркеров не перекрываются
+            fd = os.open(self.data_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            self._refresh()
+    
+    def _reset_index(self):
+        self._rows = {}
+        self._records = None
+        self._hits = np.zeros(0, dtype=np.uint32)
+        self._pending_hits = {}  # Номера записей старого файла больше не действительны
+        self._indexed_bytes = 0
+    
+    def _compact(self):
+        """Переписывает файлы, оставляя compact_keep * max_rows самых частых записей (вызывается под _lock)"""
+        self.flush_hits()
+        if self._records is None:
+            return
+        keep = int(self.max_rows * self.compact_keep)
+        rows = np.fromiter(self._rows.values(), dtype=np.int64)
+        # По убыванию обращений, при равенстве - более новые записи
+        order = np.lexsort((-rows, -self._hits[rows].astype(np.int64)))
+        kept = np.sort(rows[order[:keep]])
+        records = np.array(self._records[kept])
+        hits = self._hits[kept] // 2
+        
+        tmp_data = f"{self.data_file}.{os.getpid()}.tmp"
+        tmp_hits = f"{self.hits_file}.{os.getpid()}.tmp"
+        try:
+            records.tofile(tmp_data)
+            hits.tofile(tmp_hits)
+            # Отпускаем mmap старого файла: под Windows открытый файл нельзя заменить
+            self._reset_index()
+            os.replace(tmp_data, self.data_file)
+            os.replace(tmp_hits, self.hits_file)
+        except OSError as e:
+            for path in (tmp_data, tmp_hits):
+                if os.path.exists(path):
+                    os.remove(path)
+            if not self._full_warned:
+                print(f"[WARNING] Не удалось сжать кэш embeddings запросов ({e}), новые запросы не сохраняются")
+                self._full_warned = True
+            self._refresh()
+            return
+        
+        self._refresh()
+        print(f"[CACHE] Кэш embeddings запросов сжат: {len(rows)} → {len(self._rows)} записей (оставлены самые частые)")
+    
+    def _create(self, dim):
+        self.dim = dim
+        tmp_path = f"{self.meta_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'model': self.model, 'dim': dim}, f)
+        os.replace(tmp_path, self.meta_file)
+    
+    def _touch(self, row):
+        self._pending_hits[row] = self._pending_hits.get(row, 0) + 1
+        if len(self._pending_hits) >= self.HITS_FLUSH_EVERY:
+            self.flush_hits()
+    
+    def flush_hits(self):
+        """Записывает накопленные счётчики обращений (гонки между воркерами допустимы: это статистика)"""
+        with self._lock:
+            if not self._pending_hits:
+                return
+            # Если файл заменили при сжатии, накопленные номера записей устарели и сбрасываются
+            self._refresh()
+            if not self._pending_hits:
+                return
+            pending, self._pending_hits = self._pending_hits, {}
+            mode = 'r+b' if os.path.exists(self.hits_file) else 'w+b'
+            with open(self.hits_file, mode) as f:
+                for row, count in sorted(pending.items()):
+                    if row >= len(self._hits):
+                        continue
+                    self._hits[row] = min(int(self._hits[row]) + count, np.iinfo(np.uint32).max)
+                    f.seek(row * 4)
+                    f.write(self._hits[row:row + 1].tobytes())
+    
+    def most_frequent(self, limit):
+        """
+        Самые частые запросы кэша
+        
+        Returns:
+            list: [(ключ, вектор)] по убыванию числа обращений
+        """
+        with self._lock:
+            self._refresh()
+            if not self._rows or limit <= 0:
+                return []
+            rows = np.fromiter(self._rows.values(), dtype=np.int64)
+            hits = self._hits[rows]
+            if len(rows) > limit:
+                part = np.argpartition(-hits.astype(np.int64), limit - 1)[:limit]
+                rows, hits = rows[part], hits[part]
+            rows = rows[np.argsort(-hits.astype(np.int64), kind='stable')]
+            return [(bytes(self._records['key'][row]), np.array(self._records['vector'][row])) for row in rows]
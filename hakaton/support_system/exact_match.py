@@ -0,0 +1,106 @@
+"""
+Индекс точных совпадений обращения с вопросами базы знаний
+
+Многие обращения почти дословно повторяют example_question статьи. Для
+них не нужны ни embedding, ни классификация LLM: ответ берётся прямо из
+статьи. Вопросы сравниваются после свёртки регистра, пробелов и
+пунктуации, а также в том виде, который даёт AnglicismNormalizer (так же
+обрабатывается обращение в process_ticket). Вид после TextExtractor не
+используется: он отбрасывает часть предложений, и обращение с
+дополнительным текстом совпало бы с вопросом статьи.
+"""
+
+import re
+
+_NON_WORD = re.compile(r'[^\w\s]+')
+
+
+def fold_text(text):
+    """Свёртка текста для точного сравнения: регистр, ё/е, пунктуация и пробелы"""
+    text = str(text).lower().replace('ё', 'е')
+    return ' '.join(_NON_WORD.sub(' ', text).split())
+
+
+def question_variants(question):
+    """Ключи вопроса: сам вопрос и его вид после нормализации англицизмов"""
+    from anglicism_normalizer import get_normalizer
+
+    normalized = get_normalizer().normalize(question)
+    keys = {fold_text(question), fold_text(normalized)}
+    keys.discard('')
+    return keys
+
+
+class ExactMatchIndex:
+    """
+    Свёрнутый текст вопроса -> строка статьи
+
+    Если один ключ дают вопросы разных статей, совпадение неоднозначно и
+    индекс его не возвращает. Индекс неизменяемый: изменения статей
+    создают новый экземпляр (см. with_changes).
+    """
+
+    def __init__(self, rows_by_key=None):
+        self._rows = rows_by_key or {}  # ключ -> строка или tuple строк (неоднозначный ключ)
+
+    @staticmethod
+    def _question(article):
+        return article.get('example_question', article.get('problem', ''))
+
+    @classmethod
+    def build(cls, articles, rows=None):
+        """
+        Args:
+            articles: Хранилище статей (индексируется по номеру строки)
+            rows: Номера строк актуальных статей (None - все)
+        """
+        index = cls()
+        for row in (range(len(articles)) if rows is None else rows):
+            index._add(int(row), cls._question(articles[int(row)]))
+        return index
+
+    def _add(self, row, question):
+        for key in question_variants(question):
+            current = self._rows.get(key)
+            if current is None:
+                self._rows[key] = row
+            elif isinstance(current, tuple):
+                self._rows[key] = current + (row,)
+            elif current != row:
+                self._rows[key] = (current, row)
+
+    def _remove(self, row, question):
+        for key in question_variants(question):
+            current = self._rows.get(key)
+            if current == row:
+                del self._rows[key]
+            elif isinstance(current, tuple) and row in current:
+                rest = tuple(r for r in current if r != row)
+                self._rows[key] = rest[0] if len(rest) == 1 else rest
+
+    def with_changes(self, articles, removed_rows=(), added_rows=()):
+        """Новый индекс без статей removed_rows и со статьями added_rows"""
+        index = ExactMatchIndex(dict(self._rows))
+        for row in removed_rows:
+            index._remove(row, self._question(articles[row]))
+        for row in added_rows:
+            index._add(row, self._question(articles[row]))
+        return index
+
+    def __len__(self):
+        return len(self._rows)
+
+    def lookup(self, *texts):
+        """
+        Строка статьи, вопрос которой совпадает с одним из текстов
+
+        Returns:
+            int или None (нет совпадения или оно неоднозначно)
+        """
+        for text in texts:
+            if not text:
+                continue
+            row = self._rows.get(fold_text(text))
+            if row is not None:
+                return row if not isinstance(row, tuple) else None
+        return None
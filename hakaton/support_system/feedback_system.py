@@ -5,6 +5,7 @@
 
 import json
 import os
+from collections import Counter
 from datetime import datetime
 from typing import Dict, List, Tuple
 
@@ -159,6 +160,12 @@ class FeedbackSystem:
         
         return search_results
     
+    def frequent_queries(self, limit: int = 1000) -> List[Tuple[str, int]]:
+        """Запросы из истории feedback с числом повторов, по убыванию частоты"""
+        counts = Counter(' '.join(item.get('query', '').split()) for item in self.stats['history'])
+        counts.pop('', None)
+        return counts.most_common(limit)
+    
     def get_statistics(self) -> Dict:
         """Получение общей статистики"""
         total_templates = len(self.stats['templates'])
@@ -0,0 +1,86 @@
+"""
+Журнал изменений базы знаний, сделанных через API
+
+Добавленные, изменённые и удалённые статьи записываются построчно в JSONL.
+При загрузке БЗ журнал применяется поверх исходных файлов, поэтому правки
+сохраняются после перезапуска. Чтобы перенести правки в файл БЗ, обновите
+файл и удалите журнал.
+"""
+
+import json
+import os
+import time
+
+from article_store import ArticleStore
+
+
+class KBJournal:
+    """Журнал операций над статьями: add / update / delete"""
+
+    OPERATIONS = ('add', 'update', 'delete')
+
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+
+    def append(self, op, article_id, article=None):
+        """Дописывает операцию в журнал (с fsync, чтобы правка не потерялась при сбое)"""
+        if op not in self.OPERATIONS:
+            raise ValueError(f"Неизвестная операция журнала: {op}")
+
+        entry = {'op': op, 'id': article_id, 'time': time.time()}
+        if article is not None:
+            entry['article'] = dict(article)
+
+        with open(self.journal_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self):
+        """Операции журнала по порядку (повреждённые строки пропускаются)"""
+        if not os.path.exists(self.journal_file):
+            return
+
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    print(f"[WARNING] Журнал БЗ, строка {line_number}: некорректный JSON")
+                    continue
+                if entry.get('op') in self.OPERATIONS:
+                    yield entry
+
+    def replay(self, articles):
+        """
+        Применяет журнал к статьям, загруженным из файлов БЗ
+
+        Изменение несуществующей статьи добавляет её, удаление несуществующей игнорируется.
+
+        Returns:
+            ArticleStore с применёнными изменениями или None, если журнал пуст
+        """
+        entries = list(self.read())
+        if not entries:
+            return None
+
+        merged = [article.to_dict() for article in articles]
+        row_by_id = {article['id']: row for row, article in enumerate(merged)}
+
+        for entry in entries:
+            row = row_by_id.get(entry['id'])
+            if entry['op'] == 'delete':
+                if row is not None:
+                    merged[row] = None
+                    del row_by_id[entry['id']]
+            elif row is not None:
+                merged[row] = entry['article']
+            else:
+                row_by_id[entry['id']] = len(merged)
+                merged.append(entry['article'])
+
+        print(f"[OK] Применено {len(entries)} изменений БЗ из журнала")
+        return ArticleStore.from_dicts(article for article in merged if article is not None)
@@ -0,0 +1,263 @@
+"""
+Потоковая загрузка статей базы знаний из XLSX, CSV, JSONL и JSON
+
+Строки читаются лениво (openpyxl в режиме read-only, csv и JSONL построчно)
+и проверяются по одной, поэтому в памяти не держится весь файл или
+DataFrame. Несколько файлов и листов объединяются в одну базу знаний.
+"""
+
+import csv
+import json
+import os
+import warnings
+
+# Подавляем warning от openpyxl о Data Validation
+warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
+
+# Поле статьи -> допустимые названия столбцов (в нижнем регистре)
+COLUMN_ALIASES = {
+    'id': ('id',),
+    'main_category': ('main_category', 'основная категория', 'category'),
+    'subcategory': ('subcategory', 'подкатегория'),
+    'example_question': ('example_question', 'пример вопроса', 'problem'),
+    'priority': ('priority', 'приоритет'),
+    'target_audience': ('target_audience', 'целевая аудитория'),
+    'template_answer': ('template_answer', 'шаблонный ответ', 'solution'),
+}
+_ALIAS_FIELDS = {alias: field for field, aliases in COLUMN_ALIASES.items() for alias in aliases}
+DEFAULTS = {'main_category': 'Другое', 'subcategory': '', 'priority': 'Средний', 'target_audience': 'Все'}
+
+
+class RowError(ValueError):
+    """Строка источника не прошла проверку"""
+
+
+def _header_map(header):
+    """Номер столбца -> поле статьи по строке заголовков"""
+    mapping = {}
+    for position, name in enumerate(header):
+        field = _ALIAS_FIELDS.get(str(name).strip().lower() if name is not None else '')
+        if field and field not in mapping.values():
+            mapping[position] = field
+    return mapping
+
+
+def _clean(value):
+    if value is None:
+        return None
+    if isinstance(value, float) and value != value:  # NaN
+        return None
+    # Текст не обрезаем: от него зависит хэш статьи в кэше embeddings
+    value = str(value)
+    return value if value.strip() else None
+
+
+def normalize_row(raw, default_id):
+    """
+    Проверяет строку источника и приводит её к полям статьи
+
+    Args:
+        raw: dict поле -> значение (поля уже приведены к названиям статьи)
+        default_id: id, если в строке его нет
+
+    Raises:
+        RowError: если нет ни вопроса, ни ответа или id не число
+    """
+    article = {}
+    for field in COLUMN_ALIASES:
+        value = _clean(raw.get(field))
+        if field == 'id':
+            if value is None:
+                value = default_id
+            else:
+                try:
+                    value = int(float(value.strip()))
+                except ValueError:
+                    raise RowError(f"некорректный id: {value!r}") from None
+        elif value is None:
+            value = DEFAULTS.get(field, '')
+        article[field] = value
+
+    if not article['example_question'] and not article['template_answer']:
+        raise RowError("нет ни вопроса, ни шаблонного ответа")
+    return article
+
+
+def _rows_from_table(rows):
+    """Строки таблицы (первая - заголовок) -> dict поле -> значение"""
+    rows = iter(rows)
+    for header in rows:
+        mapping = _header_map(header)
+        break
+    else:
+        return
+
+    if 'example_question' not in mapping.values() and 'template_answer' not in mapping.values():
+        return  # Лист без столбцов статей (например, справочный)
+
+    for row in rows:
+        if row is None or all(cell is None or cell == '' for cell in row):
+            continue
+        yield {field: row[position] for position, field in mapping.items() if position < len(row)}
+
+
+def iter_xlsx_rows(path, sheet=None):
+    """Строки всех листов (или одного листа sheet) книги Excel в режиме read-only"""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheets = [workbook[sheet]] if sheet else workbook.worksheets
+        for worksheet in sheets:
+            yield from _rows_from_table(worksheet.iter_rows(values_only=True))
+    finally:
+        workbook.close()
+
+
+def iter_csv_rows(path):
+    """Строки CSV файла (разделитель определяется автоматически)"""
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        sample = f.read(64 * 1024)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        yield from _rows_from_table(csv.reader(f, dialect))
+
+
+def map_columns(item):
+    """Ключи объекта (поля статьи или названия столбцов) -> поля статьи; нестандартные ключи сохраняются как есть"""
+    row = {}
+    extra = {}
+    for key, value in item.items():
+        field = _ALIAS_FIELDS.get(str(key).strip().lower())
+        if field is None:
+            extra[key] = value
+        elif field not in row:
+            row[field] = value
+    for key, value in extra.items():
+        row.setdefault(key, value)
+    return row
+
+
+def _rows_from_dicts(items):
+    """Объекты JSON -> dict поле -> значение"""
+    for item in items:
+        # Не-объекты пропускаем как есть: ошибка будет отмечена при проверке
+        yield map_columns(item) if isinstance(item, dict) else item
+
+
+def iter_jsonl_rows(path):
+    """Строки JSONL файла (одна статья в строке)"""
+    def items():
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield RowError(f"строка {line_number}: некорректный JSON ({e})")
+    yield from _rows_from_dicts(items())
+
+
+def iter_json_rows(path):
+    """Статьи из JSON массива (формат целиком читается в память)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    yield from _rows_from_dicts(data if isinstance(data, list) else [data])
+
+
+def normalize_article(item, default_id):
+    """
+    Проверяет статью из dict (ключи - поля статьи или названия столбцов)
+
+    Raises:
+        RowError: если статья не прошла проверку
+    """
+    if not isinstance(item, dict):
+        raise RowError("ожидался объект статьи")
+    raw = map_columns(item)
+    article = normalize_row(raw, default_id)
+    for key, value in raw.items():
+        article.setdefault(key, value)
+    return article
+
+
+def split_source(source):
+    """'file.xlsx#Лист' -> ('file.xlsx', 'Лист')"""
+    path, _, sheet = source.partition('#')
+    return path, (sheet or None)
+
+
+def iter_source_rows(source):
+    path, sheet = split_source(source)
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.xlsx':
+        return iter_xlsx_rows(path, sheet)
+    if extension == '.csv':
+        return iter_csv_rows(path)
+    if extension == '.jsonl':
+        return iter_jsonl_rows(path)
+    if extension == '.json':
+        return iter_json_rows(path)
+    raise ValueError(f"Неподдерживаемый формат файла: {path}")
+
+
+def iter_articles(sources, stats=None, max_logged_errors=10):
+    """
+    Лениво читает и проверяет статьи из нескольких источников
+
+    id статей должны быть уникальны во всей БЗ (по ним работают /api/articles
+    и журнал изменений). Если id уже встречался (например, два файла нумеруют
+    строки с 1), статья получает следующий свободный id, а в лог пишется
+    предупреждение. Нумерация зависит только от источников и их порядка,
+    поэтому при каждой загрузке одинакова.
+
+    Args:
+        sources: Пути к файлам (для XLSX можно указать лист: 'file.xlsx#Лист')
+        stats: dict для статистики {'loaded': int, 'skipped': int, 'renumbered': int} (опционально)
+
+    Yields:
+        dict: Статья с полями id, main_category, subcategory, example_question,
+              priority, target_audience, template_answer (и нестандартными полями JSON)
+    """
+    stats = stats if stats is not None else {}
+    stats.setdefault('loaded', 0)
+    stats.setdefault('skipped', 0)
+    stats.setdefault('renumbered', 0)
+    seen_ids = set()
+    max_id = 0
+
+    for source in sources:
+        for row_number, raw in enumerate(iter_source_rows(source), 1):
+            try:
+                if isinstance(raw, RowError):
+                    raise raw
+                if not isinstance(raw, dict):
+                    raise RowError("ожидался объект статьи")
+                article = normalize_row(raw, default_id=stats['loaded'] + 1)
+            except RowError as e:
+                stats['skipped'] += 1
+                if stats['skipped'] <= max_logged_errors:
+                    print(f"[WARNING] {os.path.basename(source)}, запись {row_number}: {e}")
+                continue
+
+            for key, value in raw.items():
+                if key not in article:
+                    article[key] = value
+
+            if article['id'] in seen_ids:
+                new_id = max_id + 1
+                stats['renumbered'] += 1
+                if stats['renumbered'] <= max_logged_errors:
+                    print(f"[WARNING] {os.path.basename(source)}, запись {row_number}: "
+                          f"id {article['id']} уже есть в БЗ, статье присвоен id {new_id}")
+                article['id'] = new_id
+            seen_ids.add(article['id'])
+            max_id = max(max_id, article['id'])
+
+            stats['loaded'] += 1
+            yield article
@@ -0,0 +1,146 @@
+"""
+Бинарный снимок базы знаний для быстрого старта
+
+После первого разбора XLSX/JSON статьи сохраняются в компактный файл,
+который читается без pandas/openpyxl. Снимок привязан к списку источников
+(файлы и листы XLSX в порядке загрузки), а также к размеру, времени
+изменения и хэшу исходных файлов и пересоздаётся при их изменении.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import zlib
+
+SNAPSHOT_MAGIC = b'KBSNAP'
+SNAPSHOT_VERSION = 2
+
+
+def _file_sha1(path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class KBSnapshot:
+    """
+    Снимок статей базы знаний
+
+    Формат файла: MAGIC, версия и длина заголовка (struct), JSON-заголовок
+    с описанием исходных файлов, затем сжатый zlib JSON с колонками статей.
+    """
+
+    def __init__(self, snapshot_file):
+        self.snapshot_file = snapshot_file
+
+    @staticmethod
+    def _specs(specs):
+        """Источники в виде [абсолютный путь, лист или None] в порядке загрузки"""
+        from kb_loader import split_source
+
+        return [[os.path.abspath(path), sheet] for path, sheet in map(split_source, specs)]
+
+    @staticmethod
+    def _source_state(path, with_hash=False):
+        stat = os.stat(path)
+        state = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if with_hash:
+            state['sha1'] = _file_sha1(path)
+        return state
+
+    def _read_header(self, f):
+        magic = f.read(len(SNAPSHOT_MAGIC))
+        if magic != SNAPSHOT_MAGIC:
+            return None
+        version, header_len = struct.unpack('<II', f.read(8))
+        if version != SNAPSHOT_VERSION:
+            return None
+        return json.loads(f.read(header_len).decode('utf-8'))
+
+    def _sources_match(self, header, sources):
+        """Проверяет исходные файлы: быстро по размеру и mtime, при расхождении mtime - по хэшу"""
+        saved = header.get('sources', [])
+        if [s['path'] for s in saved] != [os.path.abspath(p) for p in sources]:
+            return False, False
+
+        touched = False
+        for saved_state, path in zip(saved, sources):
+            state = self._source_state(path)
+            if state['size'] != saved_state['size']:
+                return False, False
+            if state['mtime_ns'] != saved_state['mtime_ns']:
+                # Файл могли просто перезаписать тем же содержимым
+                if _file_sha1(path) != saved_state.get('sha1'):
+                    return False, False
+                touched = True
+        return True, touched
+
+    def load(self, sources, model=None, specs=None):
+        """
+        Загружает статьи из снимка, если он актуален для sources
+
+        Args:
+            sources: Исходные файлы
+            specs: Источники, как они заданы для загрузки ('file.xlsx#Лист'); снимок
+                   другого набора листов или другого порядка источников не подходит
+
+        Returns:
+            tuple: (fields, rows, hashes) или None. hashes - хэши текстов для model (или None)
+        """
+        if not os.path.exists(self.snapshot_file):
+            return None
+
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                header = self._read_header(f)
+                if header is None:
+                    return None
+
+                if header.get('specs') != self._specs(specs or sources):
+                    return None
+                is_valid, touched = self._sources_match(header, sources)
+                if not is_valid:
+                    return None
+
+                body = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+        except (OSError, ValueError, struct.error, zlib.error) as e:
+            print(f"[WARNING] Не удалось прочитать снимок БЗ: {e}")
+            return None
+
+        fields, rows = body['fields'], body['rows']
+        hashes = body.get('hashes') if body.get('model') == model else None
+
+        if touched:
+            # Обновляем mtime в заголовке, чтобы не считать хэш при каждом запуске
+            self.save(sources, fields, rows, hashes, model, specs)
+
+        return fields, rows, hashes
+
+    def save(self, sources, fields, rows, hashes=None, model=None, specs=None):
+        """Сохраняет статьи (колонки fields, строки rows) и хэши их текстов в снимок"""
+        rows = [list(row) for row in rows]
+        body = {
+            'fields': list(fields),
+            'rows': rows,
+            'model': model,
+            'hashes': hashes,
+        }
+        header = {
+            'specs': self._specs(specs or sources),
+            'sources': [self._source_state(path, with_hash=True) for path in sources],
+            'count': len(rows)
+        }
+
+        header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        body_bytes = zlib.compress(json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 1)
+
+        tmp_path = f"{self.snapshot_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(struct.pack('<II', SNAPSHOT_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            f.write(body_bytes)
+        os.replace(tmp_path, self.snapshot_file)
@@ -2,120 +2,1002 @@
 Модуль поиска по базе знаний с использованием векторных представлений
 """
 
-import warnings
-import json
 import numpy as np
-import pandas as pd
 from llm_client import LLMClient
-from config import SEARCH_TOP_K, SIMILARITY_THRESHOLD
-
-# Подавляем warning от openpyxl о Data Validation
-warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
+from kb_snapshot import KBSnapshot
+from kb_journal import KBJournal
+from exact_match import ExactMatchIndex
+from article_store import ArticleStore, ArticleView
+from cache import get_cache
+from embedding_store import EmbeddingCache, EmbeddingStore, QueryEmbeddingStore, normalize_rows, open_embedding_store
+from config import (
+    SEARCH_TOP_K, SIMILARITY_THRESHOLD, FILTERED_SEARCH_MIN_SIMILARITY, SEARCH_BATCH_CHUNK_SIZE,
+    ANN_INDEX, ANN_MIN_ARTICLES, IVF_NLIST, IVF_NPROBE, IVF_TRAIN_ITERATIONS, IVF_TRAIN_SAMPLE,
+    EMBEDDINGS_STORAGE, RESCORE_CANDIDATES, EMBEDDING_MODEL, EMBEDDING_STREAM_BATCH, QUERY_EMBEDDING_CACHE,
+    QUERY_EMBEDDING_STORE_MAX_ROWS, QUERY_EMBEDDING_STORE_COMPACT_KEEP, QUERY_CACHE_WARMUP_SIZE
+)
+import atexit
 import os
+import threading
+
+
+class QueryScores:
+    """
+    Сходство одного запроса со статьями-кандидатами
+    
+    rows=None означает, что scores посчитаны для всех статей (точный поиск).
+    Фильтры применяются уже к посчитанным значениям, поэтому из одного
+    объекта можно отобрать top_k с разными масками. Для квантованного
+    хранилища scores приближённые: лучшие кандидаты пересчитываются точно.
+    """
+    
+    __slots__ = ('index', 'query_vec', 'rows', 'scores')
+    
+    def __init__(self, index, query_vec, scores, rows=None):
+        self.index = index
+        self.query_vec = query_vec
+        self.scores = scores
+        self.rows = rows
+    
+    def top_k(self, top_k, threshold, mask=None):
+        """
+        Отбирает top_k статей по убыванию сходства
+        
+        Returns:
+            tuple: (индексы статей, их сходство)
+        """
+        if self.index.store.approximate:
+            indices, scores = self._rescored_top_k(top_k, threshold, mask)
+        elif self.rows is None:
+            indices = select_top_k(self.scores, top_k, threshold, mask)
+            return indices, self.scores[indices]
+        else:
+            candidate_mask = mask[self.rows] if mask is not None else None
+            picked = select_top_k(self.scores, top_k, threshold, candidate_mask)
+            indices, scores = self.rows[picked], self.scores[picked]
+        
+        # Узкий фильтр мог не попасть в просмотренные кластеры ANN -
+        # тогда досчитываем точно по статьям из маски, их немного
+        if mask is not None and len(indices) < top_k:
+            masked_rows = np.flatnonzero(mask)
+            if masked_rows.size <= self.index.exact_fallback_rows:
+                masked_scores = self.index.matrix[masked_rows] @ self.query_vec
+                picked = select_top_k(masked_scores, top_k, threshold)
+                indices, scores = masked_rows[picked], masked_scores[picked]
+        
+        return indices, scores
+    
+    def _rescored_top_k(self, top_k, threshold, mask):
+        """Отбор кандидатов по приближённому сходству и точный пересчёт по float32 матрице"""
+        candidate_mask = mask if self.rows is None or mask is None else mask[self.rows]
+        # Порог применяем только после точного пересчёта
+        picked = select_top_k(self.scores, max(top_k * 4, RESCORE_CANDIDATES), -np.inf, candidate_mask)
+        rows = picked if self.rows is None else self.rows[picked]
+        
+        # Чтение строк по возрастанию индекса дружелюбнее к mmap
+        rows = np.sort(rows)
+        exact_scores = self.index.matrix[rows] @ self.query_vec
+        picked = select_top_k(exact_scores, top_k, threshold)
+        return rows[picked], exact_scores[picked]
+
+
+class VectorIndex:
+    """
+    Индекс для точного косинусного поиска по embeddings
+    
+    Хранит непрерывную float32 матрицу с L2-нормализованными строками,
+    поэтому косинусное сходство запроса со всеми статьями считается
+    одним умножением матрицы на вектор. Вместо матрицы можно передать
+    EmbeddingStore (mmap или квантованное хранилище).
+    """
+    
+    kind = 'exact'
+    # Сколько статей из узкого фильтра досчитывать точно, если поиск их не нашёл
+    # (нужно только IVF: точный перебор уже учитывает маску)
+    exact_fallback_rows = 0
+    
+    def __init__(self, embeddings):
+        if isinstance(embeddings, EmbeddingStore):
+            self.store = embeddings
+        else:
+            self.store = EmbeddingStore(normalize_rows(embeddings))
+        # Точная float32 матрица (в памяти или mmap)
+        self.matrix = self.store.matrix
+    
+    def __len__(self):
+        return self.matrix.shape[0]
+    
+    @property
+    def shape(self):
+        return self.matrix.shape
+    
+    def normalize_query(self, query_embedding):
+        """Приводит вектор запроса к float32 и единичной длине"""
+        return normalize_rows(query_embedding)
+    
+    def vector(self, row):
+        """Нормализованный вектор статьи"""
+        return np.asarray(self.matrix[row], dtype=np.float32)
+    
+    def similarities(self, query_embedding):
+        """Косинусное сходство запроса со всеми статьями"""
+        return self.matrix @ self.normalize_query(query_embedding)
+    
+    def score(self, query_embedding):
+        """Считает сходство запроса со статьями (QueryScores)"""
+        query_vec = self.normalize_query(query_embedding)
+        return QueryScores(self, query_vec, self.store.dot(query_vec))
+    
+    def score_batch(self, query_embeddings):
+        """Считает сходство для нескольких запросов одним GEMM (список QueryScores)"""
+        query_vecs = self.normalize_query(query_embeddings)
+        all_scores = self.store.dot_batch(query_vecs)
+        return [QueryScores(self, query_vecs[i], all_scores[i]) for i in range(len(query_vecs))]
+
+
+class IVFIndex(VectorIndex):
+    """
+    Приближённый индекс IVF (inverted file) для больших баз знаний
+    
+    Статьи разбиваются на nlist кластеров сферическим k-means. Запрос
+    сравнивается с центроидами, и точное сходство считается только для
+    статей из nprobe ближайших кластеров. Больше nprobe - выше полнота,
+    но медленнее поиск.
+    """
+    
+    kind = 'ivf'
+    
+    def __init__(self, embeddings, nlist=None, nprobe=IVF_NPROBE, centroids=None, list_offsets=None, list_rows=None):
+        super().__init__(embeddings)
+        self.nprobe = nprobe
+        # Узкие фильтры, не найденные в nprobe кластерах, досчитываются точно
+        self.exact_fallback_rows = max(len(self) // 10, 1000)
+        
+        if centroids is not None:
+            self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+            self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+            self.list_rows = np.asarray(list_rows, dtype=np.int64)
+        else:
+            nlist = nlist or int(4 * np.sqrt(len(self)))
+            nlist = max(1, min(nlist, len(self)))
+            self.centroids = self._train_centroids(self.matrix, nlist)
+            self._build_lists(self._assign(self.matrix, self.centroids))
+    
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+    
+    @staticmethod
+    def _assign(vectors, centroids, block_size=16384):
+        """Номер ближайшего центроида для каждого вектора (блоками, чтобы ограничить память)"""
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size]
+            assignment[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+        return assignment
+    
+    def _train_centroids(self, matrix, nlist, iterations=IVF_TRAIN_ITERATIONS, sample_size=IVF_TRAIN_SAMPLE, seed=0):
+        """Сферический k-means на случайной выборке статей"""
+        rng = np.random.default_rng(seed)
+        if len(matrix) > sample_size:
+            sample = matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))]
+        else:
+            sample = matrix
+        
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        
+        for _ in range(iterations):
+            assignment = self._assign(sample, centroids)
+            order = np.argsort(assignment, kind='stable')
+            counts = np.bincount(assignment, minlength=nlist)
+            
+            non_empty = np.flatnonzero(counts)
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[non_empty]
+            centroids[non_empty] = np.add.reduceat(sample[order], starts, axis=0)
+            
+            # Пустые кластеры переинициализируем случайными статьями
+            empty = np.flatnonzero(counts == 0)
+            if empty.size:
+                centroids[empty] = sample[rng.choice(len(sample), empty.size, replace=False)]
+            
+            centroids = normalize_rows(centroids)
+        
+        return centroids
+    
+    def _build_lists(self, assignment):
+        """Списки статей по кластерам в формате CSR: list_rows[list_offsets[c]:list_offsets[c + 1]]"""
+        self.list_rows = np.argsort(assignment, kind='stable').astype(np.int64)
+        counts = np.bincount(assignment, minlength=self.nlist)
+        self.list_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    
+    def _candidates(self, centroid_scores):
+        """Статьи из nprobe ближайших кластеров"""
+        nprobe = min(self.nprobe, self.nlist)
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        return np.concatenate([
+            self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probe
+        ])
+    
+    def score(self, query_embedding):
+        query_vec = self.normalize_query(query_embedding)
+        rows = self._candidates(self.centroids @ query_vec)
+        return QueryScores(self, query_vec, self.store.dot(query_vec, rows), rows)
+    
+    def score_batch(self, query_embeddings):
+        query_vecs = self.normalize_query(query_embeddings)
+        centroid_scores = query_vecs @ self.centroids.T
+        results = []
+        for i, query_vec in enumerate(query_vecs):
+            rows = self._candidates(centroid_scores[i])
+            results.append(QueryScores(self, query_vec, self.store.dot(query_vec, rows), rows))
+        return results
+    
+    def save(self, path, fingerprint):
+        """Сохраняет кластеры рядом с кэшем embeddings"""
+        np.savez(
+            path,
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            list_rows=self.list_rows,
+            fingerprint=np.array(fingerprint)
+        )
+    
+    @classmethod
+    def load(cls, path, embeddings, fingerprint, nprobe=IVF_NPROBE):
+        """Загружает сохранённые кластеры, если они построены для этих же embeddings"""
+        with np.load(path) as data:
+            if str(data['fingerprint']) != fingerprint:
+                return None
+            return cls(
+                embeddings,
+                nprobe=nprobe,
+                centroids=data['centroids'],
+                list_offsets=data['list_offsets'],
+                list_rows=data['list_rows']
+            )
+
+
+def category_matches(category_filter_lower, article_category):
+    """
+    Мягкое сравнение категорий (нечувствительно к регистру)
+    
+    Категория подходит, если есть хотя бы одно общее слово
+    или одна строка содержится в другой.
+    """
+    article_category_lower = article_category.lower()
+    
+    # Разбиваем на слова для более мягкого сравнения
+    filter_words = set(category_filter_lower.split())
+    article_words = set(article_category_lower.split())
+    
+    if filter_words & article_words:
+        return True
+    # Нет общих слов - отбрасываем только если категории сильно различаются
+    return category_filter_lower in article_category_lower or article_category_lower in category_filter_lower
+
+
+def select_top_k(similarities, top_k, threshold, mask=None):
+    """
+    Выбирает индексы top_k наиболее похожих статей
+    
+    Порог и маска применяются векторно, а np.argpartition отбирает
+    кандидатов за O(n) без полной сортировки.
+    
+    Args:
+        similarities: Вектор сходства со всеми статьями
+        top_k: Количество результатов
+        threshold: Минимальное сходство
+        mask: Булева маска допустимых статей (опционально)
+        
+    Returns:
+        np.ndarray: Индексы статей по убыванию сходства
+    """
+    keep = similarities >= threshold
+    if mask is not None:
+        keep &= mask
+    
+    candidates = np.flatnonzero(keep)
+    if top_k <= 0 or candidates.size == 0:
+        return candidates[:0]
+    
+    candidate_scores = similarities[candidates]
+    if candidates.size > top_k:
+        part = np.argpartition(-candidate_scores, top_k - 1)[:top_k]
+        candidates = candidates[part]
+        candidate_scores = candidate_scores[part]
+    
+    # Стабильная сортировка сохраняет порядок статей при равном сходстве
+    order = np.argsort(-candidate_scores, kind='stable')
+    return candidates[order]
+
+
+class MetadataIndex:
+    """
+    Индекс метаданных статей для фильтрованного поиска
+    
+    Для каждого поля хранит список уникальных значений и массив их номеров
+    по статьям. Правило сравнения применяется только к уникальным значениям,
+    а итоговая булева маска кэшируется для каждой строки фильтра.
+    """
+    
+    # Поле -> (ключи статьи по приоритету, мягкое сравнение)
+    FIELDS = {
+        'main_category': (('main_category', 'category'), True),
+        'subcategory': (('subcategory',), True),
+        'target_audience': (('target_audience',), False),
+        'priority': (('priority',), False),
+    }
+    MASK_CACHE_LIMIT = 256
+    
+    def __init__(self, articles):
+        self.size = len(articles)
+        self.values = {}  # поле -> список уникальных значений
+        self.codes = {}   # поле -> np.ndarray номеров значений по статьям
+        self._mask_cache = {}
+        
+        if isinstance(articles, ArticleStore):
+            # Хранилище уже держит интернированные номера значений
+            for field in self.FIELDS:
+                codes, values = articles.field_codes(field)
+                self.codes[field] = np.frombuffer(codes, dtype=np.int32).copy() if len(codes) else np.empty(0, dtype=np.int32)
+                self.values[field] = [str(value) for value in values]
+            return
+        
+        for field, (keys, _) in self.FIELDS.items():
+            value_ids = {}
+            codes = np.empty(self.size, dtype=np.int32)
+            for i, article in enumerate(articles):
+                value = self._article_value(article, keys)
+                if value not in value_ids:
+                    value_ids[value] = len(value_ids)
+                codes[i] = value_ids[value]
+            self.values[field] = list(value_ids)
+            self.codes[field] = codes
+    
+    @staticmethod
+    def _article_value(article, keys):
+        for key in keys:
+            value = article.get(key)
+            if value is not None:
+                return str(value)
+        return ''
+    
+    def field_mask(self, field, filter_value):
+        """Булева маска статей, у которых поле подходит под фильтр (с кэшем)"""
+        filter_lower = str(filter_value).strip().lower()
+        cache_key = (field, filter_lower)
+        mask = self._mask_cache.get(cache_key)
+        if mask is not None:
+            return mask
+        
+        soft = self.FIELDS[field][1]
+        matching = [
+            value_id
+            for value_id, value in enumerate(self.values[field])
+            if (category_matches(filter_lower, value) if soft else value.strip().lower() == filter_lower)
+        ]
+        mask = np.isin(self.codes[field], np.asarray(matching, dtype=np.int32))
+        mask.flags.writeable = False
+        
+        if len(self._mask_cache) >= self.MASK_CACHE_LIMIT:
+            self._mask_cache.pop(next(iter(self._mask_cache)), None)
+        self._mask_cache[cache_key] = mask
+        return mask
+    
+    def mask(self, filters):
+        """
+        Объединённая маска по нескольким полям
+        
+        Args:
+            filters: dict поле -> значение фильтра (пустые значения игнорируются)
+            
+        Returns:
+            np.ndarray или None, если фильтров нет
+        """
+        combined = None
+        for field, filter_value in filters.items():
+            if not filter_value:
+                continue
+            field_mask = self.field_mask(field, filter_value)
+            combined = field_mask if combined is None else combined & field_mask
+        return combined
+
+
+class SegmentedScores:
+    """Сходство запроса со статьями основного индекса и сегмента новых статей"""
+    
+    __slots__ = ('base', 'delta', 'base_size')
+    
+    def __init__(self, base, delta, base_size):
+        self.base = base
+        self.delta = delta
+        self.base_size = base_size
+    
+    def top_k(self, top_k, threshold, mask=None):
+        """Отбирает top_k в каждом сегменте и объединяет (как QueryScores.top_k)"""
+        delta_mask = mask[self.base_size:] if mask is not None else None
+        delta_picked = select_top_k(self.delta, top_k, threshold, delta_mask)
+        if self.base is None:
+            return delta_picked + self.base_size, self.delta[delta_picked]
+        
+        base_indices, base_scores = self.base.top_k(
+            top_k, threshold, mask[:self.base_size] if mask is not None else None
+        )
+        indices = np.concatenate([base_indices, delta_picked + self.base_size])
+        scores = np.concatenate([base_scores, self.delta[delta_picked]])
+        order = np.argsort(-scores, kind='stable')[:top_k]
+        return indices[order], scores[order]
+
+
+class SegmentedIndex:
+    """
+    Неизменяемый основной индекс и сегмент статей, добавленных после его построения
+    
+    Статьи, добавленные или изменённые через API, попадают в небольшую
+    матрицу с точным перебором, а основной индекс (VectorIndex, IVF,
+    квантованный) не перестраивается. Строки сегмента идут после строк
+    основного индекса. Каждое изменение создаёт новый объект, поэтому
+    поиск по предыдущей версии не видит частично добавленных строк.
+    Сегмент переносится в основной индекс при следующей загрузке БЗ.
+    """
+    
+    kind = 'segmented'
+    
+    def __init__(self, base, delta):
+        self.base = base
+        self.delta = delta
+        self.delta.flags.writeable = False
+        self.base_size = len(base) if base is not None else 0
+    
+    @classmethod
+    def extend(cls, index, vectors):
+        """Новый индекс: index (любого вида или None) плюс строки vectors"""
+        vectors = normalize_rows(vectors)
+        if isinstance(index, SegmentedIndex):
+            return cls(index.base, np.vstack([index.delta, vectors]))
+        return cls(index, vectors)
+    
+    def __len__(self):
+        return self.base_size + len(self.delta)
+    
+    @property
+    def shape(self):
+        return (len(self), self.delta.shape[1])
+    
+    def normalize_query(self, query_embedding):
+        return normalize_rows(query_embedding)
+    
+    def vector(self, row):
+        if row < self.base_size:
+            return self.base.vector(row)
+        return self.delta[row - self.base_size]
+    
+    def score(self, query_embedding):
+        query_vec = self.normalize_query(query_embedding)
+        base = self.base.score(query_vec) if self.base is not None else None
+        return SegmentedScores(base, self.delta @ query_vec, self.base_size)
+    
+    def score_batch(self, query_embeddings):
+        query_vecs = self.normalize_query(query_embeddings)
+        if self.base is not None:
+            base = self.base.score_batch(query_vecs)
+        else:
+            base = [None] * len(query_vecs)
+        delta = query_vecs @ self.delta.T
+        return [SegmentedScores(base[i], delta[i], self.base_size) for i in range(len(query_vecs))]
+
+
+class KBVersion:
+    """
+    Неизменяемая версия базы знаний для поиска
+    
+    Поиск один раз берёт текущую версию и работает только с ней. Изменения
+    статей создают новую версию и публикуют её заменой одной ссылки, поэтому
+    выполняющийся поиск никогда не видит наполовину построенный индекс.
+    
+    Хранилище статей общее для всех версий и только дополняется: версия
+    видит первые size строк, а alive отмечает актуальные из них (None - все).
+    """
+    
+    __slots__ = ('number', 'articles', 'size', 'index', 'metadata', 'hashes', 'alive', 'row_by_id', 'exact')
+    
+    def __init__(self, number, articles, index, metadata, hashes, alive=None, row_by_id=None, exact=None):
+        self.number = number
+        self.articles = articles
+        self.size = metadata.size
+        self.index = index
+        self.metadata = metadata
+        self.hashes = hashes
+        self.alive = alive
+        self.row_by_id = row_by_id  # id статьи -> строка (строится при первом изменении)
+        self.exact = exact  # ExactMatchIndex по вопросам актуальных статей
+    
+    def live_articles(self):
+        """Актуальные статьи версии"""
+        if self.alive is None:
+            return self.articles
+        return ArticleView(self.articles, np.flatnonzero(self.alive))
 
 
 class KnowledgeBase:
     """Система поиска по базе знаний с использованием embeddings"""
     
     def __init__(self, knowledge_file='data/smart_support_vtb_belarus_faq_final.xlsx', api_key=None):
+        """
+        Args:
+            knowledge_file: Путь к файлу БЗ (.xlsx, .csv, .jsonl, .json) или список путей,
+                            которые объединяются в одну БЗ. Для XLSX можно указать лист: 'file.xlsx#Лист'
+            api_key: API ключ SciBox
+        """
         self.llm = LLMClient(api_key=api_key)
         
-        # Формируем абсолютный путь к файлу БЗ
-        if not os.path.isabs(knowledge_file):
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-            self.knowledge_file = os.path.join(base_dir, knowledge_file)
-        else:
-            self.knowledge_file = knowledge_file
+        # Формируем абсолютные пути к файлам БЗ
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        sources = [knowledge_file] if isinstance(knowledge_file, str) else list(knowledge_file)
+        self.knowledge_files = [
+            source if os.path.isabs(source) else os.path.join(base_dir, source)
+            for source in sources
+        ]
+        self.knowledge_file = self.knowledge_files[0] if self.knowledge_files else ''
             
         # Формируем абсолютный путь к файлу embeddings
         base_dir = os.path.dirname(os.path.abspath(__file__))
         self.embeddings_file = os.path.join(base_dir, 'data/embeddings_cache.npy')
+        self.embedding_cache = EmbeddingCache(
+            self.embeddings_file,
+            os.path.join(base_dir, 'data/embeddings_manifest.json'),
+            EMBEDDING_MODEL
+        )
+        self.ann_index_file = os.path.join(base_dir, 'data/ann_index_ivf.npz')
+        # Готовые чанки прерванного создания embeddings
+        self.embeddings_checkpoint_dir = os.path.join(base_dir, 'data/embeddings_checkpoint')
+        # Префикс файлов нормализованной/квантованной матрицы (EMBEDDINGS_STORAGE != 'memory')
+        self.embeddings_store_base = os.path.join(base_dir, 'data/embeddings_index')
+        # Снимок статей для быстрого старта без pandas
+        self.snapshot = KBSnapshot(os.path.join(base_dir, 'data/kb_snapshot.bin'))
+        # Изменения статей через API (применяются поверх файлов БЗ при загрузке)
+        self.journal = KBJournal(os.path.join(base_dir, 'data/kb_changes.jsonl'))
         
-        self.articles = []
+        self.articles = ArticleStore()  # Колоночное хранилище; статьи доступны как read-only dict
+        self.article_hashes = None  # Хэши текстов статей для кэша embeddings
         self.embeddings = None
-        self.query_cache = {}  # Кэш для embeddings запросов
-        self.cache_limit = 100  # Ограничение размера кэша
+        self.index = None  # VectorIndex, строится один раз при загрузке embeddings
+        self.metadata = None  # MetadataIndex для фильтров по категории, аудитории и т.д.
+        self.version = None  # KBVersion, которую видит поиск
+        self._write_lock = threading.Lock()  # Изменения статей выполняются по одному
+        self._next_article_id = None  # id для новой статьи (id удалённых статей не переиспользуются)
+        self.query_cache = get_cache('query_embeddings', **QUERY_EMBEDDING_CACHE)  # Общий LRU+TTL кэш embeddings запросов
+        # Embeddings запросов на диске: переживают перезапуск и общие для воркеров
+        self.query_store = QueryEmbeddingStore(
+            os.path.join(base_dir, 'data/query_embeddings'),
+            EMBEDDING_MODEL,
+            max_rows=QUERY_EMBEDDING_STORE_MAX_ROWS,
+            compact_keep=QUERY_EMBEDDING_STORE_COMPACT_KEEP
+        )
+        atexit.register(self.query_store.flush_hits)
         
         self.load_knowledge_base()
+        self._replay_journal()
+        self.metadata = MetadataIndex(self.articles)
         if self.articles:
             self.load_or_create_embeddings()
+        self._publish(KBVersion(
+            1, self.articles, self.index, self.metadata, self.article_hashes,
+            exact=ExactMatchIndex.build(self.articles)
+        ))
     
     def load_knowledge_base(self):
-        """Загружает базу знаний из XLSX или JSON файла"""
-        if not os.path.exists(self.knowledge_file):
-            print(f"[WARNING] Файл базы знаний не найден: {self.knowledge_file}")
-            self.articles = []
+        """
+        Загружает базу знаний из XLSX, CSV, JSONL или JSON файлов
+        
+        Строки читаются потоково и проверяются по одной (см. kb_loader).
+        Если снимок БЗ актуален для исходных файлов, статьи читаются из него.
+        После разбора исходных файлов снимок пересоздаётся.
+        """
+        import time
+        from kb_loader import iter_articles, split_source
+        
+        sources = []
+        for source in self.knowledge_files:
+            if os.path.exists(split_source(source)[0]):
+                sources.append(source)
+            else:
+                print(f"[WARNING] Файл базы знаний не найден: {source}")
+        
+        if not sources:
+            self.articles = ArticleStore()
+            return
+        
+        # Один файл может быть указан несколькими листами
+        source_files = list(dict.fromkeys(split_source(source)[0] for source in sources))
+        
+        start_time = time.time()
+        snapshot = self.snapshot.load(source_files, model=EMBEDDING_MODEL, specs=sources)
+        if snapshot is not None:
+            fields, rows, self.article_hashes = snapshot
+            self.articles = ArticleStore.from_rows(fields, rows)
+            print(f"[OK] Загружено {len(self.articles)} статей из снимка БЗ за {time.time() - start_time:.3f}s")
             return
         
+        articles = ArticleStore()
+        stats = {}
         try:
-            # Определяем формат файла
-            if self.knowledge_file.endswith('.xlsx'):
-                # Загружаем из Excel
-                df = pd.read_excel(self.knowledge_file)
-                
-                # Преобразуем DataFrame в список словарей
-                self.articles = []
-                for idx, row in df.iterrows():
-                    article = {
-                        'id': int(row.get('id', idx + 1)),
-                        'main_category': str(row.get('main_category', row.get('Основная категория', 'Другое'))),
-                        'subcategory': str(row.get('subcategory', row.get('Подкатегория', ''))),
-                        'example_question': str(row.get('example_question', row.get('Пример вопроса', ''))),
-                        'priority': str(row.get('priority', row.get('Приоритет', 'Средний'))),
-                        'target_audience': str(row.get('target_audience', row.get('Целевая аудитория', 'Все'))),
-                        'template_answer': str(row.get('template_answer', row.get('Шаблонный ответ', ''))),
-                        # Для обратной совместимости
-                        'category': str(row.get('main_category', row.get('Основная категория', 'Другое'))),
-                        'problem': str(row.get('example_question', row.get('Пример вопроса', ''))),
-                        'solution': str(row.get('template_answer', row.get('Шаблонный ответ', '')))
-                    }
-                    self.articles.append(article)
-                
-                print(f"[OK] Загружено {len(self.articles)} статей из XLSX файла")
-                
-            elif self.knowledge_file.endswith('.json'):
-                # Загружаем из JSON (обратная совместимость)
-                with open(self.knowledge_file, 'r', encoding='utf-8') as f:
-                    self.articles = json.load(f)
-                print(f"[OK] Загружено {len(self.articles)} статей из JSON файла")
-            
-            else:
-                print(f"[ERROR] Неподдерживаемый формат файла: {self.knowledge_file}")
-                self.articles = []
-                
+            for article in iter_articles(sources, stats):
+                articles.append(article)
         except Exception as e:
             print(f"[ERROR] Ошибка при загрузке базы знаний: {e}")
-            self.articles = []
+            self.articles = ArticleStore()
+            return
+        
+        self.articles = articles
+        print(f"[OK] Загружено {len(self.articles)} статей из {len(sources)} источников за {time.time() - start_time:.2f}s"
+              + (f" (пропущено некорректных записей: {stats['skipped']})" if stats.get('skipped') else "")
+              + (f" (перенумеровано повторяющихся id: {stats['renumbered']})" if stats.get('renumbered') else ""))
+        
+        self.article_hashes = self._compute_article_hashes()
+        try:
+            self.snapshot.save(
+                source_files,
+                self.articles.fields,
+                self.articles.iter_rows(),
+                self.article_hashes,
+                model=EMBEDDING_MODEL,
+                specs=sources
+            )
+        except Exception as e:
+            print(f"[WARNING] Не удалось сохранить снимок БЗ: {e}")
+    
+    def _replay_journal(self):
+        """Применяет к загруженным статьям изменения, сделанные через API"""
+        try:
+            articles = self.journal.replay(self.articles)
+        except Exception as e:
+            print(f"[ERROR] Не удалось применить журнал изменений БЗ: {e}")
+            return
+        if articles is not None:
+            self.articles = articles
+            self.article_hashes = None  # Хэши из снимка относятся к статьям до изменений
+    
+    def _compute_article_hashes(self):
+        return [self.embedding_cache.text_hash(self._embedding_text(article)) for article in self.articles]
+    
+    @staticmethod
+    def _embedding_text(article):
+        """Текст статьи, по которому строится её embedding"""
+        # Используем новые поля или fallback на старые
+        return (
+            f"{article.get('example_question', article.get('problem', ''))} "
+            f"{article.get('template_answer', article.get('solution', ''))}"
+        )
     
     def load_or_create_embeddings(self):
-        """Загружает или создает embeddings для базы знаний"""
-        # Проверяем, есть ли кэшированные embeddings
-        if os.path.exists(self.embeddings_file):
-            try:
-                self.embeddings = np.load(self.embeddings_file)
-                print(f"[OK] Загружены кэшированные embeddings: {self.embeddings.shape}")
+        """
+        Загружает embeddings из кэша и досоздаёт недостающие
+        
+        Кэш хранит хэш текста каждой статьи (вместе с EMBEDDING_MODEL) в манифесте,
+        поэтому после правки БЗ в API отправляются только новые и изменённые статьи.
+        """
+        import time
+        
+        hashes = self.article_hashes
+        if hashes is None or len(hashes) != len(self.articles):
+            hashes = self.article_hashes = self._compute_article_hashes()
+        # Для хранилищ на диске исходный кэш не читаем целиком в память
+        mmap_mode = None if EMBEDDINGS_STORAGE == 'memory' else 'r'
+        
+        try:
+            cached, cached_hashes = self.embedding_cache.load(mmap_mode=mmap_mode)
+        except Exception as e:
+            print(f"[WARNING] Не удалось загрузить кэш embeddings: {e}")
+            cached, cached_hashes = None, None
+        
+        if cached is not None and cached_hashes is None:
+            # Кэш старого формата без манифеста: доверяем ему, только если совпадает число статей
+            if len(cached) == len(hashes):
+                print("[INFO] Кэш embeddings без манифеста, сохраняем манифест для текущей БЗ")
+                cached_hashes = list(hashes)
+                self.embedding_cache.save_manifest(cached_hashes, cached.shape[1])
+            else:
+                cached_hashes = []
+        
+        if cached is not None and cached_hashes == hashes:
+            self._build_index(cached, self.embedding_cache.fingerprint(hashes))
+            print(f"[OK] Загружены кэшированные embeddings: {self.embeddings.shape}")
+            return
+        
+        row_by_hash = {h: i for i, h in enumerate(cached_hashes or []) if h}
+        reused = sum(1 for article_hash in hashes if article_hash in row_by_hash)
+        missing_count = len(set(hashes) - set(row_by_hash))
+        print(f"[INFO] Embeddings: {reused} статей из кэша, {missing_count} новых или изменённых текстов")
+        
+        # Новый кэш собираем построчно в файле, не держа вторую копию матрицы в памяти.
+        # Недостающие тексты отправляются порциями по EMBEDDING_STREAM_BATCH, поэтому
+        # память не растёт с размером БЗ.
+        state = {'matrix': None, 'created': 0, 'failed': 0}
+        dim = cached.shape[1] if cached is not None and len(cached) else None
+        saved_hashes = list(hashes)
+        pending = {}  # хэш -> (текст, [строки])
+        
+        def ensure_matrix(dim):
+            if state['matrix'] is None:
+                state['matrix'] = self.embedding_cache.create_matrix(len(hashes), dim)
+            return state['matrix']
+        
+        def flush():
+            if not pending:
+                return
+            items = list(pending.items())
+            pending.clear()
+            embeddings_list = self.llm.get_embeddings_batch(
+                [text for _, (text, _) in items],
+                checkpoint_dir=self.embeddings_checkpoint_dir
+            )
+            if not embeddings_list:
+                # Embedding не получен: нулевая строка не найдётся поиском,
+                # а пустой хэш заставит повторить попытку при следующем запуске
+                for _, (_, rows) in items:
+                    for row in rows:
+                        saved_hashes[row] = ''
+                        if state['matrix'] is not None:
+                            state['matrix'][row] = 0
+                    state['failed'] += 1
                 return
+            matrix = ensure_matrix(len(embeddings_list[0]))
+            for (_, (_, rows)), embedding in zip(items, embeddings_list):
+                matrix[rows] = embedding
+            state['created'] += len(items)
+        
+        start_time = time.time()
+        for i, (article, article_hash) in enumerate(zip(self.articles, hashes)):
+            if article_hash in row_by_hash:
+                ensure_matrix(dim)[i] = cached[row_by_hash[article_hash]]
+                continue
+            if article_hash in pending:
+                pending[article_hash][1].append(i)
+                continue
+            pending[article_hash] = (self._embedding_text(article), [i])
+            if len(pending) >= EMBEDDING_STREAM_BATCH:
+                flush()
+        flush()
+        
+        if state['created']:
+            print(f"[OK] Создано {state['created']} embeddings за {time.time() - start_time:.2f}s")
+        if state['failed']:
+            print(f"[ERROR] Не удалось создать {state['failed']} embeddings")
+        
+        matrix = state['matrix']
+        if matrix is None:
+            print("[ERROR] Не удалось создать embeddings")
+            return
+        # Строки, для которых embedding не получен до создания матрицы
+        for i, article_hash in enumerate(saved_hashes):
+            if not article_hash:
+                matrix[i] = 0
+        
+        del cached
+        self.embedding_cache.commit(matrix, saved_hashes)
+        
+        self._build_index(
+            np.load(self.embeddings_file, mmap_mode=mmap_mode),
+            self.embedding_cache.fingerprint(saved_hashes)
+        )
+        print(f"[OK] Сохранено {self.embeddings.shape[0]} embeddings")
+    
+    def _build_index(self, embeddings, fingerprint):
+        """
+        Строит поисковый индекс; self.embeddings указывает на его нормализованную матрицу
+        
+        Тип индекса задаётся ANN_INDEX: 'exact' - точный перебор, 'ivf' - приближённый
+        IVF, 'auto' - IVF начиная с ANN_MIN_ARTICLES статей. Хранение матрицы задаётся
+        EMBEDDINGS_STORAGE: 'memory', 'mmap', 'float16' или 'int8'.
+        """
+        store = open_embedding_store(embeddings, EMBEDDINGS_STORAGE, self.embeddings_store_base, fingerprint)
+        print(f"[OK] Хранилище embeddings: {store.kind}, {store.nbytes / 2**20:.1f} MB")
+        
+        use_ivf = ANN_INDEX == 'ivf' or (ANN_INDEX == 'auto' and len(store) >= ANN_MIN_ARTICLES)
+        
+        if use_ivf:
+            self.index = self._load_or_build_ivf(store, fingerprint)
+        else:
+            self.index = VectorIndex(store)
+        
+        # Отдельную float64 копию не держим: матрица индекса уже нормализована
+        self.embeddings = self.index.matrix
+    
+    def _load_or_build_ivf(self, store, fingerprint):
+        """Загружает IVF индекс с диска или обучает и сохраняет новый"""
+        import time
+        
+        if os.path.exists(self.ann_index_file):
+            try:
+                index = IVFIndex.load(self.ann_index_file, store, fingerprint)
+                if index is not None:
+                    print(f"[OK] Загружен IVF индекс: {index.nlist} кластеров, nprobe={index.nprobe}")
+                    return index
+                print("[INFO] IVF индекс устарел, перестраиваем...")
             except Exception as e:
-                print(f"[WARNING] Не удалось загрузить кэш embeddings: {e}")
+                print(f"[WARNING] Не удалось загрузить IVF индекс: {e}")
         
-        # Создаем embeddings для всех статей
-        if self.articles:
-            print("[INFO] Создание embeddings для базы знаний...")
-            # Используем новые поля или fallback на старые
-            texts = [
-                f"{article.get('example_question', article.get('problem', ''))} "
-                f"{article.get('template_answer', article.get('solution', ''))}" 
-                for article in self.articles
-            ]
-            embeddings_list = self.llm.get_embeddings_batch(texts)
+        start_time = time.time()
+        index = IVFIndex(store, nlist=IVF_NLIST)
+        print(f"[OK] Построен IVF индекс: {index.nlist} кластеров за {time.time() - start_time:.2f}s")
+        
+        try:
+            index.save(self.ann_index_file, fingerprint)
+        except Exception as e:
+            print(f"[WARNING] Не удалось сохранить IVF индекс: {e}")
+        
+        return index
+    
+    def _publish(self, version):
+        """Делает версию текущей для поиска (одна замена ссылки)"""
+        self.version = version
+        # Атрибуты для обратной совместимости указывают на актуальную версию
+        self.articles = version.live_articles()
+        self.index = version.index
+        self.metadata = version.metadata
+        self.article_hashes = version.hashes
+    
+    def find_exact(self, *texts):
+        """
+        Статья, вопрос которой совпадает с одним из текстов обращения
+        (без учёта регистра, пробелов и пунктуации)
+        
+        Returns:
+            Article или None
+        """
+        version = self.version
+        if version is None or version.exact is None:
+            return None
+        row = version.exact.lookup(*texts)
+        return version.articles[row] if row is not None else None
+    
+    def get_article(self, article_id):
+        """Актуальная статья по id (KeyError, если её нет)"""
+        version = self.version
+        row_by_id = version.row_by_id if version.row_by_id is not None else self._rows_by_id(version)
+        return version.articles[row_by_id[article_id]]
+    
+    @staticmethod
+    def _rows_by_id(version):
+        """id статьи -> строка для актуальных статей версии"""
+        rows = range(version.size) if version.alive is None else np.flatnonzero(version.alive)
+        return {version.articles.value(int(row), 'id'): int(row) for row in rows}
+    
+    def add_article(self, article):
+        """
+        Добавляет статью без перезапуска: создаётся embedding только этой статьи
+        
+        Args:
+            article: dict с полями статьи (как в файле БЗ); id назначается автоматически, если не указан
             
-            if embeddings_list:
-                self.embeddings = np.array(embeddings_list)
-                # Сохраняем в кэш
-                np.save(self.embeddings_file, self.embeddings)
-                print(f"[OK] Создано и сохранено {self.embeddings.shape[0]} embeddings")
+        Returns:
+            Article: Добавленная статья
+            
+        Raises:
+            ValueError: Статья не прошла проверку или id уже занят
+        """
+        from kb_loader import normalize_article
+        
+        with self._write_lock:
+            version = self.version
+            row_by_id = version.row_by_id if version.row_by_id is not None else self._rows_by_id(version)
+            if self._next_article_id is None:
+                ids = (version.articles.value(row, 'id') for row in range(version.size))
+                self._next_article_id = max((i for i in ids if isinstance(i, int)), default=0) + 1
+            
+            article = normalize_article(article, default_id=self._next_article_id)
+            if article['id'] in row_by_id:
+                raise ValueError(f"Статья с id {article['id']} уже существует")
+            
+            self._apply_change(version, row_by_id, 'add', article['id'], article)
+            self._next_article_id = max(self._next_article_id, article['id'] + 1)
+            return self.get_article(article['id'])
+    
+    def update_article(self, article_id, fields):
+        """
+        Изменяет поля статьи; embedding пересоздаётся, только если изменился её текст
+        
+        Returns:
+            Article: Обновлённая статья
+            
+        Raises:
+            KeyError: Статьи с таким id нет
+            ValueError: Статья не прошла проверку
+        """
+        from kb_loader import map_columns, normalize_article
+        
+        with self._write_lock:
+            version = self.version
+            row_by_id = version.row_by_id if version.row_by_id is not None else self._rows_by_id(version)
+            if article_id not in row_by_id:
+                raise KeyError(article_id)
+            
+            current = version.articles[row_by_id[article_id]].to_dict()
+            for alias in ArticleStore.ALIASES:
+                current.pop(alias, None)
+            # fields могут использовать названия столбцов (category, "Основная категория"...)
+            article = normalize_article({**current, **map_columns(fields)}, default_id=article_id)
+            article['id'] = article_id
+            
+            self._apply_change(version, row_by_id, 'update', article_id, article)
+            return self.get_article(article_id)
+    
+    def delete_article(self, article_id):
+        """
+        Удаляет статью из поиска
+        
+        Raises:
+            KeyError: Статьи с таким id нет
+        """
+        with self._write_lock:
+            version = self.version
+            row_by_id = version.row_by_id if version.row_by_id is not None else self._rows_by_id(version)
+            if article_id not in row_by_id:
+                raise KeyError(article_id)
+            
+            self._apply_change(version, row_by_id, 'delete', article_id)
+    
+    def _apply_change(self, version, row_by_id, op, article_id, article=None):
+        """
+        Создаёт и публикует новую версию БЗ с одним изменением (вызывается под _write_lock)
+        
+        Основной индекс не меняется: новая редакция статьи добавляется строкой
+        в сегмент индекса, а старая строка исключается маской alive.
+        """
+        import time
+        
+        start_time = time.time()
+        store = version.articles
+        if len(store) != version.size:
+            raise RuntimeError("Хранилище статей не соответствует текущей версии БЗ")
+        if version.index is None and version.size:
+            raise RuntimeError("Поисковый индекс не построен, изменение статей недоступно")
+        
+        old_row = row_by_id.get(article_id)
+        vector = None
+        article_hash = None
+        if article is not None:
+            text = self._embedding_text(article)
+            article_hash = self.embedding_cache.text_hash(text)
+            if old_row is not None and version.hashes and version.hashes[old_row] == article_hash:
+                # Текст не изменился - переиспользуем вектор
+                vector = version.index.vector(old_row)
             else:
-                print("[ERROR] Не удалось создать embeddings")
+                # Правка администратора интерактивна: не ждём в очереди пакетных запросов
+                vector = self.llm.get_embedding(text)
+                if vector is None:
+                    raise RuntimeError("Не удалось получить embedding статьи")
+        
+        # Журнал пишем до публикации: опубликованная правка переживёт перезапуск
+        self.journal.append(op, article_id, article)
+        
+        alive = version.alive.copy() if version.alive is not None else np.ones(version.size, dtype=bool)
+        row_by_id = dict(row_by_id)
+        hashes = list(version.hashes or [''] * version.size)
+        index = version.index
+        
+        removed_rows, added_rows = [], []
+        if old_row is not None:
+            alive[old_row] = False
+            del row_by_id[article_id]
+            removed_rows.append(old_row)
+        
+        if article is not None:
+            row = store.append(article)
+            alive = np.append(alive, True)
+            row_by_id[article_id] = row
+            hashes.append(article_hash)
+            index = SegmentedIndex.extend(index, np.asarray([vector], dtype=np.float32))
+            added_rows.append(row)
+        
+        exact = version.exact.with_changes(store, removed_rows, added_rows) if version.exact is not None else None
+        
+        alive.flags.writeable = False
+        self._publish(KBVersion(
+            version.number + 1, store, index, MetadataIndex(store), hashes, alive, row_by_id, exact
+        ))
+        print(f"[OK] БЗ версии {version.number + 1}: {op} статьи {article_id} за {time.time() - start_time:.2f}s")
     
     def cosine_similarity(self, vec1, vec2):
         """Вычисляет косинусное сходство между двумя векторами"""
@@ -124,96 +1006,320 @@ class KnowledgeBase:
         norm2 = np.linalg.norm(vec2)
         return dot_product / (norm1 * norm2)
     
-    def search(self, query, top_k=SEARCH_TOP_K, category_filter=None):
+    def get_query_embedding(self, query):
+        """
+        Возвращает embedding запроса, используя кэш
+        
+        Returns:
+            list или None, если API не вернул embedding
+        """
+        import time
+        
+        query_hash = self._query_hash(query)
+        
+        cached = self.query_cache.get(query_hash)
+        if cached is not None:
+            print(f"[CACHE HIT] Embedding взят из кэша")
+            self.query_store.touch(query_hash.encode('ascii'))
+            return cached
+        
+        cached = self.query_store.get(query)
+        if cached is not None:
+            print(f"[CACHE HIT] Embedding взят из кэша на диске")
+            self.query_cache.set(query_hash, cached)
+            return cached
+        
+        start_time = time.time()
+        query_embedding = self.llm.get_embedding(query)
+        elapsed = time.time() - start_time
+        print(f"[API CALL] Embedding создан: {elapsed:.2f}s")
+        
+        if query_embedding is None:
+            return None
+        
+        # float32 вдвое компактнее в кэше, вытеснение - по LRU и TTL
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        self.query_cache.set(query_hash, query_embedding)
+        self._store_query_embeddings([(query, query_embedding)])
+        
+        return query_embedding
+    
+    def _query_hash(self, query):
+        """Ключ кэша embeddings запроса: модель и текст без различий в регистре и пробелах"""
+        return self.query_store.key(query).decode('ascii')
+    
+    def _store_query_embeddings(self, items):
+        try:
+            self.query_store.put_many(items)
+        except OSError as e:
+            print(f"[WARNING] Не удалось сохранить embeddings запросов на диск: {e}")
+    
+    def warm_up_query_cache(self, queries=(), limit=QUERY_CACHE_WARMUP_SIZE):
+        """
+        Прогревает кэш embeddings запросов при старте
+        
+        Самые частые запросы из кэша на диске загружаются в кэш в памяти,
+        а частые запросы из истории (queries), которых нет на диске,
+        векторизуются одним вызовом API.
+        
+        Args:
+            queries: Тексты запросов из истории обращений и отзывов (по убыванию частоты)
+            limit: Максимум запросов для прогрева
+        """
+        import time
+        
+        start_time = time.time()
+        frequent = self.query_store.most_frequent(limit)
+        self.query_cache.set_many((key.decode('ascii'), vector) for key, vector in frequent)
+        
+        queries = [query for query in dict.fromkeys(queries) if query][:limit]
+        missing = [query for query in queries if not self.query_store.contains(query)]
+        created = 0
+        if missing:
+            embeddings_list = self.llm.get_embeddings_batch(missing)
+            if embeddings_list:
+                items = [(query, np.asarray(embedding, dtype=np.float32)) for query, embedding in zip(missing, embeddings_list)]
+                self._store_query_embeddings(items)
+                self.query_cache.set_many((self._query_hash(query), embedding) for query, embedding in items)
+                created = len(items)
+        
+        print(f"[OK] Прогрев кэша embeddings запросов: {len(frequent)} с диска, {created} новых за {time.time() - start_time:.2f}s")
+    
+    def get_query_embeddings(self, queries):
+        """
+        Возвращает embeddings для списка запросов
+        
+        Запросы ищутся в кэше в памяти, затем на диске; остальные
+        векторизуются одним вызовом get_embeddings_batch.
+        
+        Returns:
+            list: Embedding для каждого запроса (None, если API не вернул embedding)
+        """
+        import time
+        
+        hashes = [self._query_hash(query) for query in queries]
+        embeddings = self.query_cache.get_many(hashes)
+        
+        # Уникальные запросы без embedding в кэше
+        missing = {}
+        for query, query_hash, embedding in zip(queries, hashes, embeddings):
+            if embedding is None and query_hash not in missing:
+                missing[query_hash] = query
+        
+        if missing:
+            from_disk = {
+                query_hash: embedding
+                for query_hash, embedding in zip(missing, self.query_store.get_many(list(missing.values())))
+                if embedding is not None
+            }
+            if from_disk:
+                self.query_cache.set_many(from_disk.items())
+                embeddings = [
+                    embedding if embedding is not None else from_disk.get(query_hash)
+                    for query_hash, embedding in zip(hashes, embeddings)
+                ]
+                missing = {query_hash: query for query_hash, query in missing.items() if query_hash not in from_disk}
+        
+        print(f"[CACHE] Batch: {len(queries) - len(missing)} из {len(queries)} embeddings взяты из кэша")
+        
+        if missing:
+            start_time = time.time()
+            batch = self.llm.get_embeddings_batch(list(missing.values()))
+            print(f"[API CALL] Batch embeddings ({len(missing)}): {time.time() - start_time:.2f}s")
+            
+            if batch:
+                fetched = dict(zip(missing, batch))
+                embeddings = [
+                    embedding if embedding is not None else fetched.get(query_hash)
+                    for query_hash, embedding in zip(hashes, embeddings)
+                ]
+                self.query_cache.set_many(fetched.items())
+                self._store_query_embeddings([(missing[query_hash], embedding) for query_hash, embedding in fetched.items()])
+        
+        return embeddings
+    
+    def _filter_mask(self, version, category_filter=None, subcategory_filter=None, audience_filter=None,
+                     priority_filter=None):
+        """
+        Объединённая маска фильтров по метаданным и актуальности статей версии
+        
+        Без фильтров возвращает сам version.alive (None, если все статьи актуальны).
+        """
+        mask = version.metadata.mask({
+            'main_category': category_filter,
+            'subcategory': subcategory_filter,
+            'target_audience': audience_filter,
+            'priority': priority_filter,
+        })
+        if mask is None or version.alive is None:
+            return version.alive if mask is None else mask
+        return mask & version.alive
+    
+    def _build_results(self, version, indices, similarities):
+        """Формирует словари результатов только для отобранных статей"""
+        return [
+            {
+                'article': version.articles[int(i)],
+                'similarity': float(similarity),
+                'rank': rank
+            }
+            for rank, (i, similarity) in enumerate(zip(indices, similarities), 1)
+        ]
+    
+    def search(self, query, top_k=SEARCH_TOP_K, category_filter=None, subcategory_filter=None,
+               audience_filter=None, priority_filter=None):
         """
         Ищет релевантные статьи по запросу
         
         Args:
             query: Текст запроса
             top_k: Количество результатов
-            category_filter: Фильтр по категории (опционально)
+            category_filter: Фильтр по категории (опционально, мягкое сравнение)
+            subcategory_filter: Фильтр по подкатегории (опционально, мягкое сравнение)
+            audience_filter: Фильтр по целевой аудитории (опционально, точное совпадение)
+            priority_filter: Фильтр по приоритету (опционально, точное совпадение)
             
         Returns:
             list: Список найденных статей с оценкой релевантности
         """
-        if not self.articles or self.embeddings is None:
+        version = self.version
+        if version is None or not version.size or version.index is None:
             return []
         
-        # Проверяем кэш embeddings
-        import hashlib
-        import time
+        query_embedding = self.get_query_embedding(query)
+        if query_embedding is None:
+            return []
         
-        query_hash = hashlib.md5(query.encode('utf-8')).hexdigest()
+        # ОПТИМИЗАЦИЯ: матрица индекса нормализована заранее,
+        # поэтому сходство со статьями - одно умножение матрицы на вектор
+        scores = version.index.score(query_embedding)
         
-        if query_hash in self.query_cache:
-            query_embedding = self.query_cache[query_hash]
-            print(f"[CACHE HIT] Embedding взят из кэша")
-        else:
-            start_time = time.time()
-            query_embedding = self.llm.get_embedding(query)
-            elapsed = time.time() - start_time
-            print(f"[API CALL] Embedding создан: {elapsed:.2f}s")
-            
-            if query_embedding is None:
-                return []
-            
-            # Сохраняем в кэш
-            self.query_cache[query_hash] = query_embedding
-            
-            # Ограничиваем размер кэша
-            if len(self.query_cache) > self.cache_limit:
-                # Удаляем самый старый элемент (первый добавленный)
-                oldest_key = next(iter(self.query_cache))
-                del self.query_cache[oldest_key]
-                print(f"[INFO] Кэш очищен, размер: {len(self.query_cache)}")
-        
-        query_vec = np.array(query_embedding)
-        
-        # ОПТИМИЗАЦИЯ: Векторизованное вычисление сходства для всех статей сразу
-        # Нормализуем векторы
-        query_norm = query_vec / np.linalg.norm(query_vec)
-        embeddings_norm = self.embeddings / np.linalg.norm(self.embeddings, axis=1, keepdims=True)
-        
-        # Вычисляем косинусное сходство для всех статей одновременно
-        all_similarities = np.dot(embeddings_norm, query_norm)
-        
-        # Применяем фильтры
-        similarities = []
-        for i, similarity in enumerate(all_similarities):
-            # Фильтр по порогу схожести
-            if similarity < SIMILARITY_THRESHOLD:
-                continue
+        # Применяем фильтры по порогу и метаданным как булевы маски
+        mask = self._filter_mask(version, category_filter, subcategory_filter, audience_filter, priority_filter)
+        
+        return self._build_results(version, *scores.top_k(top_k, SIMILARITY_THRESHOLD, mask))
+    
+    def search_batch(self, queries, top_k=SEARCH_TOP_K, category_filter=None, subcategory_filter=None,
+                     audience_filter=None, priority_filter=None):
+        """
+        Ищет релевантные статьи сразу для списка запросов
+        
+        Все запросы векторизуются одним вызовом API, а сходство считается
+        умножением матрицы запросов на матрицу индекса (блоками по
+        SEARCH_BATCH_CHUNK_SIZE запросов, чтобы ограничить память).
+        
+        Args:
+            queries: Список текстов запросов
+            top_k, *_filter: Как в search(), общие для всех запросов
             
-            article = self.articles[i]
-            
-            # Применяем фильтр по категории, если указан (мягкая фильтрация)
-            if category_filter:
-                article_category = article.get('main_category', article.get('category', ''))
-                # Проверяем частичное совпадение (нечувствительно к регистру)
-                category_filter_lower = category_filter.lower()
-                article_category_lower = article_category.lower()
-                
-                # Разбиваем на слова для более мягкого сравнения
-                filter_words = set(category_filter_lower.split())
-                article_words = set(article_category_lower.split())
-                
-                # Если есть хотя бы одно общее слово - считаем подходящим
-                if not (filter_words & article_words):
-                    # Нет общих слов - пропускаем только если категории сильно различаются
-                    if category_filter_lower not in article_category_lower and article_category_lower not in category_filter_lower:
-                        continue
-            
-            similarities.append({
-                'article': article,
-                'similarity': float(similarity),
-                'rank': len(similarities) + 1
-            })
+        Returns:
+            list: Для каждого запроса - список найденных статей (как в search())
+        """
+        if not queries:
+            return []
+        version = self.version
+        if version is None or not version.size or version.index is None:
+            return [[] for _ in queries]
+        
+        embeddings = self.get_query_embeddings(queries)
+        mask = self._filter_mask(version, category_filter, subcategory_filter, audience_filter, priority_filter)
+        
+        results = [[] for _ in queries]
+        valid = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+        
+        for start in range(0, len(valid), SEARCH_BATCH_CHUNK_SIZE):
+            chunk = valid[start:start + SEARCH_BATCH_CHUNK_SIZE]
+            chunk_scores = version.index.score_batch([embeddings[i] for i in chunk])
+            
+            for query_idx, scores in zip(chunk, chunk_scores):
+                results[query_idx] = self._build_results(version, *scores.top_k(top_k, SIMILARITY_THRESHOLD, mask))
+        
+        return results
+    
+    def search_with_fallback(self, query, top_k=SEARCH_TOP_K, category_filter=None, subcategory_filter=None,
+                             audience_filter=None, priority_filter=None):
+        """
+        Ищет с фильтрами и без них за одно вычисление сходства
+        
+        Embedding запроса берётся один раз, сходство со статьями считается
+        один раз, а из одного вектора сходства отбираются оба top_k.
+        
+        Returns:
+            tuple: (results_filtered, results_all)
+        """
+        return self.results_from_scores(self.score_query(query), top_k, category_filter, subcategory_filter,
+                                        audience_filter, priority_filter)
+    
+    def score_query(self, query):
+        """
+        Embedding запроса и его сходство со статьями текущей версии БЗ
+        
+        Фильтры применяются позже (results_from_scores), поэтому сходство можно
+        считать до того, как известна категория обращения.
+        
+        Returns:
+            tuple: (версия БЗ, QueryScores) или None, если искать не по чему
+        """
+        version = self.version
+        if version is None or not version.size or version.index is None:
+            return None
+        
+        query_embedding = self.get_query_embedding(query)
+        if query_embedding is None:
+            return None
+        
+        return version, version.index.score(query_embedding)
+    
+    def results_from_scores(self, scored, top_k=SEARCH_TOP_K, category_filter=None, subcategory_filter=None,
+                            audience_filter=None, priority_filter=None):
+        """
+        Результаты с фильтрами и без них по уже посчитанному сходству (score_query)
+        
+        Returns:
+            tuple: (results_filtered, results_all)
+        """
+        if scored is None:
+            return [], []
+        version, scores = scored
+        
+        mask = self._filter_mask(version, category_filter, subcategory_filter, audience_filter, priority_filter)
+        results_all = self._build_results(version, *scores.top_k(top_k, SIMILARITY_THRESHOLD, version.alive))
+        
+        if mask is version.alive:
+            # Без фильтров оба набора совпадают
+            return results_all, [dict(r) for r in results_all]
+        
+        return self._build_results(version, *scores.top_k(top_k, SIMILARITY_THRESHOLD, mask)), results_all
+    
+    @staticmethod
+    def select_results(results_filtered, results_all, min_similarity=FILTERED_SEARCH_MIN_SIMILARITY):
+        """
+        Политика выбора между результатами с фильтром и без него
+        
+        Результаты с фильтром используются, если лучшее совпадение не ниже
+        min_similarity. Иначе берутся результаты без фильтра, когда они лучше.
+        
+        Returns:
+            tuple: (results, used_filter)
+        """
+        best_similarity_filtered = results_filtered[0]['similarity'] if results_filtered else 0
+        
+        if results_filtered and best_similarity_filtered >= min_similarity:
+            return results_filtered, True
+        
+        if results_filtered:
+            print(f"[SEARCH] Низкое совпадение с фильтром ({best_similarity_filtered*100:.0f}%), пробуем без фильтра...")
+        else:
+            print(f"[SEARCH] Нет результатов с фильтром, пробуем без фильтра...")
         
-        # Сортируем по убыванию схожести
-        similarities.sort(key=lambda x: x['similarity'], reverse=True)
+        # Если без фильтра результаты лучше - используем их
+        if results_all:
+            best_similarity_all = results_all[0]['similarity']
+            if not results_filtered or best_similarity_all > best_similarity_filtered:
+                print(f"[SEARCH] Используем результаты БЕЗ фильтра (лучшее совпадение: {best_similarity_all*100:.0f}%)")
+                return results_all, False
         
-        # Возвращаем top_k результатов
-        return similarities[:top_k]
+        return results_filtered, True
     
     def format_search_results(self, results):
         """Форматирует результаты поиска для отображения"""
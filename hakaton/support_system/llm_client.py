@@ -2,13 +2,205 @@
 Клиент для работы с SciBox LLM API
 """
 
-from openai import OpenAI
-from config import SCIBOX_API_KEY, SCIBOX_BASE_URL, CHAT_MODEL, EMBEDDING_MODEL
-import time
+from openai import OpenAI, AsyncOpenAI
+from config import (
+    SCIBOX_API_KEY, SCIBOX_BASE_URL, CHAT_MODEL, EMBEDDING_MODEL,
+    EMBEDDING_CHUNK_SIZE, EMBEDDING_MAX_CONCURRENCY, EMBEDDING_CHUNK_RETRIES,
+    LLM_POOL_MAX_CONNECTIONS, LLM_POOL_MAX_KEEPALIVE, LLM_KEEPALIVE_EXPIRY, LLM_REQUEST_TIMEOUT, LLM_CONNECT_TIMEOUT,
+    LLM_RETRY_MAX_ATTEMPTS, EMBEDDING_RETRY_DEADLINE, EMBEDDING_BATCH_MAX_RETRY_DELAY, EMBEDDING_MICROBATCH_WAIT,
+    LLM_SINGLE_FLIGHT
+)
+from embedding_batcher import EmbeddingBatcher
+from single_flight import SingleFlight, request_key
+from retry_policy import RetryPolicy, APIError, RateLimitError, ServerError
+from rate_limiter import get_rate_limiter, estimate_tokens, ThrottleTimeoutError, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+import asyncio
+import atexit
+import hashlib
+import os
+import threading
+import weakref
+
+try:
+    import httpx
+except ImportError:  # Без httpx клиенты OpenAI создают пул с настройками по умолчанию
+    httpx = None
+
+# Общие клиенты OpenAI: один пул соединений на API ключ для всех модулей
+_clients_lock = threading.Lock()
+_sync_clients = {}  # API ключ -> OpenAI
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> {API ключ -> AsyncOpenAI}
+_batchers = {}  # API ключ -> EmbeddingBatcher
+_single_flights = {}  # API ключ -> SingleFlight
+
+
+def _http_client_options():
+    return {
+        'limits': httpx.Limits(
+            max_connections=LLM_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+        ),
+        'timeout': httpx.Timeout(LLM_REQUEST_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+    }
+
+
+def get_openai_client(api_key):
+    """Синхронный клиент OpenAI с общим пулом keep-alive соединений для API ключа"""
+    with _clients_lock:
+        client = _sync_clients.get(api_key)
+        if client is None:
+            http_client = httpx.Client(**_http_client_options()) if httpx is not None else None
+            client = _sync_clients[api_key] = OpenAI(
+                api_key=api_key,
+                base_url=SCIBOX_BASE_URL,
+                timeout=LLM_REQUEST_TIMEOUT,
+                max_retries=0,  # Повторы - по RetryPolicy
+                http_client=http_client
+            )
+        return client
+
+
+def get_async_openai_client(api_key):
+    """
+    Асинхронный клиент OpenAI для API ключа в текущем event loop
+    
+    Асинхронный пул соединений привязан к event loop, поэтому клиенты
+    общие в пределах одного loop. Перед завершением loop их соединения
+    нужно закрыть: await aclose_clients().
+    """
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(api_key)
+        if client is None:
+            http_client = httpx.AsyncClient(**_http_client_options()) if httpx is not None else None
+            client = clients[api_key] = AsyncOpenAI(
+                api_key=api_key,
+                base_url=SCIBOX_BASE_URL,
+                timeout=LLM_REQUEST_TIMEOUT,
+                max_retries=0,
+                http_client=http_client
+            )
+        return client
+
+
+async def aclose_clients():
+    """Закрывает асинхронные клиенты текущего event loop"""
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = list(_async_clients.pop(loop, {}).values())
+    for client in clients:
+        try:
+            await client.close()
+        except Exception:
+            pass
+
+
+def validate_api_key(api_key):
+    """
+    Проверка API ключа временным клиентом
+    
+    Клиент закрывается сразу после проверки, поэтому неверные ключи
+    (например, из попыток /api/init) не оставляют пулов соединений в
+    общих клиентах.
+    
+    Returns:
+        tuple: (bool, str) - (успех, сообщение об ошибке если есть)
+    """
+    with OpenAI(api_key=api_key, base_url=SCIBOX_BASE_URL, timeout=LLM_REQUEST_TIMEOUT, max_retries=0) as client:
+        return _check_key(client)
+
+
+def _check_key(client):
+    """Тестовый запрос embedding клиентом: (успех, сообщение об ошибке)"""
+    try:
+        # Пробуем получить embedding для короткой строки
+        client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input="test"
+        )
+        # Если дошли сюда - ключ рабочий
+        return (True, None)
+    except Exception as e:
+        error_msg = str(e)
+        # Проверяем типичные ошибки API ключа
+        if "401" in error_msg or "Unauthorized" in error_msg or "invalid" in error_msg.lower():
+            return (False, "Неверный API ключ")
+        elif "403" in error_msg or "Forbidden" in error_msg:
+            return (False, "API ключ не имеет необходимых прав доступа")
+        elif "connection" in error_msg.lower() or "timeout" in error_msg.lower():
+            return (False, "Не удалось подключиться к API. Проверьте интернет-соединение")
+        else:
+            return (False, f"Ошибка проверки ключа: {error_msg}")
+
+
+def get_embedding_batcher(api_key, embed_many):
+    """Общий для API ключа сборщик одновременных get_embedding в пакеты"""
+    with _clients_lock:
+        batcher = _batchers.get(api_key)
+        if batcher is None:
+            batcher = _batchers[api_key] = EmbeddingBatcher(embed_many)
+        return batcher
+
+
+def batcher_stats():
+    """Сколько embedding-запросов собрано в пакеты и средний размер пакета"""
+    with _clients_lock:
+        batchers = list(_batchers.values())
+    stats = {'texts': 0, 'batches': 0}
+    for batcher in batchers:
+        batcher_stat = batcher.stats()
+        stats['texts'] += batcher_stat['texts']
+        stats['batches'] += batcher_stat['batches']
+    stats['avg_batch'] = round(stats['texts'] / stats['batches'], 2) if stats['batches'] else 0
+    return stats
+
+
+def get_single_flight(api_key):
+    """Общие для API ключа выполняемые запросы (single-flight)"""
+    with _clients_lock:
+        single_flight = _single_flights.get(api_key)
+        if single_flight is None:
+            single_flight = _single_flights[api_key] = SingleFlight()
+        return single_flight
+
+
+def single_flight_stats():
+    """Сколько вызовов получили результат уже выполнявшегося запроса"""
+    with _clients_lock:
+        single_flights = list(_single_flights.values())
+    stats = {'calls': 0, 'shared': 0, 'in_flight': 0}
+    for single_flight in single_flights:
+        for name, value in single_flight.stats().items():
+            stats[name] += value
+    return stats
+
+
+@atexit.register
+def close_clients():
+    """Закрывает соединения синхронных клиентов"""
+    with _clients_lock:
+        clients = list(_sync_clients.values())
+        _sync_clients.clear()
+    for client in clients:
+        try:
+            client.close()
+        except Exception:
+            pass
 
 
 class LLMClient:
-    """Клиент для взаимодействия с LLM моделями"""
+    """
+    Клиент для взаимодействия с LLM моделями
+    
+    Экземпляры с одним API ключом используют общий клиент OpenAI и его пул
+    keep-alive соединений. Синхронные методы работают как раньше, для
+    asyncio есть методы с префиксом a (agenerate_response, aget_embedding,
+    aget_embeddings). Одновременные get_embedding с одним ключом
+    отправляются одним запросом (EmbeddingBatcher), а одинаковые
+    одновременные запросы выполняются один раз (SingleFlight).
+    """
     
     def __init__(self, api_key=None):
         # Используем переданный ключ или из конфига
@@ -16,10 +208,15 @@ class LLMClient:
         if not key:
             raise ValueError("API ключ не установлен. Передайте api_key или установите в config.")
         
-        self.client = OpenAI(
-            api_key=key,
-            base_url=SCIBOX_BASE_URL
-        )
+        self.api_key = key
+        self.client = get_openai_client(key)
+        self.embedding_batcher = get_embedding_batcher(key, self._embed_texts) if EMBEDDING_MICROBATCH_WAIT > 0 else None
+        self.single_flight = get_single_flight(key) if LLM_SINGLE_FLIGHT else None
+    
+    @property
+    def async_client(self):
+        """Асинхронный клиент для текущего event loop"""
+        return get_async_openai_client(self.api_key)
     
     def validate_key(self):
         """
@@ -29,131 +226,332 @@ class LLMClient:
         Returns:
             tuple: (bool, str) - (успех, сообщение об ошибке если есть)
         """
-        try:
-            # Пробуем получить embedding для короткой строки
-            response = self.client.embeddings.create(
-                model=EMBEDDING_MODEL,
-                input="test"
-            )
-            # Если дошли сюда - ключ рабочий
-            return (True, None)
-        except Exception as e:
-            error_msg = str(e)
-            # Проверяем типичные ошибки API ключа
-            if "401" in error_msg or "Unauthorized" in error_msg or "invalid" in error_msg.lower():
-                return (False, "Неверный API ключ")
-            elif "403" in error_msg or "Forbidden" in error_msg:
-                return (False, "API ключ не имеет необходимых прав доступа")
-            elif "connection" in error_msg.lower() or "timeout" in error_msg.lower():
-                return (False, "Не удалось подключиться к API. Проверьте интернет-соединение")
-            else:
-                return (False, f"Ошибка проверки ключа: {error_msg}")
-    
-    def generate_response(self, messages, temperature=0.3, max_tokens=500, max_retries=2, progress_callback=None):
+        return _check_key(self.client)
+    
+    @staticmethod
+    def _timeout_kwargs(timeout):
+        # timeout=None в запросе OpenAI отключил бы таймаут клиента, поэтому передаём только заданный
+        return {} if timeout is None else {'timeout': timeout}
+    
+    @staticmethod
+    def _throttle(kind, tokens, priority, timeout):
+        """
+        Ждёт бюджет запросов и токенов (rate_limiter) перед запросом к API
+        
+        Returns:
+            float: Таймаут для самого запроса - timeout за вычетом ожидания (None - без ограничения)
+        
+        Raises:
+            ThrottleTimeoutError: Ожидание бюджета заняло всё время до дедлайна
+        """
+        waited = get_rate_limiter(kind).acquire(tokens, priority, timeout)
+        if waited > 0.05:
+            print(f"[RATE LIMIT] {kind}: ожидание бюджета {waited:.2f}s")
+        if timeout is None:
+            return None
+        remaining = timeout - waited
+        if remaining <= 0.001:
+            raise ThrottleTimeoutError(f"Бюджет запросов {kind} освободился слишком поздно ({waited:.1f}s из {timeout:.1f}s)")
+        return remaining
+    
+    @staticmethod
+    def _chat_tokens(messages, max_tokens):
+        return sum(estimate_tokens(message.get('content') or '') for message in messages) + max_tokens
+    
+    @staticmethod
+    def _error_result(error):
+        """Ошибка API -> результат generate_response для обработки на уровне API"""
+        print(f"[ERROR] Ошибка при генерации ответа ({error.kind}, попыток: {error.attempts}): {error}")
+        if isinstance(error, RateLimitError):
+            return {
+                'error': 'rate_limit',
+                'message': 'API перегружен',
+                'attempts': error.attempts,
+                'retry_after': error.retry_after
+            }
+        return None
+    
+    def generate_response(self, messages, temperature=0.3, max_tokens=500, max_retries=LLM_RETRY_MAX_ATTEMPTS - 1,
+                          progress_callback=None, deadline=None, priority=PRIORITY_INTERACTIVE):
         """
-        Генерирует ответ от чат-модели с retry при перегрузке
+        Генерирует ответ от чат-модели с повторами при временных ошибках
+        
+        Повторы - по RetryPolicy: экспоненциальная задержка с jitter и
+        Retry-After сервера. Если следующая попытка не помещается в дедлайн
+        (LLM_RETRY_DEADLINE), ошибка возвращается сразу, без ожидания.
+        Одновременные вызовы с теми же сообщениями и параметрами ждут
+        первый и получают его ответ (progress_callback - только у первого).
         
         Args:
             messages: Список сообщений в формате OpenAI
             temperature: Температура генерации (0-1)
             max_tokens: Максимальное количество токенов
-            max_retries: Количество повторных попыток при 429
+            max_retries: Количество повторных попыток
             progress_callback: Функция для отслеживания прогресса (опционально)
+            deadline: Время на запрос вместе с повторами, секунды (по умолчанию LLM_RETRY_DEADLINE)
+            priority: Приоритет в очереди ограничителя частоты (PRIORITY_INTERACTIVE / PRIORITY_BATCH)
             
         Returns:
             str или dict: Сгенерированный ответ или информация об ошибке
         """
-        # Прогрессивное увеличение времени ожидания: 10, 20, 30 секунд
-        wait_times = [10, 20, 30]
+        tokens = self._chat_tokens(messages, max_tokens)
+        
+        def request(timeout):
+            timeout = self._throttle('chat', tokens, priority, timeout)
+            response = self.client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                **self._timeout_kwargs(timeout)
+            )
+            return response.choices[0].message.content
         
-        for attempt in range(max_retries + 1):
+        def on_retry(attempt, delay, error):
+            print(f"[RETRY] {error.kind}: ожидание {delay:.1f}s... (попытка {attempt}/{max_retries})")
+            
+            # Если передан callback, уведомляем о состоянии
+            if progress_callback and isinstance(error, RateLimitError):
+                progress_callback({
+                    'status': 'rate_limited',
+                    'attempt': attempt,
+                    'max_retries': max_retries,
+                    'wait_time': delay
+                })
+        
+        def call():
             try:
-                response = self.client.chat.completions.create(
-                    model=CHAT_MODEL,
-                    messages=messages,
-                    temperature=temperature,
-                    max_tokens=max_tokens
-                )
-                return response.choices[0].message.content
-            except Exception as e:
-                error_str = str(e)
-                # Проверяем на 429 (Rate Limit)
-                if "429" in error_str and attempt < max_retries:
-                    # Используем прогрессивное время ожидания
-                    wait_time = wait_times[attempt] if attempt < len(wait_times) else 30
-                    
-                    print(f"[RETRY] API перегружен, ожидание {wait_time}s... (попытка {attempt + 1}/{max_retries})")
-                    
-                    # Если передан callback, уведомляем о состоянии
-                    if progress_callback:
-                        progress_callback({
-                            'status': 'rate_limited',
-                            'attempt': attempt + 1,
-                            'max_retries': max_retries,
-                            'wait_time': wait_time
-                        })
-                    
-                    time.sleep(wait_time)
-                    continue
-                
-                print(f"[ERROR] Ошибка при генерации ответа: {e}")
-                
-                # Возвращаем информацию об ошибке для обработки на уровне API
-                if "429" in error_str:
-                    return {
-                        'error': 'rate_limit',
-                        'message': 'API перегружен',
-                        'attempts': attempt + 1
-                    }
-                
-                return None
+                return RetryPolicy(max_attempts=max_retries + 1).call(request, on_retry, deadline)
+            except APIError as e:
+                return self._error_result(e)
+        
+        if self.single_flight is None:
+            return call()
+        return self.single_flight.do(request_key('chat', CHAT_MODEL, messages, temperature, max_tokens), call)
+    
+    async def agenerate_response(self, messages, temperature=0.3, max_tokens=500, max_retries=LLM_RETRY_MAX_ATTEMPTS - 1,
+                                 deadline=None, priority=PRIORITY_INTERACTIVE):
+        """Асинхронный generate_response: ожидание перед повтором не блокирует поток"""
+        tokens = self._chat_tokens(messages, max_tokens)
         
-        print(f"[ERROR] Превышено количество попыток ({max_retries})")
+        async def request(timeout):
+            timeout = await asyncio.to_thread(self._throttle, 'chat', tokens, priority, timeout)
+            response = await self.async_client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                **self._timeout_kwargs(timeout)
+            )
+            return response.choices[0].message.content
+        
+        def on_retry(attempt, delay, error):
+            print(f"[RETRY] {error.kind}: ожидание {delay:.1f}s... (попытка {attempt}/{max_retries})")
+        
+        async def call():
+            try:
+                return await RetryPolicy(max_attempts=max_retries + 1).acall(request, on_retry, deadline)
+            except APIError as e:
+                return self._error_result(e)
         
-        # Возвращаем информацию о превышении лимита попыток
-        return {
-            'error': 'max_retries_exceeded',
-            'message': f'API перегружен. Превышено количество попыток ({max_retries})',
-            'attempts': max_retries + 1
-        }
+        if self.single_flight is None:
+            return await call()
+        return await self.single_flight.ado(request_key('chat', CHAT_MODEL, messages, temperature, max_tokens), call)
     
-    def get_embedding(self, text):
+    def get_embedding(self, text, priority=PRIORITY_INTERACTIVE):
         """
         Получает векторное представление текста
         
+        Одновременные интерактивные вызовы собираются в один запрос (микро-пакет,
+        EMBEDDING_MICROBATCH_WAIT), одинаковые тексты запрашиваются один раз.
+        Временные ошибки повторяются в пределах EMBEDDING_RETRY_DEADLINE.
+        
         Args:
             text: Текст для векторизации
+            priority: Приоритет в очереди ограничителя частоты
             
         Returns:
             list: Вектор эмбеддинга
         """
+        def call():
+            if self.embedding_batcher is not None and priority == PRIORITY_INTERACTIVE:
+                return self.embedding_batcher.embed(text)
+            return self._embed_texts([text], priority)[0]
+        
         try:
+            if self.single_flight is None:
+                return call()
+            return self.single_flight.do(request_key('embeddings', EMBEDDING_MODEL, text), call)
+        except APIError as e:
+            print(f"[ERROR] Ошибка при получении эмбеддинга ({e.kind}, попыток: {e.attempts}): {e}")
+            return None
+    
+    def _embed_texts(self, texts, priority=PRIORITY_INTERACTIVE):
+        """
+        Векторы текстов одним запросом с ограничением частоты и повторами
+        
+        Raises:
+            APIError: Если запрос не удался
+        """
+        tokens = sum(estimate_tokens(text) for text in texts)
+        
+        def request(timeout):
+            timeout = self._throttle('embeddings', tokens, priority, timeout)
             response = self.client.embeddings.create(
                 model=EMBEDDING_MODEL,
-                input=text
+                input=list(texts),
+                **self._timeout_kwargs(timeout)
+            )
+            vectors = [item.embedding for item in response.data]
+            if len(vectors) != len(texts):
+                raise ServerError(f"API вернул {len(vectors)} векторов вместо {len(texts)}")
+            return vectors
+        
+        return RetryPolicy(deadline=EMBEDDING_RETRY_DEADLINE).call(request, self._log_embedding_retry)
+    
+    @staticmethod
+    def _log_embedding_retry(attempt, delay, error):
+        print(f"[RETRY] Embedding, {error.kind}: повтор через {delay:.1f}s (попытка {attempt})")
+    
+    async def aget_embedding(self, text, priority=PRIORITY_INTERACTIVE):
+        """Асинхронный get_embedding"""
+        embeddings = await self.aget_embeddings([text], priority)
+        return embeddings[0] if embeddings else None
+    
+    async def aget_embeddings(self, texts, priority=PRIORITY_INTERACTIVE):
+        """
+        Векторные представления списка текстов одним асинхронным запросом
+        
+        Returns:
+            list: Векторы в порядке texts или None при ошибке
+        """
+        if not texts:
+            return []
+        
+        tokens = sum(estimate_tokens(text) for text in texts)
+        
+        async def request(timeout):
+            timeout = await asyncio.to_thread(self._throttle, 'embeddings', tokens, priority, timeout)
+            response = await self.async_client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=list(texts),
+                **self._timeout_kwargs(timeout)
             )
-            return response.data[0].embedding
-        except Exception as e:
-            print(f"[ERROR] Ошибка при получении эмбеддинга: {e}")
+            return [item.embedding for item in response.data]
+        
+        def call():
+            return RetryPolicy(deadline=EMBEDDING_RETRY_DEADLINE).acall(request, self._log_embedding_retry)
+        
+        try:
+            if self.single_flight is None:
+                return await call()
+            return await self.single_flight.ado(request_key('embeddings', EMBEDDING_MODEL, texts), call)
+        except APIError as e:
+            print(f"[ERROR] Ошибка при получении эмбеддингов ({e.kind}, попыток: {e.attempts}): {e}")
             return None
     
-    def get_embeddings_batch(self, texts):
+    def get_embeddings_batch(self, texts, chunk_size=EMBEDDING_CHUNK_SIZE, max_concurrency=EMBEDDING_MAX_CONCURRENCY,
+                             max_retries=EMBEDDING_CHUNK_RETRIES, checkpoint_dir=None, priority=PRIORITY_BATCH):
         """
         Получает векторные представления для списка текстов
         
+        Тексты отправляются чанками по chunk_size, одновременно выполняется
+        не больше max_concurrency запросов. Каждый чанк повторяется при ошибке,
+        а готовые чанки сохраняются в checkpoint_dir, поэтому прерванный
+        запуск продолжается с места остановки.
+        
         Args:
             texts: Список текстов
+            chunk_size: Текстов в одном запросе к API
+            max_concurrency: Максимум одновременных запросов
+            max_retries: Повторных попыток для каждого чанка
+            checkpoint_dir: Папка для готовых чанков (опционально)
+            priority: Приоритет в очереди ограничителя частоты (по умолчанию - после интерактивных запросов)
             
         Returns:
-            list: Список векторов эмбеддингов
+            list: Список векторов эмбеддингов (float32) или None, если какой-то чанк не удалось получить
         """
-        try:
-            response = self.client.embeddings.create(
-                model=EMBEDDING_MODEL,
-                input=texts
-            )
-            return [item.embedding for item in response.data]
-        except Exception as e:
-            print(f"[ERROR] Ошибка при получении эмбеддингов: {e}")
+        from concurrent.futures import ThreadPoolExecutor
+        import numpy as np
+        
+        if not texts:
+            return []
+        
+        chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+        results = [None] * len(chunks)
+        # Пакетное создание embeddings может ждать дольше запросов пользователей: без дедлайна
+        chunk_policy = RetryPolicy(max_attempts=max_retries + 1, max_delay=EMBEDDING_BATCH_MAX_RETRY_DELAY, deadline=None)
+        
+        if checkpoint_dir:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+        
+        def chunk_path(chunk):
+            if not checkpoint_dir:
+                return None
+            digest = hashlib.sha1(EMBEDDING_MODEL.encode('utf-8'))
+            for text in chunk:
+                digest.update(b'\0' + text.encode('utf-8'))
+            return os.path.join(checkpoint_dir, f"{digest.hexdigest()}.npy")
+        
+        def embed_chunk(i):
+            chunk = chunks[i]
+            path = chunk_path(chunk)
+            
+            if path and os.path.exists(path):
+                try:
+                    results[i] = np.load(path)
+                    return True
+                except Exception as e:
+                    print(f"[WARNING] Повреждённый чекпоинт чанка {i + 1}: {e}")
+            
+            def request(timeout):
+                timeout = self._throttle('embeddings', sum(estimate_tokens(text) for text in chunk), priority, timeout)
+                response = self.client.embeddings.create(
+                    model=EMBEDDING_MODEL,
+                    input=chunk,
+                    **self._timeout_kwargs(timeout)
+                )
+                vectors = np.asarray([item.embedding for item in response.data], dtype=np.float32)
+                if len(vectors) != len(chunk):
+                    raise ServerError(f"API вернул {len(vectors)} векторов вместо {len(chunk)}")
+                return vectors
+            
+            def on_retry(attempt, delay, error):
+                print(f"[RETRY] Чанк {i + 1}/{len(chunks)}: {error}. Повтор через {delay:.1f}s...")
+            
+            try:
+                vectors = chunk_policy.call(request, on_retry)
+            except APIError as e:
+                print(f"[ERROR] Чанк {i + 1}/{len(chunks)} не получен после {e.attempts} попыток: {e}")
+                return False
+            
+            if path:
+                tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+                np.save(tmp_path, vectors)
+                os.replace(tmp_path, path)
+            
+            results[i] = vectors
+            print(f"[EMBEDDINGS] Чанк {i + 1}/{len(chunks)} готов ({len(chunk)} текстов)")
+            return True
+        
+        if len(chunks) == 1:
+            ok = [embed_chunk(0)]
+        else:
+            with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+                ok = list(executor.map(embed_chunk, range(len(chunks))))
+        
+        if not all(ok):
+            done = sum(ok)
+            print(f"[ERROR] Ошибка при получении эмбеддингов: готово {done} из {len(chunks)} чанков"
+                  + (", прогресс сохранён" if checkpoint_dir else ""))
             return None
-
+        
+        # Все чанки готовы - чекпоинты больше не нужны
+        if checkpoint_dir:
+            for chunk in chunks:
+                try:
+                    os.remove(chunk_path(chunk))
+                except OSError:
+                    pass
+        
+        return [vector for vectors in results for vector in vectors]
@@ -0,0 +1,182 @@
+"""
+Локальный классификатор обращений по embeddings статей базы знаний
+
+Категория определяется голосованием k ближайших статей (kNN) в том же
+индексе, что и поиск: одно умножение матрицы на вектор вместо вызова
+чат-модели. Embedding запроса берётся из кэша KnowledgeBase, поэтому
+последующий поиск по тому же тексту не обращается к API повторно.
+
+Доля голосов калибруется по базе знаний: каждая статья из выборки
+классифицируется по остальным (leave-one-out), и для интервалов доли
+голосов запоминается доля верных ответов. Эта точность и возвращается
+как уверенность. Калибровка выполняется при первой классификации (или
+явно через calibrated()), поэтому классификатор, нужный только как
+запасной при перегрузке API, не замедляет запуск.
+"""
+
+import threading
+
+import numpy as np
+
+from config import (
+    LOCAL_CLASSIFIER_K, LOCAL_CLASSIFIER_TEMPERATURE, LOCAL_CLASSIFIER_MIN_CONFIDENCE,
+    LOCAL_CLASSIFIER_CALIBRATION_SAMPLE, SEARCH_BATCH_CHUNK_SIZE
+)
+
+
+class LocalClassifier:
+    """kNN-классификатор по статьям актуальной версии базы знаний"""
+
+    CALIBRATION_BINS = 10
+
+    def __init__(self, knowledge_base, k=LOCAL_CLASSIFIER_K, temperature=LOCAL_CLASSIFIER_TEMPERATURE,
+                 calibration_sample=LOCAL_CLASSIFIER_CALIBRATION_SAMPLE):
+        self.knowledge_base = knowledge_base
+        self.k = k
+        self.temperature = temperature
+        self.calibration_sample = calibration_sample
+        # Точность по интервалам доли голосов (None - без калибровки); считается при первом обращении
+        self._calibration = None
+        self._calibrated = not calibration_sample
+        self._calibration_lock = threading.Lock()
+    
+    def calibrated(self):
+        """Калибровка (выполняется один раз при первом вызове)"""
+        if not self._calibrated:
+            with self._calibration_lock:
+                if not self._calibrated:
+                    self._calibration = self.calibrate(self.calibration_sample)
+                    self._calibrated = True
+        return self._calibration
+    
+    @property
+    def calibration(self):
+        """Точность по интервалам доли голосов или None (калибрует при первом обращении)"""
+        return self.calibrated()
+
+    def _vote(self, version, scores, exclude_row=None):
+        """
+        Голосование ближайших статей
+
+        Голос статьи - exp((сходство - лучшее сходство) / temperature),
+        поэтому почти равные соседи голосуют почти одинаково, а далёкие не влияют.
+
+        Returns:
+            tuple: (номер категории, доля голосов, строки соседей, их сходство) или None
+        """
+        k = self.k + (exclude_row is not None)
+        rows, similarities = scores.top_k(k, -np.inf, version.alive)
+        if exclude_row is not None:
+            keep = rows != exclude_row
+            rows, similarities = rows[keep][:self.k], similarities[keep][:self.k]
+        if len(rows) == 0:
+            return None
+
+        weights = np.exp((similarities - similarities[0]) / self.temperature)
+        category_codes = version.metadata.codes['main_category'][rows]
+        votes = np.bincount(category_codes, weights=weights)
+        category = int(np.argmax(votes))
+        return category, float(votes[category] / weights.sum()), rows, similarities
+
+    def calibrate(self, sample_size, seed=0):
+        """
+        Калибровка доли голосов по статьям базы знаний (leave-one-out)
+
+        Returns:
+            np.ndarray: Доля верных ответов для каждого интервала доли голосов или None
+        """
+        version = self.knowledge_base.version
+        if version is None or version.index is None or not version.size:
+            return None
+
+        rows = np.flatnonzero(version.alive) if version.alive is not None else np.arange(version.size)
+        if len(rows) < 2:
+            return None
+        if len(rows) > sample_size:
+            rows = np.sort(np.random.default_rng(seed).choice(rows, sample_size, replace=False))
+
+        category_codes = version.metadata.codes['main_category']
+        shares = []
+        correct = []
+        for start in range(0, len(rows), SEARCH_BATCH_CHUNK_SIZE):
+            chunk = rows[start:start + SEARCH_BATCH_CHUNK_SIZE]
+            vectors = np.stack([version.index.vector(int(row)) for row in chunk])
+            for row, scores in zip(chunk, version.index.score_batch(vectors)):
+                vote = self._vote(version, scores, exclude_row=row)
+                if vote is not None:
+                    shares.append(vote[1])
+                    correct.append(vote[0] == category_codes[row])
+
+        if not shares:
+            return None
+
+        bins = np.minimum((np.asarray(shares) * self.CALIBRATION_BINS).astype(int), self.CALIBRATION_BINS - 1)
+        hits = np.bincount(bins, weights=np.asarray(correct, dtype=np.float64), minlength=self.CALIBRATION_BINS)
+        totals = np.bincount(bins, minlength=self.CALIBRATION_BINS)
+        # Сглаживание Лапласа для редких интервалов, точность не убывает с долей голосов
+        accuracy = np.maximum.accumulate((hits + 1) / (totals + 2))
+
+        print(f"[OK] Локальный классификатор откалиброван на {len(shares)} статьях "
+              f"(точность leave-one-out: {np.mean(correct)*100:.0f}%)")
+        return accuracy
+
+    def confidence(self, share):
+        """Калиброванная уверенность для доли голосов"""
+        calibration = self.calibrated()
+        if calibration is None:
+            return share
+        return float(calibration[min(int(share * self.CALIBRATION_BINS), self.CALIBRATION_BINS - 1)])
+
+    @staticmethod
+    def confidence_label(confidence, min_confidence=LOCAL_CLASSIFIER_MIN_CONFIDENCE):
+        if confidence >= min_confidence:
+            return "высокая"
+        if confidence >= min_confidence / 2:
+            return "средняя"
+        return "низкая"
+
+    def classify_and_extract(self, ticket_text):
+        """
+        Классификация в формате TicketClassifier.classify_and_extract
+
+        Returns:
+            dict с дополнительными полями confidence_score (калиброванная
+            уверенность 0..1) и classifier='local', или None, если нет
+            embedding запроса или статей
+        """
+        version = self.knowledge_base.version
+        if version is None or version.index is None or not version.size:
+            return None
+
+        query_embedding = self.knowledge_base.get_query_embedding(ticket_text)
+        if query_embedding is None:
+            return None
+
+        vote = self._vote(version, version.index.score(query_embedding))
+        if vote is None:
+            return None
+        category, share, rows, similarities = vote
+
+        # Подкатегория и приоритет - по соседям из выбранной категории
+        in_category = version.metadata.codes['main_category'][rows] == category
+        rows, similarities = rows[in_category], similarities[in_category]
+        weights = np.exp((similarities - similarities[0]) / self.temperature)
+        subcategory_codes = version.metadata.codes['subcategory'][rows]
+        subcategory = version.metadata.values['subcategory'][int(np.argmax(np.bincount(subcategory_codes, weights=weights)))]
+        best = version.articles[int(rows[0])]
+
+        confidence = self.confidence(share)
+        return {
+            "category": version.metadata.values['main_category'][category],
+            "subcategory": subcategory,
+            "confidence": self.confidence_label(confidence),
+            "confidence_score": round(confidence, 3),
+            "reasoning": f"Локальный классификатор: {share*100:.0f}% голосов {self.k} ближайших статей БЗ",
+            "key_info": {
+                "main_issue": ticket_text[:100],
+                "urgency": best.get('priority', 'Средний'),
+                "sentiment": "нейтральное",
+                "key_details": []
+            },
+            "classifier": "local"
+        }
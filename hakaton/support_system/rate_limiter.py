@@ -0,0 +1,280 @@
+"""
+Ограничение частоты запросов к API на стороне клиента
+
+Для каждого вида запросов (chat, embeddings) есть две корзины токенов:
+число запросов и число токенов в минуту. Запрос ждёт, пока в обеих
+корзинах хватит бюджета, поэтому собственный трафик сглаживается ниже
+квоты API вместо повторов после 429.
+
+Ожидающие запросы образуют ограниченную очередь с приоритетами:
+интерактивные запросы (обработка обращений) обслуживаются раньше пакетных
+(создание embeddings БЗ, пакетный поиск). Корзины хранятся в памяти
+процесса или в файле SQLite, общем для всех воркеров (очередь - своя у
+каждого процесса).
+"""
+
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+from retry_policy import RateLimitError
+from config import (
+    RATE_LIMITS, RATE_LIMIT_BURST_SECONDS, RATE_LIMIT_MAX_QUEUE, RATE_LIMIT_BACKEND,
+    CACHE_SQLITE_PATH, TOKENS_PER_CHAR
+)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+
+def estimate_tokens(text):
+    """Примерное число токенов текста (1 токен ≈ TOKENS_PER_CHAR символов)"""
+    return len(text) // TOKENS_PER_CHAR + 1
+
+
+class QueueFullError(RateLimitError):
+    """Очередь ожидания бюджета переполнена"""
+    retryable = False
+
+
+class ThrottleTimeoutError(RateLimitError):
+    """Бюджет не освободился до дедлайна запроса"""
+    retryable = False
+
+
+def _take(state, costs, limits, now):
+    """
+    Пополняет корзины и списывает расход, если его хватает во всех
+
+    Args:
+        state: dict корзина -> (уровень, время обновления)
+        costs: dict корзина -> расход
+        limits: dict корзина -> (пополнение в секунду, ёмкость)
+
+    Returns:
+        tuple: (новое состояние корзин, секунды до появления бюджета; 0 - списано)
+    """
+    levels = {}
+    wait = 0.0
+    for name, cost in costs.items():
+        rate, capacity = limits[name]
+        level, updated = state.get(name, (capacity, now))
+        level = min(capacity, level + max(now - updated, 0.0) * rate)
+        levels[name] = level
+        # Запрос больше ёмкости корзины ждёт полную корзину, а не бесконечно
+        cost = min(cost, capacity)
+        if level < cost:
+            wait = max(wait, (cost - level) / rate)
+
+    if wait == 0:
+        for name, cost in costs.items():
+            levels[name] -= min(cost, limits[name][1])
+    return {name: (level, now) for name, level in levels.items()}, wait
+
+
+class MemoryBuckets:
+    """Корзины токенов в памяти процесса"""
+
+    backend = 'memory'
+
+    def __init__(self):
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def take(self, costs, limits):
+        with self._lock:
+            state, wait = _take(self._state, costs, limits, time.time())
+            self._state.update(state)
+            return wait
+
+
+class SQLiteBuckets:
+    """Корзины токенов в файле SQLite: общий бюджет для всех процессов на машине"""
+
+    backend = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits (name TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)"
+        )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def take(self, costs, limits):
+        conn = self._connect()
+        names = list(costs)
+        # BEGIN IMMEDIATE: чтение и списание - атомарно для всех процессов
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                f"SELECT name, level, updated FROM rate_limits WHERE name IN ({','.join('?' * len(names))})", names
+            ).fetchall()
+            state, wait = _take({name: (level, updated) for name, level, updated in rows}, costs, limits, time.time())
+            conn.executemany(
+                "INSERT OR REPLACE INTO rate_limits (name, level, updated) VALUES (?, ?, ?)",
+                [(name, level, updated) for name, (level, updated) in state.items()]
+            )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return wait
+
+
+class RateLimiter:
+    """
+    Бюджет запросов и токенов в минуту с очередью по приоритетам
+
+    Бюджет пробует взять только первый в очереди (наименьший приоритет,
+    затем порядок поступления), остальные ждут его.
+    """
+
+    def __init__(self, name, requests_per_minute=None, tokens_per_minute=None, burst_seconds=RATE_LIMIT_BURST_SECONDS,
+                 max_queue=RATE_LIMIT_MAX_QUEUE, buckets=None):
+        self.name = name
+        self.max_queue = max_queue
+        self.buckets = buckets or MemoryBuckets()
+        self.limits = {}  # корзина -> (пополнение в секунду, ёмкость)
+        if requests_per_minute:
+            rate = requests_per_minute / 60
+            self.limits[f'{name}:requests'] = (rate, max(1.0, rate * burst_seconds))
+        if tokens_per_minute:
+            rate = tokens_per_minute / 60
+            self.limits[f'{name}:tokens'] = (rate, max(1.0, rate * burst_seconds))
+
+        self._cond = threading.Condition()
+        self._queue = []  # heap (приоритет, номер)
+        self._order = itertools.count()
+        self._stats = {'requests': 0, 'throttled': 0, 'rejected': 0, 'timeouts': 0, 'wait_seconds': 0.0}
+
+    def _costs(self, tokens):
+        costs = {}
+        if f'{self.name}:requests' in self.limits:
+            costs[f'{self.name}:requests'] = 1
+        if f'{self.name}:tokens' in self.limits:
+            costs[f'{self.name}:tokens'] = max(tokens, 1)
+        return costs
+
+    def acquire(self, tokens=0, priority=PRIORITY_INTERACTIVE, timeout=None):
+        """
+        Ждёт бюджет на один запрос и tokens токенов
+
+        Args:
+            tokens: Оценка токенов запроса
+            priority: PRIORITY_INTERACTIVE или PRIORITY_BATCH (меньше - раньше)
+            timeout: Максимальное ожидание, секунды (None - без ограничения)
+
+        Returns:
+            float: Сколько секунд запрос ждал
+
+        Raises:
+            QueueFullError: В очереди уже max_queue запросов
+            ThrottleTimeoutError: Бюджет не появился за timeout
+        """
+        if not self.limits:
+            return 0.0
+
+        costs = self._costs(tokens)
+        started = time.monotonic()
+        with self._cond:
+            self._stats['requests'] += 1
+            if len(self._queue) >= self.max_queue:
+                self._stats['rejected'] += 1
+                raise QueueFullError(f"Очередь запросов {self.name} переполнена ({self.max_queue})")
+
+            entry = (priority, next(self._order))
+            heapq.heappush(self._queue, entry)
+            try:
+                while True:
+                    wait = None  # Не первый в очереди: ждём, пока очередь сдвинется
+                    if self._queue[0] == entry:
+                        wait = self.buckets.take(costs, self.limits)
+                        if wait == 0:
+                            break
+
+                    elapsed = time.monotonic() - started
+                    if timeout is not None:
+                        if elapsed >= timeout or (wait is not None and elapsed + wait > timeout):
+                            self._stats['timeouts'] += 1
+                            raise ThrottleTimeoutError(
+                                f"Бюджет запросов {self.name} не освободился за {timeout:.1f}s", retry_after=wait
+                            )
+                        wait = timeout - elapsed if wait is None else wait
+                    self._cond.wait(wait)
+            finally:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+
+            waited = time.monotonic() - started
+            if waited > 0.001:
+                self._stats['throttled'] += 1
+                self._stats['wait_seconds'] += waited
+            return waited
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queued'] = len(self._queue)
+        stats['wait_seconds'] = round(stats['wait_seconds'], 3)
+        stats['backend'] = self.buckets.backend
+        stats['limits_per_minute'] = {name: round(rate * 60) for name, (rate, _) in self.limits.items()}
+        return stats
+
+
+# Ограничители по виду запросов: один экземпляр на процесс
+_limiters = {}
+_limiters_lock = threading.Lock()
+_buckets = None
+
+
+def _shared_buckets():
+    global _buckets
+    if _buckets is None:
+        if RATE_LIMIT_BACKEND == 'sqlite':
+            path = CACHE_SQLITE_PATH
+            if not os.path.isabs(path):
+                path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+            try:
+                _buckets = SQLiteBuckets(path)
+            except Exception as e:
+                print(f"[WARNING] Ограничение частоты: бэкенд sqlite недоступен ({e}), используем memory")
+        elif RATE_LIMIT_BACKEND != 'memory':
+            print(f"[WARNING] Неизвестный бэкенд ограничения частоты: {RATE_LIMIT_BACKEND}, используем memory")
+        if _buckets is None:
+            _buckets = MemoryBuckets()
+    return _buckets
+
+
+def get_rate_limiter(kind):
+    """Общий ограничитель для вида запросов ('chat', 'embeddings') по RATE_LIMITS"""
+    with _limiters_lock:
+        limiter = _limiters.get(kind)
+        if limiter is None:
+            limits = RATE_LIMITS.get(kind) or {}
+            limiter = _limiters[kind] = RateLimiter(
+                kind,
+                requests_per_minute=limits.get('requests_per_minute'),
+                tokens_per_minute=limits.get('tokens_per_minute'),
+                buckets=_shared_buckets()
+            )
+        return limiter
+
+
+def rate_limit_stats():
+    """Статистика всех созданных ограничителей"""
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {kind: limiter.stats() for kind, limiter in limiters.items()}
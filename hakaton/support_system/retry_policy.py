@@ -0,0 +1,194 @@
+"""
+Политика повторных запросов к API
+
+Ошибки API приводятся к типам (перегрузка, ошибка сервера, сеть, ключ,
+некорректный запрос), повторяются только временные. Задержка растёт
+экспоненциально со случайным разбросом от нуля (full jitter), а если
+сервер прислал Retry-After, ждём не меньше него. Общий дедлайн ограничивает
+время одного запроса вместе с повторами: если следующая попытка в него не
+помещается, ошибка возвращается сразу, без ожидания.
+"""
+
+import asyncio
+import email.utils
+import random
+import time
+
+import openai
+
+from config import LLM_RETRY_MAX_ATTEMPTS, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY, LLM_RETRY_DEADLINE
+
+
+class APIError(Exception):
+    """Ошибка запроса к API после классификации"""
+
+    kind = 'error'
+    retryable = False
+
+    def __init__(self, message, status_code=None, retry_after=None, attempts=0):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after  # Секунды из заголовка Retry-After (или None)
+        self.attempts = attempts
+
+
+class RateLimitError(APIError):
+    """429: API перегружен"""
+    kind = 'rate_limit'
+    retryable = True
+
+
+class ServerError(APIError):
+    """5xx: временная ошибка сервера"""
+    kind = 'server_error'
+    retryable = True
+
+
+class NetworkError(APIError):
+    """Таймаут или обрыв соединения"""
+    kind = 'network_error'
+    retryable = True
+
+
+class AuthError(APIError):
+    """401/403: неверный ключ или нет прав"""
+    kind = 'auth_error'
+
+
+class RequestError(APIError):
+    """Прочие ошибки запроса (повтор не поможет)"""
+    kind = 'request_error'
+
+
+def parse_retry_after(headers):
+    """Секунды ожидания из заголовков retry-after-ms / Retry-After (число или HTTP-дата)"""
+    if not headers:
+        return None
+    try:
+        value = headers.get('retry-after-ms')
+        if value is not None:
+            return max(float(value) / 1000, 0.0)
+        value = headers.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            moment = email.utils.parsedate_to_datetime(value)
+            return max(moment.timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(exc):
+    """Исключение клиента API -> APIError соответствующего типа"""
+    if isinstance(exc, APIError):
+        return exc
+
+    if isinstance(exc, openai.APIConnectionError):  # включая APITimeoutError
+        return NetworkError(str(exc))
+
+    status_code = getattr(exc, 'status_code', None)
+    if status_code is None and '429' in str(exc):
+        status_code = 429
+    retry_after = parse_retry_after(getattr(getattr(exc, 'response', None), 'headers', None))
+
+    if status_code == 429:
+        return RateLimitError(str(exc), status_code, retry_after)
+    if status_code in (401, 403):
+        return AuthError(str(exc), status_code)
+    if status_code is not None and (status_code >= 500 or status_code in (408, 409)):
+        return ServerError(str(exc), status_code, retry_after)
+    if status_code is None and isinstance(exc, (TimeoutError, ConnectionError)):
+        return NetworkError(str(exc))
+    return RequestError(str(exc), status_code)
+
+
+class RetryPolicy:
+    """
+    Повторы с экспоненциальной задержкой, full jitter, Retry-After и дедлайном
+
+    Args:
+        max_attempts: Всего попыток, включая первую
+        base_delay: Задержка перед первым повтором (верхняя граница jitter), секунды
+        max_delay: Максимальная задержка между попытками, секунды
+        deadline: Время на запрос вместе с повторами, секунды (None - без ограничения)
+    """
+
+    def __init__(self, max_attempts=LLM_RETRY_MAX_ATTEMPTS, base_delay=LLM_RETRY_BASE_DELAY,
+                 max_delay=LLM_RETRY_MAX_DELAY, deadline=LLM_RETRY_DEADLINE):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def delay(self, attempt, error):
+        """Задержка перед повтором после неудачной попытки attempt (с 1)"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if error.retry_after is not None:
+            delay = max(delay, error.retry_after)
+        return delay
+
+    def _next_delay(self, attempt, error, started, deadline):
+        """Задержка перед следующей попыткой или None, если повторять не нужно"""
+        if not error.retryable or attempt >= self.max_attempts:
+            return None
+        delay = self.delay(attempt, error)
+        if deadline is not None and time.monotonic() - started + delay >= deadline:
+            return None
+        return delay
+
+    def _remaining(self, started, deadline):
+        return None if deadline is None else max(deadline - (time.monotonic() - started), 0.001)
+
+    def call(self, fn, on_retry=None, deadline=None):
+        """
+        Вызывает fn(timeout) с повторами
+
+        Args:
+            fn: Функция запроса; timeout - оставшееся до дедлайна время (или None)
+            on_retry: Вызывается перед ожиданием: on_retry(attempt, delay, error)
+            deadline: Переопределяет дедлайн политики
+
+        Raises:
+            APIError: Последняя ошибка (с attempts), если запрос не удался
+        """
+        deadline = self.deadline if deadline is None else deadline
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return fn(self._remaining(started, deadline))
+            except Exception as exc:
+                error = classify_error(exc)
+                error.attempts = attempt
+                delay = self._next_delay(attempt, error, started, deadline)
+                if delay is None:
+                    if error is exc:
+                        raise
+                    raise error from exc
+                if on_retry:
+                    on_retry(attempt, delay, error)
+                time.sleep(delay)
+
+    async def acall(self, fn, on_retry=None, deadline=None):
+        """Асинхронный call: fn(timeout) возвращает awaitable, ожидание не блокирует event loop"""
+        deadline = self.deadline if deadline is None else deadline
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await fn(self._remaining(started, deadline))
+            except Exception as exc:
+                error = classify_error(exc)
+                error.attempts = attempt
+                delay = self._next_delay(attempt, error, started, deadline)
+                if delay is None:
+                    if error is exc:
+                        raise
+                    raise error from exc
+                if on_retry:
+                    on_retry(attempt, delay, error)
+                await asyncio.sleep(delay)
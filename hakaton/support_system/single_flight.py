@@ -0,0 +1,104 @@
+"""
+Объединение одинаковых одновременных запросов к API (single-flight)
+
+Если одно и то же обращение приходит несколько раз подряд (массовый сбой,
+повторная отправка формы, повтор оператора), все копии промахиваются мимо
+кэшей: кэш заполняется только после ответа API. Здесь первый вызов с
+данным ключом выполняет запрос, а одновременные вызовы с тем же ключом
+ждут его и получают тот же результат (или то же исключение). Завершённые
+запросы не хранятся - за повторное использование отвечают кэши.
+"""
+
+import asyncio
+import hashlib
+import json
+import threading
+import weakref
+
+
+def request_key(*parts):
+    """Ключ запроса: md5 от модели, параметров и входных данных (JSON)"""
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.md5(payload.encode('utf-8')).hexdigest()
+
+
+class _Call:
+    __slots__ = ('result', 'error', 'done')
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SingleFlight:
+    """Выполняемые запросы по ключу: один запрос на ключ в каждый момент времени"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # ключ -> _Call
+        self._async_calls = weakref.WeakKeyDictionary()  # event loop -> {ключ -> asyncio.Task}
+        self._stats = {'calls': 0, 'shared': 0}
+
+    def do(self, key, fn):
+        """
+        Результат fn() - общий для одновременных вызовов с одним ключом
+
+        Raises:
+            Exception: Исключение fn (одно для всех ожидавших)
+        """
+        with self._lock:
+            self._stats['calls'] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self._stats['shared'] += 1
+
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def ado(self, key, fn):
+        """
+        Асинхронный do: fn() возвращает awaitable
+
+        Запрос выполняется отдельной задачей, поэтому отмена одного из
+        ожидающих не отменяет его для остальных.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._stats['calls'] += 1
+            tasks = self._async_calls.setdefault(loop, {})
+            task = tasks.get(key)
+            if task is None:
+                task = tasks[key] = loop.create_task(fn())
+                task.add_done_callback(lambda _: self._forget(loop, key, task))
+            else:
+                self._stats['shared'] += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, loop, key, task):
+        with self._lock:
+            tasks = self._async_calls.get(loop)
+            if tasks is not None and tasks.get(key) is task:
+                del tasks[key]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls) + sum(len(tasks) for tasks in self._async_calls.values())
+        return stats